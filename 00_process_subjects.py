@@ -3,12 +3,21 @@
 import argparse
 import subprocess
 import sys
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import _0_pull_subject_files
 import _1_run_nibabies
 import _2_push_derivatives
 import _3_delete_local_directories
+from utils.bandwidth import configure_bandwidth
+from utils.errors import StageError, run_stage
+from utils.metrics import print_transfer_summary, summarize_transfers, transfer_context
+from utils.monitor import print_run_summary, summarize_runs
+from utils.predict import estimate_batch
+from utils.scheduling import PRIORITIES, Scheduler
+from utils.tracing import span, trace
+from utils.transport import TRANSPORTS
 
 
 def parse_args():
@@ -87,6 +96,95 @@ def parse_args():
         help="The username to use when connecting to the Whale computer. For example, 'Lab Username'.",
         default=None,
     )
+    parser.add_argument(
+        "--snapshot",
+        action="store_true",
+        dest="snapshot",
+        help="push the Nibabies outputs to a new, dated snapshot directory on the server, hard-linking unchanged files to the previous outputs.",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        dest="archive",
+        help="transfer the small-file heavy surface and figures directories as single compressed tar archives. Requires zstd. Pushes to a mounted server still use rsync.",
+    )
+    parser.add_argument(
+        "--recompress-level",
+        type=int,
+        default=None,
+        choices=range(1, 10),
+        dest="recompress_level",
+        help="recompress the large .nii.gz outputs with this gzip level (1-9) before pushing them. The uncompressed CIFTI outputs (.dtseries.nii) are not touched, and recompressed files are not hard-linked to a previous --snapshot.",
+    )
+    parser.add_argument(
+        "--transfer-profile",
+        default="auto",
+        choices=["auto", "default", "lan", "wan"],
+        dest="profile",
+        help="rsync options for the transfers. 'auto' (default) measures the link to the server once per batch and picks 'lan' or 'wan'.",
+    )
+    parser.add_argument(
+        "--transport",
+        default=None,
+        choices=list(TRANSPORTS),
+        dest="transport",
+        help="how to move files to and from the server. Default is the MRI_TRANSPORT environment variable, or 'rsync' if it is not set.",
+    )
+    parser.add_argument(
+        "--bandwidth-budget",
+        type=int,
+        default=None,
+        dest="bandwidth_budget",
+        help="total bandwidth in KB/s that the transfers may use together, including those of the other runs on this computer. Pulls get a larger share than pushes, and a transfer waits while the running ones use the budget. Default is no limit.",
+    )
+    parser.add_argument(
+        "--max-transfers",
+        type=int,
+        default=None,
+        dest="max_transfers",
+        help="maximum number of transfers that may run at the same time on this computer. Waiting pulls start before waiting pushes. Default is no limit.",
+    )
+    parser.add_argument(
+        "--monitor-interval",
+        type=float,
+        default=None,
+        dest="monitor_interval_s",
+        help="seconds between two samples of the container's CPU and memory usage. Default is the MRI_MONITOR_INTERVAL_S environment variable, or 10. 0 turns the sampling off.",
+    )
+    parser.add_argument(
+        "--concurrent",
+        type=int,
+        default=1,
+        dest="concurrent",
+        help="number of subjects that run at the same time on this computer, for example when a dispatcher runs several batches. The CPUs and memory are divided between them. Default is 1.",
+    )
+    parser.add_argument(
+        "--priority",
+        action="append",
+        default=[],
+        metavar="SUBJECT=CLASS",
+        help=f"priority class of a subject, one of {', '.join(PRIORITIES)}. Can be repeated. Default is 'normal'.",
+    )
+    parser.add_argument(
+        "--deadline",
+        action="append",
+        default=[],
+        metavar="SUBJECT=TIME",
+        help="time by which a subject should be done, such as '1103=2024-05-01T17:00'. Can be repeated.",
+    )
+    parser.add_argument(
+        "--order",
+        default="scheduled",
+        choices=["scheduled", "given"],
+        help="'scheduled' (default) runs the subjects by priority, deadline, then shortest predicted runtime first. 'given' keeps the order of --subjects, and ignores --priority and --deadline.",
+    )
+    parser.add_argument(
+        "--profile",
+        default=None,
+        choices=["cprofile", "sample"],
+        dest="python_profile",
+        help="profile the Python side of the batch. 'cprofile' saves a cProfile file next to the trace in logs/traces, 'sample' adds sampled Python stacks to the trace timeline. Default is no profiling.",
+    )
     args = parser.parse_args()
     return vars(args)
 
@@ -102,50 +200,84 @@ def process_one_subject(
     nibabies_path=None,
     ip_address=None,
     username=None,
+    snapshot=None,
+    archive=False,
+    recompress_level=None,
+    profile="auto",
+    transport=None,
+    monitor_interval_s=None,
+    concurrent=1,
 ):
     """Process one subject. Use subprocess to run individual scripts."""
     print(f" 👇 Processing started for subject {subject} {session}👇 \n")
-    # Pull down the subject files from the server
-    _0_pull_subject_files.main(
-        project=project,
-        subject=subject,
-        session=session,
-        anat_only=anat_only,
-        ip_address=ip_address,
-        username=username,
-    )
-    # run nibabies
-    _1_run_nibabies.main(
-        project=project,
-        subject=subject,
-        session=session,
-        surface_recon_method=surface_recon_method,
-        anat_only=anat_only,
-        version=version,
-        use_dev=use_dev,
-        nibabies_path=nibabies_path,
-    )
-    # Push the subject Nibabies derivatives back to the server
-    _2_push_derivatives.rsync_to_server(
-        project=project,
-        subject=subject,
-        session=session,
-        surface_recon_method=surface_recon_method,
-        ip_address=ip_address,
-        username=username,
-    )
-    # Clean up local files
-    _3_delete_local_directories.clean_up(
-        project=project,
-        subject=subject,
-        session=session,
-        surface_recon_method=surface_recon_method,
-    )
+    with span("subject", subject=subject, session=session):
+        # Pull down the subject files from the server
+        # Each stage retries the failures that a retry can fix, and raises a
+        # StageError otherwise, so a failed stage stops the later ones
+        with span("prepare"):
+            run_stage(
+                "prepare",
+                _0_pull_subject_files.main,
+                project=project,
+                subject=subject,
+                session=session,
+                anat_only=anat_only,
+                ip_address=ip_address,
+                username=username,
+                archive=archive,
+                profile=profile,
+                transport=transport,
+            )
+        # run nibabies
+        with span("nibabies"):
+            run_stage(
+                "nibabies",
+                _1_run_nibabies.main,
+                project=project,
+                subject=subject,
+                session=session,
+                surface_recon_method=surface_recon_method,
+                anat_only=anat_only,
+                version=version,
+                use_dev=use_dev,
+                nibabies_path=nibabies_path,
+                monitor_interval_s=monitor_interval_s,
+                concurrent=concurrent,
+                check=True,
+                escalate=True,
+            )
+        # Push the subject Nibabies derivatives back to the server
+        with span("push"):
+            run_stage(
+                "push",
+                _2_push_derivatives.rsync_to_server,
+                project=project,
+                subject=subject,
+                session=session,
+                surface_recon_method=surface_recon_method,
+                ip_address=ip_address,
+                username=username,
+                snapshot=snapshot,
+                archive=archive,
+                recompress_level=recompress_level,
+                profile=profile,
+                transport=transport,
+            )
+        # Clean up local files
+        with span("cleanup"):
+            run_stage(
+                "cleanup",
+                _3_delete_local_directories.clean_up,
+                project=project,
+                subject=subject,
+                session=session,
+                surface_recon_method=surface_recon_method,
+            )
     print(f"✅ Processing completed for subject {subject}\n")
 
 
 def main(**kwargs):
-    """Process multiple subjects with Nibabies."""
+    """Process multiple subjects with Nibabies, and return the subjects that failed."""
     project = kwargs["project"]
     subjects = kwargs["subjects"]
     session = kwargs["session"]
@@ -156,40 +288,138 @@ def main(**kwargs):
     nibabies_path = kwargs.get("nibabies_path", None)
     ip_address = kwargs.get("ip_address", None)
     username = kwargs.get("username", None)
+    archive = kwargs.get("archive", False)
+    recompress_level = kwargs.get("recompress_level", None)
+    profile = kwargs.get("profile", "auto")
+    transport = kwargs.get("transport", None)
+    monitor_interval_s = kwargs.get("monitor_interval_s", None)
+    concurrent = kwargs.get("concurrent", 1)
+    snapshot = None
+    if kwargs.get("snapshot", False):
+        snapshot = f"{datetime.now():%Y%m%d}_nibabies-{version}"
 
     assert isinstance(anat_only, bool), "anat_only must be a boolean."
     subject_success_file = Path(f"./logs/{project}_subject_success.txt")
-    for subject in subjects:
-        # sys.stdout = open(f'./sub-{subject}_ses-{session}_processing.log', 'w')
-        print(f"\nProcessing {subject}")
-        with subject_success_file.open("a") as f:
-            f.write(f"\n ####{subject} #### \n")
-        try:
-            process_one_subject(
-                project=project,
+    batch = f"{datetime.now():%Y%m%d-%H%M%S}"
+    configure_bandwidth(
+        budget_kbps=kwargs.get("bandwidth_budget", None),
+        max_active=kwargs.get("max_transfers", None),
+    )
+    predicted = dict()
+    try:
+        estimates = estimate_batch(
+            project,
+            subjects,
+            session,
+            surface_recon_method="infantfs" if surface_recon_method == "freesurfer" else surface_recon_method,
+            anat_only=anat_only,
+        )
+        predicted = {subject: seconds for subject, seconds, _ in estimates}
+    except Exception as error:
+        print(f"Could not predict the runtimes: {error}")
+    priorities = _parse_assignments(kwargs.get("priority", []), "--priority")
+    deadlines = _parse_assignments(kwargs.get("deadline", []), "--deadline")
+    if kwargs.get("order", "scheduled") == "given":
+        if priorities or deadlines:
+            print("--order given keeps the order of --subjects, ignoring --priority and --deadline")
+        # Without a priority, deadline or runtime, the items keep the order they were pushed in
+        scheduler = Scheduler(dict(subject=subject) for subject in subjects)
+    else:
+        scheduler = Scheduler(
+            dict(
                 subject=subject,
-                session=session,
-                surface_recon_method=surface_recon_method,
-                anat_only=anat_only,
-                version=version,
-                use_dev=use_dev,
-                nibabies_path=nibabies_path,
-                ip_address=ip_address,
-                username=username,
+                priority=priorities.get(subject, "normal"),
+                deadline=deadlines.get(subject),
+                predicted_s=predicted.get(subject),
             )
-        except Exception as e:
-            mgs = f"❌ Error processing subject {subject}: {e}"
-            print(mgs)
+            for subject in subjects
+        )
+    # Also checks the priorities and deadlines before anything runs
+    planned = scheduler.ordered()
+    if predicted:
+        print("Predicted Nibabies runtimes:")
+        finish = datetime.now()
+        for item in planned:
+            # estimate_batch skips the subjects whose inputs it could not read
+            seconds = predicted.get(item["subject"])
+            if seconds is None:
+                continue
+            finish += timedelta(seconds=seconds)
+            print(f"    sub-{item['subject']}: {seconds / 3600:.1f} h, done around {finish:%a %H:%M}")
+    failed = []
+    with trace(f"batch-{batch}", profile=kwargs.get("python_profile", None)):
+        while scheduler:
+            # Picked at each step, so that a deadline that came closer moves its subject up
+            subject = scheduler.pop()["subject"]
+            # sys.stdout = open(f'./sub-{subject}_ses-{session}_processing.log', 'w')
+            print(f"\nProcessing {subject}")
+            with subject_success_file.open("a") as f:
+                f.write(f"\n ####{subject} #### \n")
+            with transfer_context(batch=batch):
+                try:
+                    process_one_subject(
+                        project=project,
+                        subject=subject,
+                        session=session,
+                        surface_recon_method=surface_recon_method,
+                        anat_only=anat_only,
+                        version=version,
+                        use_dev=use_dev,
+                        nibabies_path=nibabies_path,
+                        ip_address=ip_address,
+                        username=username,
+                        snapshot=snapshot,
+                        archive=archive,
+                        recompress_level=recompress_level,
+                        profile=profile,
+                        transport=transport,
+                        monitor_interval_s=monitor_interval_s,
+                        concurrent=concurrent,
+                    )
+                except Exception as e:
+                    if isinstance(e, StageError):
+                        mgs = f"❌ Error processing subject {subject} at the {e.stage} stage ({e.kind}): {e}"
+                    else:
+                        mgs = f"❌ Error processing subject {subject}: {e}"
+                    print(mgs)
+                    failed.append(subject)
+                    with subject_success_file.open("a") as f:
+                        f.write(mgs)
+                    continue
+                finally:
+                    print_transfer_summary(
+                        summarize_transfers(by="stage", batch=batch, subject=subject),
+                        title=f"Transfers for subject {subject}",
+                    )
             with subject_success_file.open("a") as f:
-                f.write(mgs)
-            continue
-        with subject_success_file.open("a") as f:
-            f.write(f"✅ {subject} Completed \n")
+                f.write(f"✅ {subject} Completed \n")
+    print_transfer_summary(
+        summarize_transfers(by="subject", batch=batch),
+        title=f"Transfers for batch {batch}",
+    )
+    print_run_summary(
+        summarize_runs(by="subject", batch=batch),
+        title=f"Container resource usage for batch {batch}",
+    )
+    return failed
+
+
+def _parse_assignments(values, option):
+    """Return a dict from ``["SUBJECT=VALUE", ...]``."""
+    assignments = dict()
+    for value in values:
+        subject, sep, assigned = value.partition("=")
+        if not sep:
+            raise ValueError(f"{option} must look like SUBJECT=VALUE, but got: {value}")
+        assignments[subject] = assigned
+    return assignments
 
 
 def run_main():
     args = parse_args()
-    main(**args)
+    failed = main(**args)
+    # A non-zero exit lets a caller, such as utils/executors.py, see failed subjects
+    sys.exit(1 if failed else 0)
 
 
 if __name__ == "__main__":
@@ -1,7 +1,15 @@
 import argparse
+import os
 import subprocess
+import sys
+import time
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from utils.images import ensure_image, get_singularity  # noqa: E402
+from utils.monitor import monitored_run  # noqa: E402
+from utils.predict import subject_features  # noqa: E402
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Run BiBS-Net')
@@ -13,12 +21,19 @@ def parse_args():
         help="Project name. Must be one 'BABIES', or 'ABC'",
         required=True,
     )
-    parser.add_argument(
+    subjects = parser.add_mutually_exclusive_group(required=True)
+    subjects.add_argument(
         "--subject",
         type=str,
+        nargs="+",
         dest="subject",
-        help="The label of the participant that should be analyzed, for example 1011 for sub-1011. The label corresponds to sub-<participant_label> from the BIDS spec (so it does not include 'sub-')",
-        required=True,
+        help="The label of the participant that should be analyzed, for example 1011 for sub-1011. The label corresponds to sub-<participant_label> from the BIDS spec (so it does not include 'sub-'). Several labels run one after the other in this job.",
+    )
+    subjects.add_argument(
+        "--subjects-file",
+        type=str,
+        dest="subjects_file",
+        help="A text file with one participant label per line, which run one after the other in this job.",
     )
     parser.add_argument(
         "--session",
@@ -33,33 +48,97 @@ def parse_args():
         type=str,
         dest="image_path",
         default=None,
-        help="Absolute path to the BIBSnet image. If ``None`` is provided (default), Then function will use the image stored on The Humphreys Lab DORS server: ``/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sil``.",
+        help="Absolute path to the BIBSnet image. If ``None`` is provided (default), Then function will use the image stored on The Humphreys Lab DORS server: ``/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sif``, after checking it against its pinned checksum (see utils/images.py).",
+    )
+    parser.add_argument(
+        "--log-dir",
+        type=str,
+        dest="log_dir",
+        default=None,
+        help="Where to write the log of each subject, when several subjects are run. Default is SLURM/log/bibsnet.",
     )
     args = parser.parse_args()
     return vars(args)
 
 
+def run_subject(project, subject, session, image_path, bids_path, derivatives_path, log_file=None):
+    """Run the BIBSnet container on one subject, and return its exit code.
+
+    The run is recorded in the ``runs`` ledger (see ``utils.monitor``). If
+    ``log_file`` is given, the output of the container is written to it.
+    """
+    command = [
+        get_singularity(),
+        "run",
+        "--cleanenv",
+        "--no-home",
+        "--nv",
+        "--bind",
+        f"{bids_path}:/input",
+        "--bind",
+        f"{derivatives_path}:/output",
+        str(image_path),
+        "/input",
+        "/output",
+        "participant",
+        "-participant",
+        subject,
+    ]
+    labels = dict(project=project, subject=subject, session=session)
+    try:
+        labels["features"] = subject_features(project, subject, session, bids_dir=bids_path)
+    except OSError as error:
+        print(f"Could not read the input features: {error}")
+    if log_file is None:
+        returncode, _ = monitored_run(command, tool="bibsnet", **labels)
+        return returncode
+    with open(log_file, "w") as log:
+        returncode, _ = monitored_run(
+            command, tool="bibsnet", stdout=log, stderr=subprocess.STDOUT, **labels
+        )
+    return returncode
+
+
 def main(
     project,
-    subject,
-    session,
+    subject=None,
+    session=None,
     image_path=None,
+    subjects_file=None,
+    log_dir=None,
     ):
-    """Run BIBSnet on a single subject.
-    
+    """Run BIBSnet on one subject, or on several subjects one after the other.
+
+    Running several subjects in one job saves the GPU allocation and container
+    start up of each subject. The output of each subject is then written to its own
+    log file, and a subject that fails does not stop the others.
+
     Parameters
     ----------
     project : str
         Project name. Must be one 'BABIES', or 'ABC'.
-    subject : str
-        The label of the participant that should be analyzed, for example 1011 for sub-1011.
+    subject : str | list of str
+        The label of the participant that should be analyzed, for example 1011 for sub-1011, or a list of labels.
     session : str
         The session of the participant that should be analyzed, for example 'newborn', 'sixmonth', or 'twelvemonth'.
     image_path : str, optional
-        Absolute path to the BIBSnet image. If ``None`` is provided (default), Then function will use the image stored on The Humphreys Lab DORS server: ``/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sil``.
+        Absolute path to the BIBSnet image. If ``None`` is provided (default), Then function will use the image stored on The Humphreys Lab DORS server: ``/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sif``, after checking it against its pinned checksum (see ``utils.images``).
+    subjects_file : str, optional
+        A text file with one participant label per line, instead of ``subject``.
+    log_dir : str, optional
+        Where to write the log of each subject, when there are several. Default is ``SLURM/log/bibsnet``.
+
+    Returns
+    -------
+    returncode : int
+        0 if all the subjects succeeded, else 1.
     """
-    dors_image_path = Path("/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sif")
-    image_path = Path(image_path) if image_path is not None else dors_image_path
+    subjects = [subject] if isinstance(subject, str) else list(subject or [])
+    if subjects_file is not None:
+        subjects += [line.strip() for line in Path(subjects_file).read_text().splitlines() if line.strip()]
+    if not subjects:
+        raise ValueError("Pass a subject or a subjects_file.")
+    image_path = Path(image_path) if image_path is not None else ensure_image("bibsnet")
     if not isinstance(image_path, Path):
         raise TypeError(f"image_path must be a string or a Path object, got {type(image_path)} instead.")
     if not image_path.exists():
@@ -75,27 +154,28 @@ def main(
         raise FileNotFoundError(f"BIDS directory not found: {bids_path}")
     if not derivatives_path.exists():
         raise FileNotFoundError(f"Derivatives directory not found: {derivatives_path}")
+
     # Run BIBSnet
-    subprocess.call(
-        [
-        "singularity",
-        "run",
-        "--cleanenv",
-        "--no-home",
-        "--nv",
-        "--bind",
-        f"{bids_path}:/input",
-        "--bind",
-        f"{derivatives_path}:/output",
-        image_path,
-        "/input",
-        "/output",
-        "participant",
-        "-participant",
-        subject,
-        ]
-    )
+    if len(subjects) == 1:
+        return run_subject(project, subjects[0], session, image_path, bids_path, derivatives_path)
+    log_dir = Path(log_dir) if log_dir is not None else slurm_dir / "log" / "bibsnet"
+    log_dir.mkdir(parents=True, exist_ok=True)
+    job_id = os.environ.get("SLURM_JOB_ID", "local")
+    failed = []
+    for ii, label in enumerate(subjects, start=1):
+        log_file = log_dir / f"{job_id}_sub-{label}_ses-{session}.log"
+        print(f"[{ii}/{len(subjects)}] Running BIBSnet on sub-{label}_ses-{session}, log: {log_file}", flush=True)
+        start = time.perf_counter()
+        returncode = run_subject(project, label, session, image_path, bids_path, derivatives_path, log_file)
+        print(f"[{ii}/{len(subjects)}] sub-{label} exited with {returncode} after {time.perf_counter() - start:.0f} s", flush=True)
+        if returncode != 0:
+            failed.append(label)
+    print(f"BIBSnet finished {len(subjects) - len(failed)} of {len(subjects)} subjects.")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    return 1 if failed else 0
+
 
 if __name__ == "__main__":
     args = parse_args()
-    main(**args)
+    sys.exit(main(**args))
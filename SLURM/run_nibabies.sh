@@ -31,8 +31,7 @@ if [ "$#" -lt 4 ] || [ "$#" -gt 5 ]; then
     exit 1
 fi
 
-# Define the image and options
-IMAGE="docker://nipreps/nibabies:23.1.0"
+# Define the options
 PROJECT=$1
 PARTICIPANT_LABEL=$2
 AGE_DESCRIPTION=$3
@@ -67,10 +66,98 @@ SESSION_DIR="$PROJECT_DIR/$AGE_DESCRIPTION"
 BIDS_DIR="$SESSION_DIR/bids"
 DERIVATIVES_DIR="$SESSION_DIR/derivatives"
 OUT_DIR="$DERIVATIVES_DIR/Nibabies"
-SCRATCH_DIR="$DERIVATIVES_DIR/work/nibabies_work"
+# Each subject has its own work directory, since the tasks of an array run at the same
+# time and each push task deletes the work directory of its subject
+SCRATCH_DIR="$DERIVATIVES_DIR/work/nibabies_work/sub-$PARTICIPANT_LABEL"
 PRECOMPUTED_DIR="$DERIVATIVES_DIR/precomputed"
 LICENSE_FILE="$ROOT_DIR/utils/assets/license.txt"
 
+# Stage the inputs, the work directory and the outputs on the node-local disk
+# ($TMPDIR), instead of running Nipype's work directory on the shared home storage.
+# NIBABIES_STAGING=auto (default) stages if $TMPDIR has room for the inputs plus
+# NIBABIES_STAGING_MIN_GB (the work directory and the outputs), off never stages.
+NIBABIES_STAGING="${NIBABIES_STAGING:-auto}"
+NIBABIES_STAGING_MIN_GB="${NIBABIES_STAGING_MIN_GB:-60}"
+STAGE_DIR=""
+if [ "$NIBABIES_STAGING" != "off" ] && [ -n "$TMPDIR" ] && [ -d "$TMPDIR" ]; then
+    INPUT_KB=$(du -sk "$BIDS_DIR/sub-$PARTICIPANT_LABEL" "$PRECOMPUTED_DIR/sub-$PARTICIPANT_LABEL" 2>/dev/null | awk '{total += $1} END {print total + 0}')
+    NEEDED_KB=$((INPUT_KB + NIBABIES_STAGING_MIN_GB * 1024 * 1024))
+    FREE_KB=$(df -Pk "$TMPDIR" | awk 'NR == 2 {print $4}')
+    if [ -n "$FREE_KB" ] && [ "$FREE_KB" -ge "$NEEDED_KB" ]; then
+        STAGE_DIR=$(mktemp -d "$TMPDIR/nibabies_${PROJECT}_sub-${PARTICIPANT_LABEL}_XXXXXX")
+    else
+        echo "Not staging to $TMPDIR: $((FREE_KB / 1024 / 1024)) GB free, $((NEEDED_KB / 1024 / 1024)) GB needed"
+    fi
+fi
+
+# Copy the outputs of a staged run back and delete the staging directory when the script
+# exits, even if Nibabies failed, or the job was cancelled or timed out (SLURM sends
+# SIGTERM first). The outputs hold the crash reports. The work directory stays on the
+# node, its node runtimes are saved first.
+STATUS=1
+STAGED=""
+NIBABIES_PID=""
+finish() {
+    if [ -n "$STAGED" ]; then
+        echo "Copying the outputs of sub-$PARTICIPANT_LABEL back to $FINAL_OUT_DIR"
+        mkdir -p "$FINAL_OUT_DIR"
+        cp -a "$OUT_DIR/." "$FINAL_OUT_DIR/" || STATUS=1
+        (cd "$ROOT_DIR" && python3 -m utils.nodes --work-dir "$SCRATCH_DIR" --record \
+            --project "$PROJECT" --subject "$PARTICIPANT_LABEL" --session "$AGE_DESCRIPTION") \
+            || echo "Could not save the runtimes of the Nipype nodes"
+    fi
+    if [ -n "$STAGE_DIR" ]; then
+        rm -rf "$STAGE_DIR"
+    fi
+    exit $STATUS
+}
+stop() {
+    echo "Received SIGTERM, stopping Nibabies"
+    if [ -n "$NIBABIES_PID" ]; then
+        kill -TERM "$NIBABIES_PID" 2>/dev/null
+        wait "$NIBABIES_PID"
+    fi
+    STATUS=143
+    exit $STATUS
+}
+trap finish EXIT
+trap stop TERM
+
+if [ -n "$STAGE_DIR" ]; then
+    echo "Staging sub-$PARTICIPANT_LABEL to $STAGE_DIR"
+    # Only this subject, and the dataset level files (dataset_description.json...)
+    if mkdir -p "$STAGE_DIR/bids" "$STAGE_DIR/precomputed" "$STAGE_DIR/out" "$STAGE_DIR/work" \
+        && find "$BIDS_DIR" -maxdepth 1 -type f -exec cp -p -t "$STAGE_DIR/bids/" {} + \
+        && cp -a "$BIDS_DIR/sub-$PARTICIPANT_LABEL" "$STAGE_DIR/bids/" \
+        && { [ ! -d "$PRECOMPUTED_DIR" ] \
+            || find "$PRECOMPUTED_DIR" -maxdepth 1 -type f -exec cp -p -t "$STAGE_DIR/precomputed/" {} +; } \
+        && { [ ! -d "$PRECOMPUTED_DIR/sub-$PARTICIPANT_LABEL" ] \
+            || cp -a "$PRECOMPUTED_DIR/sub-$PARTICIPANT_LABEL" "$STAGE_DIR/precomputed/"; }
+    then
+        STAGED=1
+        FINAL_OUT_DIR="$OUT_DIR"
+        BIDS_DIR="$STAGE_DIR/bids"
+        PRECOMPUTED_DIR="$STAGE_DIR/precomputed"
+        OUT_DIR="$STAGE_DIR/out"
+        SCRATCH_DIR="$STAGE_DIR/work"
+    else
+        # Do not run on partial inputs
+        echo "Could not stage sub-$PARTICIPANT_LABEL to $STAGE_DIR, running from the shared storage"
+        rm -rf "$STAGE_DIR"
+        STAGE_DIR=""
+    fi
+fi
+
+mkdir -p "$SCRATCH_DIR"
+
+# The cached .sif of the image (see utils/images.py), which is built once for all
+# jobs. Fall back to converting the Docker image in this job if that fails.
+IMAGE=$(cd "$ROOT_DIR" && python3 -m utils.images path nibabies) || IMAGE="docker://nipreps/nibabies:23.1.0"
+
+# --nprocs, --omp-nthreads and --mem-mb from the SLURM allocation and past runs,
+# see utils/resources.py. Nibabies picks its own defaults if this fails.
+RESOURCE_FLAGS=$(cd "$ROOT_DIR" && python3 -m utils.resources --format nibabies) || RESOURCE_FLAGS=""
+
 echo "Passing these parameters to singularity"
 echo "---------------------------------------"
 echo " BIDS: $BIDS_DIR"
@@ -83,9 +170,12 @@ echo " PARTICIPANT: $PARTICIPANT_LABEL"
 echo " METHOD: $SURFACE_RECON_METHOD"
 echo " ANAT_ONLY: $ANAT_ONLY_FLAG"
 echo " IMAGE: $IMAGE"
+echo " STAGED: ${STAGE_DIR:-no}"
+echo " RESOURCES: $RESOURCE_FLAGS"
 echo "----------------------------------------"
 # XXX: add arguments for anat_only, CIFTI output?
-# Execute the Singularity command
+# Execute the Singularity command. It runs in the background so that SIGTERM is
+# handled (see stop) without waiting for it to exit
 singularity run -e \
   -B ${BIDS_DIR}:/data:ro \
   -B ${OUT_DIR}:/out \
@@ -100,4 +190,11 @@ singularity run -e \
   -w /scratch \
   --surface-recon-method ${SURFACE_RECON_METHOD} \
   --cifti-output 91k \
-  --verbose ${ANAT_ONLY_FLAG}
\ No newline at end of file
+  --resource-monitor \
+  ${RESOURCE_FLAGS} \
+  --verbose ${ANAT_ONLY_FLAG} &
+NIBABIES_PID=$!
+wait "$NIBABIES_PID"
+STATUS=$?
+# finish (see the EXIT trap) copies the outputs of a staged run back
+exit $STATUS
@@ -1,6 +1,7 @@
 import argparse
 
 from utils.run import prepare_subject_files
+from utils.transport import TRANSPORTS
 
 
 def main(
@@ -15,6 +16,9 @@ def main(
     dry_run=False,
     spatial_file=None,
     verbose=None,
+    archive=False,
+    profile="auto",
+    transport=None,
     ):
     # get the subject id, session id, and project name
     prepare_subject_files(
@@ -25,6 +29,11 @@ def main(
         bids_only=bids_only,
         ip_address=ip_address,
         username=username,
+        dry_run=dry_run,
+        verbose="INFO" if verbose is None else verbose,
+        archive=archive,
+        profile=profile,
+        transport=transport,
     )
 
 
@@ -89,6 +98,26 @@ def parse_args():
         dest="username",
         help="The username to use when connecting to the Whale computer, for example 'Lab Username'.",
     )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        dest="archive",
+        help="If included, pull the recon-all directory as a single compressed tar archive. Requires zstd.",
+    )
+    parser.add_argument(
+        "--transfer-profile",
+        default="auto",
+        choices=["auto", "default", "lan", "wan"],
+        dest="profile",
+        help="The rsync options to use. 'auto' (default) measures the link to the server and picks 'lan' or 'wan'.",
+    )
+    parser.add_argument(
+        "--transport",
+        default=None,
+        choices=list(TRANSPORTS),
+        dest="transport",
+        help="How to move the files. Default is the MRI_TRANSPORT environment variable, or 'rsync' if it is not set.",
+    )
     args = parser.parse_args()
     return vars(args)
 
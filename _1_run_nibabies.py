@@ -14,11 +14,15 @@ def main(**kwargs):
     use_dev = kwargs.get("use_dev", False)
     nibabies_path = kwargs.get("nibabies_path", None)
     anat_only = kwargs.get("anat_only", False)
+    monitor_interval_s = kwargs.get("monitor_interval_s", None)
+    concurrent = kwargs.get("concurrent", 1)
+    escalate = kwargs.get("escalate", 0)
+    check = kwargs.get("check", False)
 
     session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
     surface_recon_method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
     
-    run_nibabies(
+    return run_nibabies(
         subject=subject,
         session=session_dir,
         project=project,
@@ -27,6 +31,10 @@ def main(**kwargs):
         version=version,
         use_dev=use_dev,
         nibabies_path=nibabies_path,
+        monitor_interval_s=monitor_interval_s,
+        concurrent=concurrent,
+        escalate=escalate,
+        check=check,
         )
 
 def parse_args():
@@ -88,6 +96,20 @@ def parse_args():
         default=None,
         help="path to the local Nibabies repository. Only used if use_dev is used. If no path is provided, the default path is used."
         )
+    parser.add_argument(
+        "--monitor-interval",
+        type=float,
+        dest="monitor_interval_s",
+        default=None,
+        help="seconds between two samples of the container's CPU and memory usage. Default is the MRI_MONITOR_INTERVAL_S environment variable, or 10. 0 turns the sampling off."
+        )
+    parser.add_argument(
+        "--concurrent",
+        type=int,
+        dest="concurrent",
+        default=1,
+        help="number of subjects that run at the same time on this computer. The CPUs and memory given to Nibabies are divided between them. Default is 1."
+        )
     args = parser.parse_args()
     return vars(args)
 
@@ -2,8 +2,17 @@ import argparse
 from pathlib import Path
 from warnings import warn
 
+from utils.compression import recompress_outputs
 from utils.config import SubjectConfig
-from utils.utils import do_rsync
+from utils.metrics import transfer_context
+from utils.tracing import span
+from utils.transfer import (
+    get_previous_snapshot,
+    make_server_dirs,
+    plan_transfers,
+    select_profile,
+)
+from utils.transport import TRANSPORTS, get_transport
 
 
 
@@ -16,6 +25,11 @@ def rsync_to_server(**kwargs):
     surface_recon_method = kwargs["surface_recon_method"]
     ip_address = kwargs.get("ip_address", None)
     username = kwargs.get("username", None)
+    snapshot = kwargs.get("snapshot", None)
+    archive = kwargs.get("archive", False)
+    recompress_level = kwargs.get("recompress_level", None)
+    profile = kwargs.get("profile", "auto")
+    transport = kwargs.get("transport", None)
 
     session_subdir = ("six_month" if session == "sixmonth" and project == "BABIES" else session)  # fmt:skip
     server_is_mounted = ip_address is None
@@ -38,6 +52,9 @@ def rsync_to_server(**kwargs):
     assert nibabies_path.exists()
     assert nibabies_path == (derivatives_path / "Nibabies" / f"sub-{subject}").resolve()
     server_nibabies = config.server_paths["nibabies"]
+    if recompress_level is not None:
+        with span("recompress", level=recompress_level):
+            recompress_outputs(nibabies_path, level=recompress_level)
 
     sourcedata_base = (config.local_paths["nibabies"] / "sourcedata" / f"{surface_recon_method}")
     sourcedata_subject_dir = Path(f"sub-{subject}")
@@ -94,24 +111,77 @@ def rsync_to_server(**kwargs):
     if surface_recon_method == "mcribs":
         paths.append(mcribs_path)
         server_paths.append(server_mcribs)
-    
-    if not server_is_mounted:
-        for ii, path in enumerate(server_paths):
-            server_paths[ii] = Path(f"{username}@{ip_address}:{server_paths[ii]}")
+
+    # These trees hold thousands of small files, so we push each of them as a single
+    # archive instead of file by file with rsync.
+    archive_paths = []
+    if archive:
+        figures_path = nibabies_path / "figures"
+        paths.append(figures_path)
+        server_paths.append(server_nibabies / nibabies_path.name)
+        archive_paths = [freesurfer_path, figures_path]
+        if surface_recon_method == "mcribs":
+            archive_paths.append(mcribs_path)
+
+    # Versioned snapshots: push the Nibabies outputs to a new snapshot directory,
+    # and hard-link anything that did not change since the previous run.
+    snapshot_root = None
+    previous_snapshot = None
+    if snapshot is not None:
+        snapshots_dir = server_nibabies.parent / "Nibabies-snapshots"
+        snapshot_root = snapshots_dir / snapshot
+        if server_is_mounted:
+            previous_snapshot = get_previous_snapshot(snapshots_dir, exclude=snapshot)
+        print(f"Pushing Nibabies outputs to snapshot {snapshot_root}")
 
     assert len(paths) == len(server_paths)
-    for path, server_path in zip(paths, server_paths):
-        if path.exists():
-            print(f"Pushing {path} to {server_path}")
-            do_rsync(
-                path,
-                server_path,
-                flags="-rltv",
-                server_is_mounted=server_is_mounted
-                )
-        else:
+    plan = plan_transfers(
+        [path for path in paths if path.exists()],
+        [server_path for path, server_path in zip(paths, server_paths) if path.exists()],
+        live_root=server_nibabies,
+        snapshot_root=snapshot_root,
+        previous_snapshot=previous_snapshot,
+    )
+    for path in paths:
+        if not path.exists():
             print(f"{path} does not exist. Skipping.")
+    if snapshot_root is not None:
+        make_server_dirs(
+            sorted({transfer["destination"] for transfer in plan}),
+            server_is_mounted=server_is_mounted,
+            ip_address=ip_address,
+            username=username,
+        )
 
+    transport_kwargs = dict(
+        server_is_mounted=server_is_mounted, ip_address=ip_address, username=username
+    )
+    push_transport = get_transport(transport, **transport_kwargs)
+    # These directories are pushed as single archives, see --archive
+    archive_transport = get_transport("archive", **transport_kwargs)
+    with transfer_context(
+        project=project, subject=subject, session=session, stage="push"
+    ):
+        for transfer in plan:
+            print(f"Pushing {transfer['source']} to {transfer['destination']}")
+            with span("transfer", category="transfer", source=transfer["source"]):
+                # Archives can't hard-link to files already on the server, so
+                # transfers that have a --link-dest always go through rsync.
+                if transfer["source"] in archive_paths and not transfer["link_dest"]:
+                    archive_transport.push(transfer["source"], transfer["destination"])
+                    continue
+                exclude = None
+                if archive and transfer["source"] == nibabies_path:
+                    exclude = [f"/{nibabies_path.name}/figures/"]
+                push_transport.push(
+                    transfer["source"],
+                    transfer["destination"],
+                    link_dest=transfer["link_dest"] or None,
+                    exclude=exclude,
+                    profile=select_profile(
+                        profile, source=transfer["source"], **transport_kwargs
+                    ),
+                )
 
 def parse_args():
     # use argparse to get the subject id, session id, and project name
@@ -165,6 +235,49 @@ def parse_args():
         dest="username",
         help="The username to use when connecting to the Whale computer, such as 'Lab Username'.",
     )
+    parser.add_argument(
+        "--snapshot",
+        default=None,
+        dest="snapshot",
+        help="If provided, push the Nibabies outputs to derivatives/Nibabies-snapshots/SNAPSHOT"
+        " instead of derivatives/Nibabies. Files that did not change are hard-linked to the"
+        " previous outputs. Start the label with the date, for example '20240131_nibabies-23.1.0'.",
+    )
+    parser.add_argument(
+        "--archive",
+        action="store_true",
+        dest="archive",
+        help="Push the sourcedata surface directories and the figures directory as single"
+        " zstd compressed tar archives instead of file by file. Requires zstd. Only used"
+        " with --ip-address, a mounted server is pushed to with rsync.",
+    )
+    parser.add_argument(
+        "--recompress-level",
+        type=int,
+        default=None,
+        choices=range(1, 10),
+        dest="recompress_level",
+        help="If provided, recompress the large .nii.gz outputs with this gzip level (1-9)"
+        " before pushing them. The file names and formats do not change. The uncompressed"
+        " CIFTI outputs (.dtseries.nii) are not touched, and recompressed files are not"
+        " hard-linked to a previous --snapshot.",
+    )
+    parser.add_argument(
+        "--transfer-profile",
+        default="auto",
+        choices=["auto", "default", "lan", "wan"],
+        dest="profile",
+        help="The rsync options to use. 'auto' (default) measures the link to the server and"
+        " picks 'lan' or 'wan', and turns off per-file progress for small-file directories.",
+    )
+    parser.add_argument(
+        "--transport",
+        default=None,
+        choices=list(TRANSPORTS),
+        dest="transport",
+        help="How to move the files. Default is the MRI_TRANSPORT environment variable,"
+        " or 'rsync' if it is not set.",
+    )
     args = parser.parse_args()
     return vars(args)
 
@@ -1,6 +1,8 @@
 import argparse
 from pathlib import Path
 
+from utils.nodes import record_node_stats
+from utils.tracing import span
 from utils.utils import delete_directory
 
 def clean_up(subject, session, project, surface_recon_method):
@@ -30,19 +32,28 @@ def clean_up(subject, session, project, surface_recon_method):
     assert precomputed_path.exists()
     reconall_path = derivatives_path / "recon-all" / f"sub-{subject}"
     assert reconall_path.exists()
-    work_path = derivatives_path / "work" / "nibabies_work"
-    work_paths = list(work_path.glob("*/"))
-    assert work_path.exists()
-    assert len(work_paths)
+    # Only the work directory of this subject, other subjects may still be running. A run
+    # staged to a SLURM node (see SLURM/run_nibabies.sh) keeps its work directory on the
+    # node and saves its node stats there, so it has no work directory here.
+    work_path = derivatives_path / "work" / "nibabies_work" / f"sub-{subject}"
+    if work_path.exists() and any(work_path.iterdir()):
+        # Keep the runtime and memory use of the Nipype nodes before the work directory is gone
+        try:
+            record_node_stats(work_path, project=project, subject=subject, session=session)
+        except Exception as error:
+            print(f"Could not collect the Nipype node stats from {work_path}: {error}")
+    else:
+        print(f"{work_path} is missing or empty, the run was probably staged. Skipping its node stats.")
 
     # Delete directories
-    paths = [bids_path, nibabies_path, freesurfer_path, precomputed_path, reconall_path] + work_paths
+    paths = [bids_path, nibabies_path, freesurfer_path, precomputed_path, reconall_path, work_path]
     if surface_recon_method == "mcribs":
         paths += [mcribs_path]
     for path in paths:   
         if path.exists() and path.is_dir():
             print(f"Removing {path}")
-            delete_directory(path)
+            with span("rmtree", path=path):
+                delete_directory(path)
         else:
             print(f"{path} does not exist or is not a directory. Skipping.")
 
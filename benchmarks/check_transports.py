@@ -0,0 +1,222 @@
+"""Check that the transports move the same files as rsync would, on a synthetic server.
+
+Like run_benchmarks.py, nothing leaves this computer: the lab server is a synthetic
+directory tree (see synthetic_cohort.py). For the ``local`` transport (in each of its
+modes), the ``fake`` in-memory server and, if it is installed, ``rsync``, this pulls
+a subject with its filter file and pushes its outputs back, and checks that:
+
+- the pulled files are the ones that :func:`utils.planning.pull_size` expects, and
+  are identical to the files on the server,
+- a pull with ``prepare_subject_files`` lands in ``MRI_LOCAL_ROOT``, whatever the
+  current directory is,
+- a pushed directory is identical on the server, and files that are already in a
+  ``link_dest`` snapshot are hard-linked (local transport),
+- a dry run copies nothing and saves nothing to the ``transfers`` ledger.
+
+Example::
+
+    python benchmarks/check_transports.py
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+from functools import partial
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(REPO_DIR))
+
+from benchmarks.synthetic_cohort import make_cohort, make_local_root  # noqa: E402
+
+
+def _files(root):
+    """Return the paths of the files under root, relative to root."""
+    root = Path(root)
+    return sorted(path.relative_to(root) for path in root.rglob("*") if path.is_file())
+
+
+def _check(condition, message):
+    if not condition:
+        raise AssertionError(message)
+
+
+def check_pull(transport, server_root, local_root, subject, *, project, session):
+    """Pull a subject with its filter file, and compare it to the server."""
+    from utils.planning import pull_size
+    from utils.utils import pull_subject_files
+
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    pull_subject_files(
+        project, subject, session, output_dir=local_root, profile="default", transport=transport
+    )
+    pulled = [
+        path
+        for path in _files(local_root / project / "MRI" / session_dir)
+        if f"sub-{subject}" in path.parts
+    ]
+    n_files, n_bytes = pull_size(project, subject, session)
+    _check(len(pulled) == n_files, f"{transport}: pulled {len(pulled)} files, expected {n_files}")
+    base = Path(project) / "MRI" / session_dir
+    for path in pulled:
+        _check(
+            filecmp.cmp(server_root / base / path, local_root / base / path, shallow=False),
+            f"{transport}: {path} differs from the server",
+        )
+    pulled_bytes = sum((local_root / base / path).stat().st_size for path in pulled)
+    _check(pulled_bytes == n_bytes, f"{transport}: pulled {pulled_bytes} bytes, expected {n_bytes}")
+
+
+def check_push(transport, source, destination, *, link_dest=None):
+    """Push a directory, and compare it to the source."""
+    from utils.transport import get_transport
+
+    get_transport(transport).push(source, destination, link_dest=link_dest)
+    pushed = destination / source.name
+    _check(_files(pushed) == _files(source), f"{transport}: the pushed files differ")
+    for path in _files(source):
+        _check(
+            filecmp.cmp(source / path, pushed / path, shallow=False),
+            f"{transport}: the pushed {path} differs",
+        )
+    if link_dest is not None and transport == "local":
+        linked = [path for path in _files(source) if (pushed / path).stat().st_nlink > 1]
+        _check(linked, f"{transport}: nothing was hard-linked to {link_dest}")
+
+
+def check_dry_run(transport, local_root, subject, *, project, session):
+    """Check that a dry run copies nothing, and records nothing."""
+    from utils import ledger
+    from utils.utils import pull_subject_files
+
+    # The filter file is written to local_root, only the project directory must not change
+    before = _files(local_root / project)
+    n_records = len(ledger.read_records("transfers"))
+    pull_subject_files(
+        project,
+        subject,
+        session,
+        output_dir=local_root,
+        dry_run=True,
+        profile="default",
+        transport=transport,
+    )
+    _check(_files(local_root / project) == before, f"{transport}: a dry run copied files")
+    _check(
+        len(ledger.read_records("transfers")) == n_records,
+        f"{transport}: a dry run was saved to the transfers ledger",
+    )
+
+
+def check_local_root(work_dir, local_root, subject, *, project, session):
+    """Check that prepare_subject_files pulls into MRI_LOCAL_ROOT, not the current directory."""
+    from utils.run import prepare_subject_files
+
+    elsewhere = work_dir / "elsewhere"
+    elsewhere.mkdir()
+    cwd = os.getcwd()
+    os.chdir(elsewhere)
+    try:
+        prepare_subject_files(project, subject, session, profile="default", transport="local")
+    finally:
+        os.chdir(cwd)
+    _check(not _files(elsewhere), "prepare_subject_files pulled into the current directory")
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    _check(
+        (local_root / project / "MRI" / session_dir / "bids" / f"sub-{subject}").is_dir(),
+        "prepare_subject_files did not pull into MRI_LOCAL_ROOT",
+    )
+
+
+def fake_server_files(server_root):
+    """Return the files of a server directory, as the dict of a FakeTransport."""
+    return {
+        str(server_root / path): (server_root / path).read_bytes() for path in _files(server_root)
+    }
+
+
+def check_transports(work_dir, *, project="BABIES", session="newborn", scale=0.001):
+    """Run the checks for every transport, and return the names of those that passed."""
+    from utils import ledger, transport as transport_module
+
+    work_dir = Path(work_dir)
+    server_root = work_dir / "server"
+    subjects = make_cohort(server_root, project=project, session=session, n_subjects=2, scale=scale)
+    os.environ["MRI_SERVER_ROOT"] = str(server_root)
+    # The transfers of each check go to its own ledger
+    ledger.LEDGER_DIR = work_dir / "logs"
+
+    transports = ["local-reflink", "local-hardlink", "local-copy", "fake"]
+    if shutil.which("rsync") is not None:
+        transports.append("rsync")
+    else:
+        print("rsync is not installed, skipping it")
+
+    passed = []
+    for name in transports:
+        transport, _, mode = name.partition("-")
+        local_root = work_dir / name
+        make_local_root(local_root, project=project, session=session)
+        os.environ["MRI_LOCAL_ROOT"] = str(local_root)
+        if transport == "local":
+            # The scripts only pick the transport by name, which uses the default mode
+            transport_module.TRANSPORTS["local"] = partial(transport_module.LocalCopyTransport, mode=mode)
+        if transport == "fake":
+            # Pull from an in-memory copy of the synthetic server
+            transport_module._FAKE_SERVER.clear()
+            transport_module._FAKE_SERVER.update(fake_server_files(server_root))
+        try:
+            check_dry_run(transport, local_root, subjects[0], project=project, session=session)
+            check_pull(transport, server_root, local_root, subjects[0], project=project, session=session)
+
+            source = local_root / "outputs" / f"sub-{subjects[0]}"
+            shutil.copytree(server_root / project / "MRI" / session / "bids" / f"sub-{subjects[0]}", source)
+            destination = work_dir / f"{name}-pushed"
+            destination.mkdir()
+            if transport == "fake":
+                transport_module.get_transport("fake").push(source, destination)
+                pushed = {
+                    Path(path).relative_to(destination / source.name)
+                    for path in transport_module._FAKE_SERVER
+                    if Path(path).is_relative_to(destination)
+                }
+                _check(pushed == set(_files(source)), "fake: the pushed files differ")
+            else:
+                check_push(transport, source, destination)
+                snapshot = work_dir / f"{name}-snapshot"
+                snapshot.mkdir()
+                check_push(transport, source, snapshot, link_dest=destination)
+            if transport == "local":
+                check_local_root(work_dir / name, local_root, subjects[1], project=project, session=session)
+        finally:
+            transport_module.TRANSPORTS["local"] = transport_module.LocalCopyTransport
+        print(f"{name}: ok")
+        passed.append(name)
+    return passed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        dest="work_dir",
+        help="Where to create the synthetic server. Default is a temporary directory.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    kwargs = parse_args()
+    if kwargs["work_dir"] is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            check_transports(work_dir)
+    else:
+        check_transports(kwargs["work_dir"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""A fake Nibabies container, used by the docker and singularity stubs in stubs/.
+
+It parses the bind mounts and the Nibabies arguments of the command line, and
+writes representative outputs to the output and work directories, instead of
+running Nibabies.
+"""
+
+import os
+import random
+import sys
+import time
+from pathlib import Path
+
+from benchmarks.synthetic_cohort import (
+    NIBABIES_FILES,
+    NIBABIES_FUNC_FILES,
+    WORK_FILES,
+    write_file,
+    write_tree,
+)
+
+BIND_FLAGS = {"-v", "--volume", "-B", "--bind"}
+
+
+def parse_command(argv):
+    """Return the bind mounts (container path -> host path) and Nibabies arguments."""
+    binds = dict()
+    args = []
+    ii = 0
+    while ii < len(argv):
+        if argv[ii] in BIND_FLAGS:
+            host, container = argv[ii + 1].split(":")[:2]
+            binds[container] = Path(host)
+            ii += 2
+            continue
+        args.append(argv[ii])
+        ii += 1
+    return binds, args
+
+
+def write_node_reports(work_dir, subject):
+    """Write the runtime info that Nipype's resource monitor adds to the node reports."""
+    rng = random.Random(subject)
+    for report in Path(work_dir).glob("nibabies_wf/*/node_*/_report/report.rst"):
+        node = report.parent.parent
+        # A few slow, memory hungry nodes and many quick ones, as in a real run
+        slow = int(node.name.split("_")[-1]) % 100 == 0
+        report.write_text(
+            f"Node: {node.name}\n"
+            f"Hierarchy : nibabies_wf.{node.parent.name}.{node.name}\n"
+            f"Exec ID : {node.name}\n\n"
+            "Runtime info\n------------\n\n"
+            f"* duration : {rng.uniform(600, 3600) if slow else rng.uniform(0.1, 20):.3f}\n"
+            f"* hostname : benchmark\n"
+            f"* mem_peak_gb : {rng.uniform(2, 8) if slow else rng.uniform(0.1, 0.5):.3f}\n"
+            f"* cpu_percent : {rng.uniform(100, 400) if slow else rng.uniform(10, 100):.1f}\n"
+        )
+
+
+def run_nibabies(argv):
+    """Pretend to run Nibabies with the arguments of a docker/singularity command.
+
+    Subjects listed in ``BENCHMARK_FAIL_SUBJECTS`` (comma separated) fail.
+    """
+    binds, args = parse_command(argv)
+    subject = args[args.index("--participant-label") + 1]
+    bids_dir = binds["/data"]
+    session = sorted((bids_dir / f"sub-{subject}").glob("ses-*"))[0].name
+    n_runs = len(list((bids_dir / f"sub-{subject}" / session / "func").glob("*_bold.nii.gz")))
+    scale = float(os.environ.get("BENCHMARK_SCALE", 0.01))
+    labels = dict(sub=f"sub-{subject}", ses=session, sub_id=subject)
+
+    time.sleep(float(os.environ.get("BENCHMARK_CONTAINER_SECONDS", 0)))
+    if subject in os.environ.get("BENCHMARK_FAIL_SUBJECTS", "").split(","):
+        print(f"fake Nibabies failed sub-{subject}")
+        return 1
+    out_dir = binds["/out"]
+    write_tree(out_dir, NIBABIES_FILES, scale, **labels)
+    if "--anat-only" not in args:
+        for run in range(1, n_runs + 1):
+            write_tree(out_dir, NIBABIES_FUNC_FILES, scale, run=f"{run:02d}", **labels)
+    write_file(out_dir / f"sub-{subject}_{session}.html", int(200_000 * scale))
+    write_tree(binds["/scratch"], WORK_FILES, scale, **labels)
+    if "--resource-monitor" in args:
+        write_node_reports(binds["/scratch"], subject)
+    print(f"fake Nibabies finished sub-{subject} {session}")
+    return 0
+
+
+def docker_stats():
+    """Print one plausible ``docker stats --no-stream --format "{{json .}}"`` line."""
+    print(
+        '{"CPUPerc": "385.20%", "MemUsage": "6.1GiB / 15.5GiB", "BlockIO": "1.2GB / 3.4GB",'
+        ' "NetIO": "0B / 0B", "PIDs": "42"}'
+    )
+    return 0
+
+
+def run_bibsnet(argv):
+    """Pretend to run BIBSnet on the subject of ``-participant``.
+
+    Subjects listed in ``BENCHMARK_FAIL_SUBJECTS`` (comma separated) fail.
+    """
+    binds, args = parse_command(argv)
+    subject = args[args.index("-participant") + 1]
+    time.sleep(float(os.environ.get("BENCHMARK_CONTAINER_SECONDS", 0)))
+    print(f"fake BIBSnet loading the model for sub-{subject}")
+    if subject in os.environ.get("BENCHMARK_FAIL_SUBJECTS", "").split(","):
+        print(f"fake BIBSnet failed sub-{subject}")
+        return 1
+    for session_dir in sorted((binds["/input"] / f"sub-{subject}").glob("ses-*")):
+        anat_dir = binds["/output"] / "bibsnet" / f"sub-{subject}" / session_dir.name / "anat"
+        write_file(anat_dir / f"sub-{subject}_{session_dir.name}_space-T2w_desc-aseg_dseg.nii.gz", 1000)
+    print(f"fake BIBSnet finished sub-{subject}")
+    return 0
+
+
+def build_image(target, source):
+    """Write a small stand-in for ``singularity build <target> <source>``."""
+    Path(target).write_bytes(f"fake image of {source}\n".encode() * 1024)
+    return 0
+
+
+def docker_info():
+    """Print the CPUs and memory of ``docker info --format '{{.NCPU}} {{.MemTotal}}'``.
+
+    The fake containers run on this computer, so it is its capacity.
+    """
+    print(os.cpu_count(), os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES"))
+    return 0
+
+
+def main(argv):
+    if "--participant-label" in argv:
+        return run_nibabies(argv)
+    if "-participant" in argv:
+        return run_bibsnet(argv)
+    if argv[:1] == ["stats"]:
+        return docker_stats()
+    if argv[:1] == ["build"] and len(argv) >= 3:
+        return build_image(*argv[1:3])
+    if argv[:1] == ["info"]:
+        return docker_info()
+    # docker ps, singularity build, ... succeed without output
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,277 @@
+"""Time the orchestration of the pipeline on a synthetic cohort.
+
+Nothing leaves this computer: the lab server is a synthetic directory tree (see
+synthetic_cohort.py), files are moved with the selected transport (``local`` by
+default), and ``docker``/``singularity`` are replaced by the stubs in ``stubs/``,
+which write representative Nibabies outputs instead of running Nibabies.
+
+Example::
+
+    python benchmarks/run_benchmarks.py --n-subjects 500 --process-subjects 5
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+STUBS_DIR = Path(__file__).resolve().parent / "stubs"
+sys.path.insert(0, str(REPO_DIR))
+
+from benchmarks.synthetic_cohort import make_cohort, make_local_root  # noqa: E402
+
+
+class Timer:
+    """Collect the elapsed time of named stages."""
+
+    def __init__(self):
+        self.timings = dict()
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.timings.setdefault(stage, []).append(time.perf_counter() - start)
+        return result
+
+    def summary(self):
+        return {
+            stage: {
+                "n": len(values),
+                "total_s": round(sum(values), 4),
+                "mean_s": round(sum(values) / len(values), 4),
+                "max_s": round(max(values), 4),
+            }
+            for stage, values in self.timings.items()
+        }
+
+
+def _setup_environment(work_dir, transport, scale):
+    server_root = work_dir / "server"
+    local_root = work_dir / "local"
+    os.environ["MRI_SERVER_ROOT"] = str(server_root)
+    os.environ["MRI_LOCAL_ROOT"] = str(local_root)
+    os.environ["MRI_TRANSPORT"] = transport
+    os.environ["BENCHMARK_SCALE"] = str(scale)
+    os.environ["PATH"] = f"{STUBS_DIR}{os.pathsep}{os.environ['PATH']}"
+    return server_root, local_root
+
+
+def run_benchmarks(
+    work_dir,
+    *,
+    project="BABIES",
+    session="newborn",
+    n_subjects=100,
+    process_subjects=3,
+    n_func_runs=2,
+    scale=0.01,
+    transport="local",
+    anat_only=False,
+):
+    """Generate a synthetic cohort and time each stage of the pipeline.
+
+    Returns a dict with the settings, the time to generate the cohort and a summary
+    of each stage: ``subject_config`` and ``filter_file`` are timed for every subject
+    in the cohort, and ``pull``, ``precomputed``, ``container``, ``push`` and
+    ``cleanup`` for the first ``process_subjects`` subjects.
+    """
+    work_dir = Path(work_dir)
+    server_root, local_root = _setup_environment(work_dir, transport, scale)
+
+    import utils.ledger
+    from utils.config import SubjectConfig
+    from utils.utils import (
+        create_filter_file,
+        create_precomputed_files,
+        create_precomputed_jsons,
+        pull_subject_files,
+        rename_t1w_files,
+    )
+
+    pull_nibabies = importlib.import_module("_1_run_nibabies")
+    push_derivatives = importlib.import_module("_2_push_derivatives")
+    delete_local = importlib.import_module("_3_delete_local_directories")
+
+    start = time.perf_counter()
+    subjects = make_cohort(
+        server_root,
+        project=project,
+        session=session,
+        n_subjects=n_subjects,
+        n_func_runs=n_func_runs,
+        scale=scale,
+    )
+    make_local_root(local_root, project=project, session=session)
+    cohort_s = time.perf_counter() - start
+    utils.ledger.LEDGER_DIR = local_root / "logs"
+    os.chdir(local_root)
+
+    timer = Timer()
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    filter_dir = Path(tempfile.mkdtemp(dir=work_dir))
+    for subject in subjects:
+        timer.time(
+            "subject_config",
+            SubjectConfig,
+            project,
+            subject,
+            session,
+            get_spatial_file=False,
+            anat_only=anat_only,
+        )
+        timer.time(
+            "filter_file",
+            create_filter_file,
+            filter_dir,
+            subject_id=subject,
+            session_dir=session_dir,
+            anat_only=anat_only,
+        )
+
+    for subject in subjects[:process_subjects]:
+        config = SubjectConfig(
+            project, subject, session, get_spatial_file=False, anat_only=anat_only
+        )
+        timer.time(
+            "pull",
+            pull_subject_files,
+            project,
+            subject,
+            session,
+            output_dir=local_root,
+            anat_only=anat_only,
+        )
+
+        def stage_precomputed():
+            config.get_spatial_file()
+            rename_t1w_files(config["local_paths"]["sub_anatpath"])
+            create_precomputed_files(
+                reconall_dir=config["local_paths"]["reconall"],
+                output_dir=config["local_paths"]["precomputed"],
+                subject=subject,
+                session=config["session"],
+                space=config["space"],
+                overwrite=True,
+            )
+            create_precomputed_jsons(
+                precomputed_dir=config["local_paths"]["precomputed"],
+                spatial_reference_fname=config["spatial_file"],
+                subject=subject,
+                session=config["session"],
+                space=config["space"],
+            )
+
+        timer.time("precomputed", stage_precomputed)
+        timer.time(
+            "container",
+            pull_nibabies.main,
+            project=project,
+            subject=subject,
+            session=session,
+            surface_recon_method="freesurfer",
+            version="latest",
+            anat_only=anat_only,
+        )
+        timer.time(
+            "push",
+            push_derivatives.rsync_to_server,
+            project=project,
+            subject=subject,
+            session=session,
+            surface_recon_method="freesurfer",
+            anat_only=anat_only,
+        )
+        timer.time(
+            "cleanup",
+            delete_local.clean_up,
+            subject=subject,
+            session=session,
+            project=project,
+            surface_recon_method="freesurfer",
+        )
+
+    return {
+        "settings": dict(
+            project=project,
+            session=session,
+            n_subjects=n_subjects,
+            process_subjects=min(process_subjects, n_subjects),
+            n_func_runs=n_func_runs,
+            scale=scale,
+            transport=transport,
+            anat_only=anat_only,
+        ),
+        "cohort_s": round(cohort_s, 4),
+        "stages": timer.summary(),
+    }
+
+
+def print_results(results):
+    print("\nBenchmark settings:", json.dumps(results["settings"]))
+    print(f"Cohort generated in {results['cohort_s']:.2f} s\n")
+    print(f"{'stage':<16} {'n':>6} {'total s':>10} {'mean s':>10} {'max s':>10}")
+    for stage, values in results["stages"].items():
+        print(
+            f"{stage:<16} {values['n']:>6} {values['total_s']:>10.3f}"
+            f" {values['mean_s']:>10.4f} {values['max_s']:>10.4f}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline orchestration.")
+    parser.add_argument("--project", default="BABIES", choices=["BABIES", "ABC"])
+    parser.add_argument("--session", default="newborn", choices=["newborn", "sixmonth"])
+    parser.add_argument("--n-subjects", type=int, default=100, dest="n_subjects")
+    parser.add_argument(
+        "--process-subjects",
+        type=int,
+        default=3,
+        dest="process_subjects",
+        help="How many subjects to run end to end. Default is 3.",
+    )
+    parser.add_argument("--n-func-runs", type=int, default=2, dest="n_func_runs")
+    parser.add_argument("--scale", type=float, default=0.01)
+    parser.add_argument(
+        "--transport",
+        default="local",
+        choices=["local", "rsync", "archive", "fake"],
+        help="How to move files to and from the synthetic server. Default is 'local'.",
+    )
+    parser.add_argument("--anat-only", action="store_true", dest="anat_only")
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        dest="work_dir",
+        help="Where to create the synthetic server and local directories. Default is a"
+        " temporary directory, which is deleted afterwards.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Save the results to this JSON file.",
+    )
+    return vars(parser.parse_args())
+
+
+def run_main():
+    kwargs = parse_args()
+    output = kwargs.pop("output")
+    work_dir = kwargs.pop("work_dir")
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(work_dir, **kwargs)
+    else:
+        results = run_benchmarks(work_dir, **kwargs)
+    print_results(results)
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    run_main()
@@ -0,0 +1,163 @@
+"""Generate a synthetic {project}/MRI/{session} tree to benchmark the pipeline.
+
+The file counts follow a real subject, and the file sizes are the real sizes
+multiplied by ``scale``, so that a cohort of hundreds of subjects fits on a laptop.
+"""
+
+import argparse
+import json
+import os
+import random
+from pathlib import Path
+
+# (relative path template, number of files, size of each file in bytes).
+# "{i}" is replaced by the file number, "{sub}" by "sub-XXXX", "{ses}" by the session.
+BIDS_FILES = [
+    ("anat/{sub}_{ses}_T1w.nii.gz", 1, 12_000_000),
+    ("anat/{sub}_{ses}_T1w.json", 1, 2_000),
+    ("anat/{sub}_{ses}_T2w.nii.gz", 1, 12_000_000),
+    ("anat/{sub}_{ses}_T2w.json", 1, 2_000),
+    ("anat/{sub}_{ses}_T1_raw.nii.gz", 1, 12_000_000),
+    ("fmap/{sub}_{ses}_dir-{i}_epi.nii.gz", 2, 2_000_000),
+    ("fmap/{sub}_{ses}_dir-{i}_epi.json", 2, 2_000),
+    ("dwi/{sub}_{ses}_dwi.nii.gz", 1, 80_000_000),
+    ("dwi/{sub}_{ses}_dwi.bval", 1, 1_000),
+    ("dwi/{sub}_{ses}_dwi.bvec", 1, 3_000),
+]
+FUNC_FILES = [
+    ("func/{sub}_{ses}_task-rest_run-{run}_bold.nii.gz", 1, 150_000_000),
+    ("func/{sub}_{ses}_task-rest_run-{run}_bold.json", 1, 3_000),
+]
+RECONALL_FILES = [
+    ("aseg.nii.gz", 1, 1_000_000),
+    ("brain_mask.nii.gz", 1, 300_000),
+    ("mri/volume_{i}.mgz", 20, 5_000_000),
+    ("surf/surface_{i}", 60, 3_000_000),
+    ("label/label_{i}.label", 150, 30_000),
+    ("stats/stats_{i}.stats", 20, 10_000),
+    ("scripts/log_{i}.log", 10, 20_000),
+    ("touch/step_{i}.touch", 40, 0),
+]
+# What the fake Nibabies container writes, see stubs/docker
+NIBABIES_FILES = [
+    ("{sub}/{ses}/anat/{sub}_{ses}_desc-output_{i}.nii.gz", 10, 10_000_000),
+    ("{sub}/{ses}/anat/{sub}_{ses}_hemi-{i}.surf.gii", 8, 4_000_000),
+    ("{sub}/figures/{sub}_{ses}_figure_{i}.svg", 200, 50_000),
+    ("{sub}/log/{sub}_citation_{i}.md", 3, 5_000),
+    ("sourcedata/freesurfer/{sub}_{ses}/surf/surface_{i}", 60, 3_000_000),
+    ("sourcedata/freesurfer/{sub}_{ses}/label/label_{i}.label", 150, 30_000),
+    ("sourcedata/freesurfer/{sub}_{ses}/stats/stats_{i}.stats", 20, 10_000),
+]
+NIBABIES_FUNC_FILES = [
+    ("{sub}/{ses}/func/{sub}_{ses}_task-rest_run-{run}_space-{i}_bold.nii.gz", 3, 100_000_000),
+    ("{sub}/{ses}/func/{sub}_{ses}_task-rest_run-{run}_space-fsLR_den-91k_bold.dtseries.nii", 1, 120_000_000),
+]
+WORK_FILES = [
+    ("nibabies_wf/single_subject_{sub_id}_wf/node_{i}/result.pklz", 2000, 4_000),
+    ("nibabies_wf/single_subject_{sub_id}_wf/node_{i}/_report/report.rst", 2000, 1_000),
+]
+
+_BLOCK = random.Random(0).randbytes(2**16)
+
+
+def write_file(fpath, size):
+    """Write size bytes of (partly compressible) data to fpath."""
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with fpath.open("wb") as file:
+        while size > 0:
+            chunk = _BLOCK[: min(size, len(_BLOCK))]
+            file.write(chunk)
+            size -= len(chunk)
+
+
+def write_tree(root, file_specs, scale=0.01, **labels):
+    """Write the files described by file_specs under root. Returns the number of bytes."""
+    root = Path(root)
+    total = 0
+    for template, count, size in file_specs:
+        size = int(size * scale)
+        for i in range(count):
+            write_file(root / template.format(i=i, **labels), size)
+            total += size
+    return total
+
+
+def make_cohort(
+    server_root,
+    project="BABIES",
+    session="newborn",
+    n_subjects=100,
+    n_func_runs=2,
+    scale=0.01,
+    first_subject=1000,
+):
+    """Create a synthetic lab server with n_subjects subjects.
+
+    Parameters
+    ----------
+    server_root : path-like
+        The stand-in for ``/Volumes/HumphreysLab/Daily_2``.
+    n_func_runs : int
+        The number of BOLD runs per subject. Default is 2.
+    scale : float
+        The file sizes are multiplied by this. The file counts are not. Default is
+        0.01, i.e. roughly 5 MB per subject.
+
+    Returns
+    -------
+    subjects : list of str
+        The subject labels, without the ``sub-`` prefix.
+    """
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    base = Path(server_root) / project / "MRI" / session_dir
+    for directory in ["Nibabies", "precomputed", "recon-all"]:
+        (base / "derivatives" / directory).mkdir(parents=True, exist_ok=True)
+    (base / "bids").mkdir(parents=True, exist_ok=True)
+    with (base / "bids" / "dataset_description.json").open("w") as file:
+        json.dump({"Name": project, "BIDSVersion": "1.2.1"}, file)
+
+    subjects = [str(first_subject + ii) for ii in range(n_subjects)]
+    for subject in subjects:
+        labels = dict(sub=f"sub-{subject}", ses=f"ses-{session}")
+        subject_bids = base / "bids" / f"sub-{subject}" / f"ses-{session}"
+        write_tree(subject_bids, BIDS_FILES, scale, **labels)
+        for run in range(1, n_func_runs + 1):
+            write_tree(subject_bids, FUNC_FILES, scale, run=f"{run:02d}", **labels)
+        write_tree(
+            base / "derivatives" / "recon-all" / f"sub-{subject}",
+            RECONALL_FILES,
+            scale,
+            **labels,
+        )
+    return subjects
+
+
+def make_local_root(local_root, project="BABIES", session="newborn"):
+    """Create the empty local directories that the scripts expect to exist."""
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    base = Path(local_root) / project / "MRI" / session_dir
+    for directory in ["bids", "derivatives/Nibabies", "derivatives/precomputed",
+                      "derivatives/recon-all", "derivatives/work/nibabies_work"]:
+        (base / directory).mkdir(parents=True, exist_ok=True)
+    (Path(local_root) / "logs").mkdir(exist_ok=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate a synthetic MRI cohort.")
+    parser.add_argument("server_root", help="Where to create the synthetic server.")
+    parser.add_argument("--project", default="BABIES", choices=["BABIES", "ABC"])
+    parser.add_argument("--session", default="newborn", choices=["newborn", "sixmonth"])
+    parser.add_argument("--n-subjects", type=int, default=100, dest="n_subjects")
+    parser.add_argument("--n-func-runs", type=int, default=2, dest="n_func_runs")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=float(os.environ.get("BENCHMARK_SCALE", 0.01)),
+        help="File sizes are multiplied by this. Default is 0.01.",
+    )
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    subjects = make_cohort(**parse_args())
+    print(f"Created {len(subjects)} subjects")
@@ -0,0 +1,252 @@
+"""Queue subjects with a long-running orchestrator, shared by the users of this computer.
+
+Start it once (for example in a tmux session on Whale), then submit from any shell:
+
+    python orchestrator.py serve --slots 2
+    python orchestrator.py submit -p BABIES -S newborn -s 1103 1027
+    python orchestrator.py status
+    python orchestrator.py cancel 12
+    python orchestrator.py watch -p BABIES -S newborn --limit 4
+
+See utils/daemon.py.
+"""
+
+import argparse
+import getpass
+import shlex
+import sys
+import time
+
+from utils.daemon import ACTIVE_STATES, Orchestrator, request, serve
+from utils.scheduling import PRIORITIES
+from utils.watch import Watcher
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Queue subjects with a long-running orchestrator."
+    )
+    parser.add_argument(
+        "--address",
+        default=None,
+        help="host:port of the orchestrator. Default is the MRI_DAEMON_ADDRESS environment variable, or 127.0.0.1:8765.",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = commands.add_parser("serve", help="start the orchestrator.")
+    serve_parser.add_argument(
+        "--slots",
+        type=int,
+        default=1,
+        help="number of subjects that run at the same time. Default is 1.",
+    )
+    serve_parser.add_argument(
+        "--nibabies-version",
+        default="latest",
+        dest="version",
+        help="version of Nibabies to use. Default is 'latest'.",
+    )
+    serve_parser.add_argument("--ip-address", dest="ip_address", default=None)
+    serve_parser.add_argument("--username", dest="username", default=None)
+    serve_parser.add_argument(
+        "--args",
+        default="",
+        dest="extra_args",
+        help="extra arguments for 00_process_subjects.py, for example '--archive'.",
+    )
+    serve_parser.add_argument(
+        "--poll",
+        type=float,
+        default=5.0,
+        dest="poll_s",
+        help="seconds between two checks of the running subjects. Default is 5.",
+    )
+
+    submit_parser = commands.add_parser("submit", help="queue subjects.")
+    submit_parser.add_argument(
+        "-p", "--project", choices=["BABIES", "ABC"], required=True
+    )
+    submit_parser.add_argument(
+        "-s", "--subjects", nargs="+", required=True, help="Space separated subject labels."
+    )
+    submit_parser.add_argument(
+        "-S", "--session", choices=["newborn", "sixmonth"], required=True
+    )
+    submit_parser.add_argument(
+        "-m",
+        "--surface-recon-method",
+        choices=["mcribs", "freesurfer"],
+        default="freesurfer",
+        dest="surface_recon_method",
+    )
+    submit_parser.add_argument("--anat_only", action="store_true", dest="anat_only")
+    submit_parser.add_argument(
+        "--priority",
+        choices=PRIORITIES,
+        default="normal",
+        help="urgent subjects run before normal ones, and normal before low. Default is 'normal'.",
+    )
+    submit_parser.add_argument(
+        "--deadline",
+        default=None,
+        help="time by which the subjects should be done, such as '2024-05-01T17:00'. They move up the queue as it comes closer.",
+    )
+
+    status_parser = commands.add_parser("status", help="list the jobs.")
+    status_parser.add_argument(
+        "--all",
+        action="store_true",
+        dest="show_all",
+        help="also list the finished jobs. Default is only the queued and running ones.",
+    )
+    status_parser.add_argument("--user", default=None, help="only list the jobs of this user.")
+
+    cancel_parser = commands.add_parser("cancel", help="cancel queued or running jobs.")
+    cancel_parser.add_argument("job_ids", nargs="+", help="the job ids, see status.")
+
+    watch_parser = commands.add_parser(
+        "watch", help="queue the subjects of a session as they become ready on the server."
+    )
+    watch_parser.add_argument(
+        "-p", "--project", choices=["BABIES", "ABC"], required=True
+    )
+    watch_parser.add_argument(
+        "-S", "--session", choices=["newborn", "sixmonth"], required=True
+    )
+    watch_parser.add_argument(
+        "-m",
+        "--surface-recon-method",
+        choices=["mcribs", "freesurfer"],
+        default="freesurfer",
+        dest="surface_recon_method",
+    )
+    watch_parser.add_argument("--anat_only", action="store_true", dest="anat_only")
+    watch_parser.add_argument(
+        "--limit",
+        type=int,
+        default=4,
+        help="maximum number of subjects of the orchestrator queued or running at the same time. Default is 4.",
+    )
+    watch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=300.0,
+        dest="interval_s",
+        help="seconds between two looks at the server. Default is 300.",
+    )
+    watch_parser.add_argument(
+        "--settle",
+        type=float,
+        default=600.0,
+        dest="settle_s",
+        help="seconds the inputs of a subject must be unchanged before it is queued. Default is 600.",
+    )
+    watch_parser.add_argument(
+        "--once", action="store_true", help="look once and exit, for example from cron."
+    )
+    return vars(parser.parse_args())
+
+
+def print_jobs(status):
+    """Print the jobs returned by the status API."""
+    print(f"{status['running']} of {status['slots']} slots running")
+    print(f"{'id':>5}  {'user':<12} {'subject':<22} {'state':<11} {'priority':<8} {'predicted h':>11}  since")
+    for job in status["jobs"]:
+        subject = f"{job['project']} {job['subject']} {job['session']}"
+        since = job.get("finished") or job.get("started") or job["submitted"]
+        priority = job.get("priority", "normal")
+        print(
+            f"{job['id']:>5}  {str(job['user']):<12} {subject:<22} {job['state']:<11} {priority:<8} "
+            f"{job['predicted_s'] / 3600:>11.1f}  {since}"
+        )
+
+
+def watch(
+    project,
+    session,
+    *,
+    surface_recon_method="freesurfer",
+    anat_only=False,
+    limit=4,
+    interval_s=300.0,
+    settle_s=600.0,
+    once=False,
+    address=None,
+):
+    """Queue the ready subjects of a session, keeping at most ``limit`` queued or running.
+
+    A subject that the orchestrator already ran, even if it failed, is not queued
+    again. Queue it with ``submit`` to run it again.
+    """
+    watcher = Watcher(project, session, settle_s=settle_s)
+    while True:
+        jobs = request("GET", "/jobs", address=address)["jobs"]
+        jobs = [job for job in jobs if (job["project"], job["session"]) == (project, session)]
+        known = {job["subject"] for job in jobs}
+        active = sum(job["state"] in ACTIVE_STATES for job in jobs)
+        new = [subject for subject in watcher.poll() if subject not in known]
+        if new and active < limit:
+            reply = request(
+                "POST",
+                "/jobs",
+                dict(
+                    project=project,
+                    subjects=new[: limit - active],
+                    session=session,
+                    surface_recon_method=surface_recon_method,
+                    anat_only=anat_only,
+                    user=getpass.getuser(),
+                ),
+                address=address,
+            )
+            for job in reply["jobs"]:
+                print(f"Queued sub-{job['subject']} ses-{job['session']} as job {job['id']}")
+            for subject, reason in reply["skipped"].items():
+                print(f"Skipped sub-{subject}: {reason}")
+        if once:
+            break
+        time.sleep(interval_s)
+
+
+def main(command, address=None, **kwargs):
+    if command == "serve":
+        orchestrator = Orchestrator(
+            slots=kwargs["slots"],
+            version=kwargs["version"],
+            ip_address=kwargs["ip_address"],
+            username=kwargs["username"],
+            extra_args=shlex.split(kwargs["extra_args"]),
+            poll_s=kwargs["poll_s"],
+        )
+        serve(orchestrator, address=address)
+    elif command == "submit":
+        reply = request("POST", "/jobs", dict(kwargs, user=getpass.getuser()), address=address)
+        for job in reply["jobs"]:
+            print(f"Queued sub-{job['subject']} ses-{job['session']} as job {job['id']}")
+        for subject, reason in reply["skipped"].items():
+            print(f"Skipped sub-{subject}: {reason}")
+    elif command == "status":
+        status = request("GET", "/jobs", address=address)
+        if not kwargs["show_all"]:
+            status["jobs"] = [job for job in status["jobs"] if job["state"] in ACTIVE_STATES]
+        if kwargs["user"]:
+            status["jobs"] = [job for job in status["jobs"] if job["user"] == kwargs["user"]]
+        print_jobs(status)
+    elif command == "cancel":
+        for job_id in kwargs["job_ids"]:
+            request("POST", f"/jobs/{job_id}/cancel", dict(user=getpass.getuser()), address=address)
+            print(f"Cancelled job {job_id}")
+    elif command == "watch":
+        watch(**kwargs, address=address)
+
+
+def run_main():
+    try:
+        main(**parse_args())
+    except RuntimeError as error:
+        sys.exit(str(error))
+
+
+if __name__ == "__main__":
+    run_main()
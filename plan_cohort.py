@@ -0,0 +1,88 @@
+"""Estimate what processing a cohort will cost, without pulling or running anything.
+
+    python plan_cohort.py -p BABIES -S newborn -s 1103 1027 1462 --concurrent 2
+
+See utils/planning.py.
+"""
+
+import argparse
+import json
+from datetime import datetime
+
+from utils.planning import plan_cohort, print_plan
+
+
+def parse_args():
+    """Parse the command line arguments."""
+    parser = argparse.ArgumentParser(
+        description="Estimate the transfers, disk, container hours, SLURM jobs and finish time of a cohort."
+    )
+    parser.add_argument(
+        "-p", "--project", choices=["BABIES", "ABC"], required=True, dest="project"
+    )
+    subjects = parser.add_mutually_exclusive_group(required=True)
+    subjects.add_argument(
+        "-s", "--subjects", nargs="+", dest="subjects", help="Space separated subject labels."
+    )
+    subjects.add_argument(
+        "--subjects-file",
+        dest="subjects_file",
+        help="a file with one subject label per line.",
+    )
+    parser.add_argument(
+        "-S", "--session", choices=["newborn", "sixmonth"], required=True, dest="session"
+    )
+    parser.add_argument(
+        "-m",
+        "--surface-recon-method",
+        choices=["mcribs", "freesurfer"],
+        default="freesurfer",
+        dest="surface_recon_method",
+    )
+    parser.add_argument("--anat_only", action="store_true", dest="anat_only")
+    parser.add_argument(
+        "--concurrent",
+        type=int,
+        default=1,
+        help="number of subjects that run at the same time. Default is 1.",
+    )
+    parser.add_argument(
+        "--bibsnet",
+        action="store_true",
+        help="count the BIBSnet jobs of a SLURM submission.",
+    )
+    parser.add_argument(
+        "--pack-bibsnet",
+        type=float,
+        default=None,
+        metavar="HOURS",
+        dest="pack_bibsnet_hours",
+        help="count BIBSnet as packed jobs of at most HOURS, see utils/slurm.py.",
+    )
+    parser.add_argument(
+        "--start",
+        type=datetime.fromisoformat,
+        default=None,
+        help="when the cohort would start, such as '2024-05-01T09:00'. Default is now.",
+    )
+    parser.add_argument(
+        "--json", action="store_true", dest="as_json", help="print the plan as JSON."
+    )
+    return vars(parser.parse_args())
+
+
+def main(subjects=None, subjects_file=None, as_json=False, **kwargs):
+    if subjects_file is not None:
+        with open(subjects_file) as file:
+            subjects = [line.strip() for line in file if line.strip()]
+    if kwargs.get("pack_bibsnet_hours"):
+        kwargs["bibsnet"] = True
+    plan = plan_cohort(subjects=subjects, **kwargs)
+    if as_json:
+        print(json.dumps(plan, indent=2, default=str))
+    else:
+        print_plan(plan)
+
+
+if __name__ == "__main__":
+    main(**parse_args())
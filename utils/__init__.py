@@ -1 +1 @@
-from . import config, docker, run, utils
+from . import bandwidth, compression, config, docker, ledger, metrics, run, tracing, transfer, transport, utils
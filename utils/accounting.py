@@ -0,0 +1,398 @@
+"""Collect the SLURM accounting of finished jobs into the ``runs`` ledger.
+
+``sacct`` knows the wall time, CPU time, peak memory and final state of every job,
+but the jobs of the SLURM scripts only leave a log file behind. The harvester maps
+each job back to its project, subject and session (with the ``submissions`` ledger
+of :mod:`utils.slurm`, or the header of the job's log), and saves one record per
+job to the ``runs`` ledger, with ``source="sacct"``, so that the resource requests
+can be tuned from past jobs (see :mod:`utils.predict`)::
+
+    python -m utils.accounting --since 2024-05-01 --report
+
+The output of ``sacct`` can be recorded and harvested later, for example::
+
+    sacct --parsable2 --format=JobID,JobName,State,ExitCode,Elapsed,TotalCPU,AllocCPUS,ReqMem,MaxRSS,Start,End > sacct.txt
+    python -m utils.accounting --sacct-output sacct.txt
+"""
+
+import argparse
+import os
+import re
+import subprocess
+from pathlib import Path
+
+from .ledger import append_record, read_records
+
+SACCT_FIELDS = [
+    "JobID",
+    "JobName",
+    "State",
+    "ExitCode",
+    "Elapsed",
+    "TotalCPU",
+    "AllocCPUS",
+    "ReqMem",
+    "MaxRSS",
+    "Start",
+    "End",
+]
+# Jobs in these states are not finished, so they are harvested later
+UNFINISHED_STATES = {"PENDING", "RUNNING", "REQUEUED", "RESIZING", "SUSPENDED"}
+LOG_DIR = Path(__file__).parent.parent / "SLURM" / "log"
+
+# The first line that each SLURM script prints, see the scripts
+LOG_HEADERS = [
+    ("bibsnet", re.compile(r"^Running BibsNet for (?P<project>\S+) (?P<subject>\S+) (?P<session>\S+)")),
+    (
+        "nibabies",
+        re.compile(
+            r"^Running [^:]*: (?P<project>\S+) sub-(?P<subject>[^_\s]+)_ses-(?P<session>\S+)"
+            r" using (?P<surface_recon_method>\S+)(?P<anat_only> --anat-only)?"
+        ),
+    ),
+    ("prepare", re.compile(r"^Preparing (?P<project>\S+) sub-(?P<subject>[^_\s]+)_ses-(?P<session>\S+)")),
+    ("push", re.compile(r"^Pushing (?P<project>\S+) sub-(?P<subject>[^_\s]+)_ses-(?P<session>\S+)")),
+]
+# A packed BIBSnet job runs several subjects, see utils.slurm.pack_bibsnet_jobs
+PACKED_LOG_HEADER = re.compile(r"^Running BibsNet in batch mode for (?P<project>\S+) (?P<session>\S+):")
+
+_MEM_UNITS = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+def get_sacct():
+    """Return the sacct command, from the ``MRI_SACCT`` environment variable."""
+    return os.environ.get("MRI_SACCT", "sacct")
+
+
+def parse_duration(text):
+    """Parse a sacct duration (``[D-][HH:]MM:SS[.mmm]``) to seconds."""
+    if not text or text in {"UNLIMITED", "INVALID", "Partition_Limit"}:
+        return None
+    days, _, clock = text.rpartition("-")
+    parts = [float(part) for part in clock.split(":")]
+    while len(parts) < 3:
+        parts.insert(0, 0.0)
+    hours, minutes, seconds = parts
+    return (int(days) if days else 0) * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def parse_memory(text, alloc_cpus=1):
+    """Parse a sacct memory size (``MaxRSS`` or ``ReqMem``) to bytes.
+
+    ReqMem may end with ``n`` (per node) or ``c`` (per CPU, which is multiplied by
+    ``alloc_cpus``). Sizes without a unit are in bytes for MaxRSS, and sacct prints
+    them in K anyway.
+    """
+    match = re.fullmatch(r"([\d.]+)([KMGT]?)([nc]?)", (text or "").strip())
+    if match is None:
+        return None
+    value, unit, per = match.groups()
+    size = float(value) * _MEM_UNITS[unit]
+    if per == "c":
+        size *= alloc_cpus
+    return int(size)
+
+
+def parse_sacct(text):
+    """Parse the output of ``sacct --parsable2`` (with its header line).
+
+    The steps of a job (``.batch``, ``.extern``, ``.0``...) are merged into the job:
+    the peak memory is the largest MaxRSS of the steps. Returns a dict of jobs by
+    job id, where the tasks of a job array are ``{array job id}_{task id}``.
+    """
+    lines = [line for line in text.splitlines() if line.strip()]
+    if not lines:
+        return dict()
+    header = lines[0].split("|")
+    jobs = dict()
+    for line in lines[1:]:
+        row = dict(zip(header, line.split("|")))
+        job_id, _, step = row["JobID"].partition(".")
+        if "[" in job_id:
+            # The tasks of an array that did not start yet
+            continue
+        job = jobs.setdefault(job_id, {"job_id": job_id, "max_rss_bytes": None})
+        if not step:
+            alloc_cpus = int(row.get("AllocCPUS") or 0) or None
+            job.update(
+                job_name=row.get("JobName"),
+                state=row.get("State", "").split(" ")[0],
+                exit_code=row.get("ExitCode"),
+                elapsed_s=parse_duration(row.get("Elapsed")),
+                cpu_s=parse_duration(row.get("TotalCPU")),
+                alloc_cpus=alloc_cpus,
+                req_mem_bytes=parse_memory(row.get("ReqMem"), alloc_cpus or 1),
+                start=row.get("Start") or None,
+                end=row.get("End") or None,
+            )
+        rss = parse_memory(row.get("MaxRSS"))
+        if rss is not None and (job["max_rss_bytes"] is None or rss > job["max_rss_bytes"]):
+            job["max_rss_bytes"] = rss
+    return jobs
+
+
+def query_sacct(job_ids=None, since=None, sacct=None):
+    """Run sacct for some job ids, or for all the jobs since a date, and return its output."""
+    command = [sacct or get_sacct(), "--parsable2", f"--format={','.join(SACCT_FIELDS)}"]
+    if job_ids:
+        command.append(f"--jobs={','.join(job_ids)}")
+    if since is not None:
+        command.append(f"--starttime={since}")
+    return subprocess.run(command, capture_output=True, text=True, check=True).stdout
+
+
+def read_log_header(job_id, log_dir=None):
+    """Return the stage and labels of a job from the header of its log, or None."""
+    fpath = (LOG_DIR if log_dir is None else Path(log_dir)) / f"{job_id}.out"
+    if not fpath.exists():
+        return None
+    with fpath.open("r", errors="replace") as file:
+        for _, line in zip(range(50), file):
+            match = PACKED_LOG_HEADER.match(line)
+            if match is not None:
+                return dict(stage="bibsnet", packed=True, **match.groupdict())
+            for stage, pattern in LOG_HEADERS:
+                match = pattern.match(line)
+                if match is None:
+                    continue
+                labels = {key: value for key, value in match.groupdict().items() if value}
+                if "anat_only" in labels:
+                    labels["anat_only"] = True
+                return dict(stage=stage, **labels)
+    return None
+
+
+def map_job(job_id, submissions, log_dir=None):
+    """Return the stage, project, subject and session of a job, or None.
+
+    ``submissions`` are the records of the ``submissions`` ledger, by job id. A
+    packed BIBSnet job has no single subject, so it is returned with
+    ``packed=True`` and no subject.
+    """
+    array_id, _, task = job_id.partition("_")
+    submission = submissions.get(array_id)
+    if submission is not None and submission.get("packed"):
+        return dict(
+            stage=submission["stage"],
+            packed=True,
+            project=submission["project"],
+            session=submission["session"],
+        )
+    if submission is not None and task.isdigit() and int(task) < len(submission["subjects"]):
+        labels = {
+            key: submission[key]
+            for key in ["stage", "project", "session", "surface_recon_method", "anat_only", "batch"]
+            if submission.get(key) is not None
+        }
+        return dict(labels, subject=submission["subjects"][int(task)])
+    return read_log_header(job_id, log_dir=log_dir)
+
+
+def job_record(job, labels):
+    """Return the ``runs`` record of a finished job, see :func:`parse_sacct`."""
+    code, _, signal = (job.get("exit_code") or "0:0").partition(":")
+    returncode = int(code or 0)
+    if job["state"] != "COMPLETED" and returncode == 0:
+        # Killed jobs (timeout, out of memory, cancelled) exit with a signal
+        returncode = int(signal or 0) or 1
+    cpu_efficiency = mem_efficiency = None
+    if job.get("cpu_s") is not None and job.get("elapsed_s") and job.get("alloc_cpus"):
+        cpu_efficiency = round(job["cpu_s"] / (job["elapsed_s"] * job["alloc_cpus"]), 3)
+    if job.get("max_rss_bytes") and job.get("req_mem_bytes"):
+        mem_efficiency = round(job["max_rss_bytes"] / job["req_mem_bytes"], 3)
+    labels = dict(labels)
+    tool = labels.pop("stage", None) or job.get("job_name")
+    return dict(
+        labels,
+        source="sacct",
+        tool=tool,
+        slurm_job_id=job["job_id"],
+        run_id=f"slurm-{job['job_id']}",
+        started=job.get("start"),
+        state=job["state"],
+        returncode=returncode,
+        elapsed_s=job.get("elapsed_s"),
+        cpu_s=job.get("cpu_s"),
+        alloc_cpus=job.get("alloc_cpus"),
+        cpu_efficiency=cpu_efficiency,
+        peak_mem_bytes=job.get("max_rss_bytes"),
+        req_mem_bytes=job.get("req_mem_bytes"),
+        mem_efficiency=mem_efficiency,
+    )
+
+
+def _features(record, monitored):
+    """Return the input features of a job, for the runtime predictor, or None."""
+    if record["slurm_job_id"] in monitored:
+        return monitored[record["slurm_job_id"]].get("features")
+    if not all(record.get(key) for key in ["project", "subject", "session"]):
+        return None
+    from .predict import subject_features
+
+    method = record.get("surface_recon_method", "infantfs")
+    features = subject_features(
+        record["project"],
+        record["subject"],
+        record["session"],
+        surface_recon_method="mcribs" if method == "mcribs" else "infantfs",
+        anat_only=bool(record.get("anat_only")),
+    )
+    # The inputs were deleted, or were never on this computer
+    return features if features["anat_mvoxels"] else None
+
+
+def harvest(sacct_output=None, *, job_ids=None, since=None, sacct=None, log_dir=None):
+    """Save the SLURM accounting of the finished jobs to the ``runs`` ledger.
+
+    Parameters
+    ----------
+    sacct_output : str, optional
+        The output of ``sacct --parsable2`` (see ``SACCT_FIELDS``). Default is None,
+        which runs sacct.
+    job_ids : list of str, optional
+        The jobs to ask sacct about. Default is None, which asks about the jobs of
+        the ``submissions`` ledger, unless ``since`` is given.
+    since : str, optional
+        Ask sacct about all of our jobs since this date, for example
+        ``"2024-05-01"``.
+    sacct : str, optional
+        The sacct command. Default is None, which uses :func:`get_sacct`.
+    log_dir : path-like, optional
+        Where the SLURM logs are. Default is ``SLURM/log``.
+
+    Returns
+    -------
+    records : list of dict
+        The records that were added. Jobs that are not finished, that were already
+        harvested, or that cannot be mapped to a subject are skipped.
+    """
+    submissions = {record["job_id"]: record for record in read_records("submissions")}
+    if sacct_output is None:
+        if job_ids is None and since is None:
+            job_ids = sorted(submissions)
+            if not job_ids:
+                print("No submissions to harvest. Pass job ids or --since.")
+                return []
+        sacct_output = query_sacct(job_ids=job_ids, since=since, sacct=sacct)
+    runs = read_records("runs")
+    harvested = {run["slurm_job_id"] for run in runs if run.get("source") == "sacct"}
+    monitored = {
+        run["slurm_job_id"]: run
+        for run in runs
+        if run.get("slurm_job_id") and run.get("source") != "sacct"
+    }
+
+    records, skipped, packed = [], [], []
+    for job_id, job in parse_sacct(sacct_output).items():
+        if job_id in harvested or job.get("state") in UNFINISHED_STATES or "state" not in job:
+            continue
+        labels = map_job(job_id, submissions, log_dir=log_dir)
+        if labels is None:
+            skipped.append(job_id)
+            continue
+        if labels.get("packed"):
+            # utils.monitor recorded each subject of the job as it ran
+            packed.append(job_id)
+            continue
+        record = job_record(job, labels)
+        features = _features(record, monitored)
+        if features is not None:
+            record["features"] = features
+        records.append(append_record("runs", record))
+    print(f"Harvested {len(records)} SLURM jobs")
+    if packed:
+        print(f"Skipped {len(packed)} packed BIBSnet jobs, their subjects were recorded as they ran")
+    if skipped:
+        print(f"Could not tell the subject of {len(skipped)} jobs: {', '.join(skipped)}")
+    return records
+
+
+def print_efficiency_report(records=None, cpu_threshold=0.5, mem_threshold=0.5):
+    """Print the CPU and memory efficiency of the harvested jobs, and flag the worst.
+
+    The efficiency is what a job used divided by what it requested: CPU time over
+    ``elapsed * CPUs``, and MaxRSS over the requested memory.
+    """
+    if records is None:
+        records = read_records("runs", source="sacct")
+    print(
+        f"\n{'tool':<10} {'jobs':>5} {'failed':>6} {'mean h':>7} {'CPU eff':>8}"
+        f" {'mem eff':>8} {'max GB':>7}"
+    )
+    by_tool = dict()
+    for record in records:
+        by_tool.setdefault(record.get("tool"), []).append(record)
+
+    def _mean(values):
+        values = [value for value in values if value is not None]
+        return sum(values) / len(values) if values else None
+
+    for tool, jobs in by_tool.items():
+        cpu = _mean(job.get("cpu_efficiency") for job in jobs)
+        mem = _mean(job.get("mem_efficiency") for job in jobs)
+        peaks = [job["peak_mem_bytes"] for job in jobs if job.get("peak_mem_bytes")]
+        print(
+            f"{str(tool):<10} {len(jobs):>5}"
+            f" {sum(job.get('returncode') != 0 for job in jobs):>6}"
+            f" {(_mean(job.get('elapsed_s') for job in jobs) or 0) / 3600:>7.2f}"
+            f" {'-' if cpu is None else f'{cpu:.0%}':>8}"
+            f" {'-' if mem is None else f'{mem:.0%}':>8}"
+            f" {'-' if not peaks else f'{max(peaks) / 2**30:.1f}':>7}"
+        )
+    inefficient = [
+        record
+        for record in records
+        if (record.get("cpu_efficiency") is not None and record["cpu_efficiency"] < cpu_threshold)
+        or (record.get("mem_efficiency") is not None and record["mem_efficiency"] < mem_threshold)
+    ]
+    if inefficient:
+        print(
+            f"\n{len(inefficient)} jobs used less than {cpu_threshold:.0%} of their CPUs"
+            f" or {mem_threshold:.0%} of their memory:"
+        )
+        for record in inefficient:
+            print(
+                f"  {record['slurm_job_id']:<14} {str(record.get('tool')):<10}"
+                f" sub-{record.get('subject')}_ses-{record.get('session')}"
+                f" CPU {record.get('cpu_efficiency')} mem {record.get('mem_efficiency')}"
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Save the SLURM accounting of finished jobs.")
+    parser.add_argument(
+        "--jobs",
+        nargs="+",
+        default=None,
+        help="Job ids to harvest. Default is the jobs submitted with utils.slurm.",
+    )
+    parser.add_argument(
+        "--since", default=None, help="Harvest all jobs since this date (YYYY-MM-DD)."
+    )
+    parser.add_argument(
+        "--sacct-output",
+        default=None,
+        dest="sacct_output",
+        help="Read the output of 'sacct --parsable2' from this file instead of running sacct.",
+    )
+    parser.add_argument("--log-dir", default=None, dest="log_dir")
+    parser.add_argument(
+        "--report",
+        action="store_true",
+        help="Print the CPU and memory efficiency of the harvested jobs.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    sacct_output = None
+    if args["sacct_output"] is not None:
+        sacct_output = Path(args["sacct_output"]).read_text()
+    harvest(sacct_output, job_ids=args["jobs"], since=args["since"], log_dir=args["log_dir"])
+    if args["report"]:
+        print_efficiency_report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+import fcntl
+import itertools
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from . import ledger
+from .tracing import span
+
+# Relative share of the bandwidth budget for each kind of transfer. Pulls unblock the
+# next container, so they get most of the link. Pushes of finished subjects can wait.
+PRIORITY_WEIGHTS = {"pull": 4, "push": 1}
+
+_SCHEDULER = None
+
+
+class BandwidthScheduler:
+    """Share a bandwidth budget between the transfers that run at the same time.
+
+    The transfers of all the processes on this computer that use the same
+    ``state_dir`` share the budget, for example the subjects that
+    ``orchestrator.py`` or ``utils.executors`` run side by side. Each waiting and
+    active transfer is a small file in ``state_dir``, which is only changed while
+    holding a lock on ``state_dir/.lock``.
+
+    Parameters
+    ----------
+    budget_kbps : int | None
+        The total bandwidth, in KB/s, that all transfers may use together. Default is
+        None, which does not limit the bandwidth.
+    max_active : int | None
+        The maximum number of transfers that may run at the same time. Transfers
+        that can't start yet wait, and waiting pulls always start before waiting
+        pushes. Default is None, which does not limit the number of transfers.
+    min_kbps : int
+        The smallest ``--bwlimit`` that is given to a transfer. Default is 500.
+    state_dir : path-like | None
+        Where the transfers are tracked. Default is None, which uses
+        ``logs/bandwidth``.
+    poll_s : float
+        How often a waiting transfer checks whether it may start. Default is 1.
+
+    Notes
+    -----
+    rsync can't change its ``--bwlimit`` while it runs, so a share is given when a
+    transfer (or a retry of a transfer) starts, and kept until it ends. Each
+    transfer gets ``budget * weight / total weight``, where the total weight is
+    the sum over the active transfers and itself (see ``PRIORITY_WEIGHTS``), but
+    never more than what the active transfers left of the budget, so together
+    they stay within it. A push also counts a pull in the total weight when none
+    is active, to leave room for the next pull. A transfer waits while less than
+    ``min_kbps`` is left. The files of processes of this computer that died are
+    removed. The files of other computers (on a shared ``logs`` directory) are
+    left alone.
+    """
+
+    def __init__(self, budget_kbps=None, max_active=None, min_kbps=500, state_dir=None, poll_s=1.0):
+        self.budget_kbps = budget_kbps
+        self.max_active = max_active
+        self.min_kbps = min_kbps
+        self.state_dir = Path(state_dir) if state_dir is not None else None
+        self.poll_s = poll_s
+        self._counter = itertools.count()
+
+    @property
+    def limited(self):
+        return self.budget_kbps is not None or self.max_active is not None
+
+    def _directory(self):
+        return self.state_dir if self.state_dir is not None else ledger.LEDGER_DIR / "bandwidth"
+
+    @contextmanager
+    def _lock(self):
+        directory = self._directory()
+        directory.mkdir(parents=True, exist_ok=True)
+        with open(directory / ".lock", "w") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                yield directory
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _tickets(directory):
+        """Return the waiting and the active tickets, removing those of dead processes."""
+        tickets = {"waiting": [], "active": []}
+        hostname = socket.gethostname()
+        for fpath in directory.glob("*.json"):
+            try:
+                ticket = json.loads(fpath.read_text())
+            except (OSError, ValueError):
+                continue
+            if ticket["hostname"] == hostname:
+                try:
+                    os.kill(ticket["pid"], 0)
+                except ProcessLookupError:
+                    fpath.unlink(missing_ok=True)
+                    continue
+                except PermissionError:
+                    pass
+            ticket["fpath"] = fpath
+            tickets[ticket["state"]].append(ticket)
+        # Heavier transfers first, then in the order they arrived
+        tickets["waiting"].sort(key=lambda ticket: (-ticket["weight"], ticket["created"], ticket["name"]))
+        return tickets
+
+    def share(self, weight, active):
+        """Return the ``--bwlimit`` in KB/s of a new transfer next to the ``active`` ones.
+
+        Returns None if the budget is not limited, and 0 if the active transfers
+        left less than ``min_kbps`` of it, in which case the transfer must wait.
+        """
+        if self.budget_kbps is None:
+            return None
+        weights = [ticket["weight"] for ticket in active] + [weight]
+        if max(weights) < PRIORITY_WEIGHTS["pull"]:
+            weights.append(PRIORITY_WEIGHTS["pull"])
+        share = max(int(self.budget_kbps * weight / sum(weights)), self.min_kbps)
+        left = self.budget_kbps - sum(ticket.get("granted_kbps") or 0 for ticket in active)
+        if left < min(self.min_kbps, self.budget_kbps):
+            return 0
+        return min(share, left)
+
+    @contextmanager
+    def transfer(self, priority="push"):
+        """Wait for a free slot, and yield the ``--bwlimit`` to use (or None)."""
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(
+                f"priority must be one of {list(PRIORITY_WEIGHTS)}, but got: {priority}"
+            )
+        if not self.limited:
+            yield None
+            return
+        weight = PRIORITY_WEIGHTS[priority]
+        name = f"{socket.gethostname()}-{os.getpid()}-{next(self._counter)}"
+        ticket = dict(
+            name=name,
+            hostname=socket.gethostname(),
+            pid=os.getpid(),
+            weight=weight,
+            priority=priority,
+            created=time.time(),
+            state="waiting",
+        )
+        fpath = None
+        try:
+            with span("wait for bandwidth", category="wait", priority=priority):
+                with self._lock() as directory:
+                    fpath = directory / f"{name}.json"
+                    fpath.write_text(json.dumps(ticket))
+                while True:
+                    with self._lock() as directory:
+                        tickets = self._tickets(directory)
+                        can_start = tickets["waiting"][0]["name"] == name and (
+                            self.max_active is None or len(tickets["active"]) < self.max_active
+                        )
+                        if can_start:
+                            bwlimit = self.share(weight, tickets["active"])
+                        if can_start and bwlimit != 0:
+                            ticket.update(state="active", granted_kbps=bwlimit)
+                            fpath.write_text(json.dumps(ticket))
+                            break
+                    time.sleep(self.poll_s)
+            yield bwlimit
+        finally:
+            if fpath is not None:
+                with self._lock():
+                    fpath.unlink(missing_ok=True)
+
+
+def configure_bandwidth(budget_kbps=None, max_active=None):
+    """Set up the scheduler that is used by all transfers of this process."""
+    global _SCHEDULER
+    _SCHEDULER = BandwidthScheduler(budget_kbps=budget_kbps, max_active=max_active)
+    return _SCHEDULER
+
+
+def get_scheduler():
+    """Return the shared scheduler.
+
+    If :func:`configure_bandwidth` was not called, the budget is read from the
+    ``MRI_BANDWIDTH_BUDGET_KBPS`` environment variable (unlimited if it is not set).
+    """
+    if _SCHEDULER is None:
+        budget = os.environ.get("MRI_BANDWIDTH_BUDGET_KBPS")
+        configure_bandwidth(budget_kbps=int(budget) if budget else None)
+    return _SCHEDULER
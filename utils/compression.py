@@ -0,0 +1,135 @@
+import gzip
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+
+def _payload_sha256(fpath, chunk_size=2**20):
+    """Return the sha256 of the decompressed contents of a gzip file."""
+    digest = hashlib.sha256()
+    with gzip.open(fpath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def recompress_gzip_file(fpath, level=9, chunk_size=2**20):
+    """Recompress a gzip file (for example a ``.nii.gz``) in place.
+
+    Parameters
+    ----------
+    fpath : path-like
+        The gzip file to recompress. The file name is not changed, so BIDS names stay
+        valid.
+    level : int
+        The gzip compression level, from 1 (fastest) to 9 (smallest). Default is 9.
+
+    Returns
+    -------
+    sizes : tuple of int
+        The size of the file in bytes, before and after recompression.
+
+    Notes
+    -----
+    The new file is written next to the original, and it only replaces the original
+    if its decompressed contents are identical to the original's, and if it is
+    smaller. Otherwise the original file is left untouched.
+    """
+    fpath = Path(fpath)
+    tmp_fpath = fpath.with_name(f".{fpath.name}.recompress")
+    old_size = fpath.stat().st_size
+    original = hashlib.sha256()
+    try:
+        with gzip.open(fpath, "rb") as src, tmp_fpath.open("wb") as raw:
+            with gzip.GzipFile(
+                filename=fpath.name[: -len(".gz")],
+                mode="wb",
+                compresslevel=level,
+                fileobj=raw,
+                mtime=int(fpath.stat().st_mtime),
+            ) as dst:
+                for chunk in iter(lambda: src.read(chunk_size), b""):
+                    original.update(chunk)
+                    dst.write(chunk)
+        new_size = tmp_fpath.stat().st_size
+        if new_size >= old_size:
+            return old_size, old_size
+        if _payload_sha256(tmp_fpath) != original.hexdigest():
+            raise OSError(f"Recompressed {fpath} does not match the original contents.")
+        stat = fpath.stat()
+        os.replace(tmp_fpath, fpath)
+        os.utime(fpath, (stat.st_atime, stat.st_mtime))
+    finally:
+        tmp_fpath.unlink(missing_ok=True)
+    return old_size, new_size
+
+
+def recompress_outputs(
+    path,
+    level=9,
+    *,
+    min_size_mb=10,
+    n_jobs=None,
+    patterns=("*.nii.gz",),
+):
+    """Recompress the large gzipped NIfTI files in a Nibabies output directory.
+
+    Parameters
+    ----------
+    path : path-like
+        The directory to search, for example
+        ``"./BABIES/MRI/newborn/derivatives/Nibabies/sub-1073"``.
+    level : int
+        The gzip compression level, from 1 to 9. Default is 9.
+    min_size_mb : float
+        Files smaller than this are skipped, because the savings are not worth the
+        time. Default is 10.
+    n_jobs : int | None
+        The number of processes to use. Default is None, which uses one process per
+        core.
+    patterns : tuple of str
+        The glob patterns of the files to recompress. Default is ``("*.nii.gz",)``.
+
+    Returns
+    -------
+    sizes : dict
+        The total size in bytes of the matched files ``"before"`` and ``"after"``.
+
+    Notes
+    -----
+    GIFTI files are not touched: their data arrays are already compressed inside the
+    XML, and rewriting them would require nibabel. Neither are the CIFTI outputs of
+    ``--cifti-output 91k`` (``.dtseries.nii``, ``.dscalar.nii``): Nibabies writes
+    them uncompressed, and gzipping them would change their names.
+
+    A recompressed file has new bytes, so it is not hard-linked to the same output
+    in a previous snapshot (``--snapshot``, see :func:`utils.transfer.plan_transfers`)
+    even if its contents did not change.
+    """
+    path = Path(path)
+    if not path.exists():
+        raise FileNotFoundError(f"{path} does not exist")
+    if level not in range(1, 10):
+        raise ValueError(f"level must be between 1 and 9, but got: {level}")
+    fpaths = sorted(
+        fpath
+        for pattern in patterns
+        for fpath in path.rglob(pattern)
+        if fpath.stat().st_size >= min_size_mb * 1024**2
+    )
+    print(f"Recompressing {len(fpaths)} files in {path} with gzip level {level}")
+    sizes = {"before": 0, "after": 0}
+    if not fpaths:
+        return sizes
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        for fpath, (old_size, new_size) in zip(
+            fpaths, executor.map(recompress_gzip_file, fpaths, [level] * len(fpaths))
+        ):
+            sizes["before"] += old_size
+            sizes["after"] += new_size
+            print(f"    {fpath.name}: {old_size / 1024**2:.1f} MB -> {new_size / 1024**2:.1f} MB")
+    print(
+        f"Total: {sizes['before'] / 1024**2:.1f} MB -> {sizes['after'] / 1024**2:.1f} MB"
+    )
+    return sizes
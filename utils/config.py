@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 import sys
 from pathlib import Path
 from warnings import warn
@@ -9,6 +10,27 @@ import yaml
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DEFAULT_SERVER_ROOT = Path("/Volumes/HumphreysLab/Daily_2")
+
+
+def get_server_root():
+    """Return the root of the lab server, which holds the project directories.
+
+    Default is ``/Volumes/HumphreysLab/Daily_2``. Set the ``MRI_SERVER_ROOT``
+    environment variable to use another directory, for example a local stand-in
+    for the server when testing or benchmarking.
+    """
+    return Path(os.environ.get("MRI_SERVER_ROOT", DEFAULT_SERVER_ROOT))
+
+
+def get_local_root():
+    """Return the local directory that holds the project directories.
+
+    Default is this repository. Set the ``MRI_LOCAL_ROOT`` environment variable to
+    use another directory.
+    """
+    return Path(os.environ.get("MRI_LOCAL_ROOT", Path(__file__).parent.parent))
+
 
 class Config(dict):
     def __init__(self, *args, **kwargs):
@@ -50,8 +72,8 @@ class SubjectConfig(Config):
         self["subject_id"] = subject_id
         self["session"] = _get_session(session)
         self["base_path"] = dict(
-            server=Path("/Volumes/HumphreysLab/Daily_2") / project / "MRI",
-            local=(Path(__file__).parent.parent / project / "MRI"),
+            server=get_server_root() / project / "MRI",
+            local=get_local_root() / project / "MRI",
         )
         self["server_paths"] = dict()
         self["local_paths"] = dict()
@@ -0,0 +1,537 @@
+"""A long-running orchestrator that owns the queue of subjects on this computer.
+
+Every run of ``00_process_subjects.py`` starts from scratch: it checks the server
+directories again, measures the link again, and does not know what else runs on
+the computer. The orchestrator is started once (``python orchestrator.py serve``)
+and keeps that state warm between submissions:
+
+- the subjects it checked on the server, and their features (see
+  :func:`utils.predict.subject_features`),
+- the runtime predictor, reloaded only when a run finished,
+- the transfer profile (``lan`` or ``wan``), measured once,
+- which Nibabies images are present, pulled once if missing.
+
+It runs each subject with ``00_process_subjects.py`` in its own process, at most
+``slots`` at a time, and splits the CPUs and memory between them. Several users
+can queue subjects through a small HTTP API on ``localhost`` (see
+:func:`request`): a subject that is already queued or running is not queued
+twice. The jobs are saved to the ``jobs`` ledger, so the queue survives a restart.
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.error import HTTPError, URLError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+from . import ledger
+from .config import SubjectConfig, get_local_root
+from .ledger import append_record, read_records
+from .scheduling import PRIORITIES, parse_time, sort_key
+
+REPO_DIR = Path(__file__).parent.parent
+DEFAULT_ADDRESS = "127.0.0.1:8765"
+# The states of a job that has not finished yet
+ACTIVE_STATES = ("queued", "running")
+
+
+def get_address():
+    """Return the ``host:port`` of the orchestrator, from ``MRI_DAEMON_ADDRESS``.
+
+    Default is ``127.0.0.1:8765``, so that only users of this computer can reach it.
+    """
+    return os.environ.get("MRI_DAEMON_ADDRESS", DEFAULT_ADDRESS)
+
+
+class Orchestrator:
+    """The queue of subjects, and the processes that run them.
+
+    Parameters
+    ----------
+    slots : int
+        How many subjects may run at the same time.
+    version : str
+        The version of Nibabies to run.
+    ip_address, username : str, optional
+        How to reach Whale, if the server is not mounted on this computer.
+    extra_args : list of str
+        Passed to each ``00_process_subjects.py`` process, for example
+        ``["--archive"]``.
+    poll_s : float
+        Seconds between two checks of the running processes.
+    docker : str
+        The docker command.
+    """
+
+    def __init__(
+        self,
+        slots=1,
+        version="latest",
+        *,
+        ip_address=None,
+        username=None,
+        extra_args=(),
+        poll_s=5.0,
+        docker="docker",
+    ):
+        self.slots = slots
+        self.version = version
+        self.ip_address = ip_address
+        self.username = username
+        self.extra_args = list(extra_args)
+        self.poll_s = poll_s
+        self.docker = docker
+        self.jobs = dict()
+        self.processes = dict()
+        # The jobs that a previous orchestrator started, and that still run
+        self.orphans = dict()
+        self.lock = threading.RLock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+        # The warm state, see the module docstring
+        self.inventory = dict()
+        self.predictor = None
+        self.profile = None
+        self.images = dict()
+        self._restore()
+
+    def _restore(self):
+        """Load the jobs of a previous orchestrator from the ``jobs`` ledger.
+
+        A job that was running keeps its slot while its process or its container
+        still runs, so that it is not started twice. It is marked interrupted when
+        both are gone, since its return code is not known.
+        """
+        for record in read_records("jobs"):
+            self.jobs[record["id"]] = record
+        for job in self.jobs.values():
+            if job["state"] != "running":
+                continue
+            if self._is_alive(job):
+                self.orphans[job["id"]] = job
+            else:
+                self._update(job, state="interrupted", finished=_now())
+        if self.orphans:
+            print(f"{len(self.orphans)} subjects of the previous orchestrator still run")
+        queued = sum(job["state"] == "queued" for job in self.jobs.values())
+        if queued:
+            print(f"Restored {queued} queued subjects")
+
+    def _update(self, job, **changes):
+        job.update(changes)
+        job.pop("timestamp", None)
+        append_record("jobs", job)
+
+    def _next_id(self):
+        return str(max((int(job_id) for job_id in self.jobs), default=0) + 1)
+
+    def check_subject(self, project, subject, session, *, surface_recon_method, anat_only):
+        """Check the server directories of a subject, and return its features.
+
+        Raises FileNotFoundError if the subject is not complete on the server. The
+        result is cached, so a subject is checked once.
+        """
+        from .predict import subject_features
+
+        key = (project, subject, session, surface_recon_method, anat_only)
+        if key not in self.inventory:
+            SubjectConfig(
+                project,
+                subject,
+                session,
+                get_spatial_file=False,
+                anat_only=anat_only,
+                server_is_mounted=self.ip_address is None,
+            )
+            method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
+            self.inventory[key] = subject_features(
+                project, subject, session, surface_recon_method=method, anat_only=anat_only
+            )
+        return self.inventory[key]
+
+    def predict(self, features):
+        """Return the predicted runtime in seconds, with the cached predictor."""
+        from .predict import load_predictor, predict
+
+        if self.predictor is None:
+            self.predictor = load_predictor("nibabies") or dict()
+        return predict(features, predictor=self.predictor or None)["elapsed_s"]
+
+    def transfer_profile(self):
+        """Return the transfer profile, measured the first time."""
+        from .transfer import measure_profile
+
+        if self.profile is None:
+            self.profile = measure_profile(
+                server_is_mounted=self.ip_address is None,
+                ip_address=self.ip_address,
+                username=self.username,
+            )
+            print(f"Transfer profile: {self.profile}")
+        return self.profile
+
+    def ensure_image(self, version):
+        """Pull the Nibabies image once, instead of in each container run."""
+        if not self.images.get(version):
+            image = f"nipreps/nibabies:{version}"
+            present = subprocess.run(
+                [self.docker, "image", "inspect", image], capture_output=True
+            ).returncode == 0
+            if not present:
+                print(f"Pulling {image}")
+                present = subprocess.run([self.docker, "pull", image]).returncode == 0
+            self.images[version] = present
+        return self.images[version]
+
+    def submit(
+        self,
+        project,
+        subjects,
+        session,
+        *,
+        surface_recon_method="freesurfer",
+        anat_only=False,
+        user=None,
+        priority="normal",
+        deadline=None,
+    ):
+        """Queue subjects, and return the new jobs and the subjects that were not queued.
+
+        ``priority`` and ``deadline`` (an ISO time) decide when they run, see
+        :mod:`utils.scheduling`. Returns a dict with ``jobs`` (the new jobs) and
+        ``skipped`` (a dict from subject to the reason: already queued or running,
+        or missing files).
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"priority must be one of {PRIORITIES}, but got: {priority}")
+        parse_time(deadline)
+        jobs, skipped = [], dict()
+        for subject in subjects:
+            try:
+                features = self.check_subject(
+                    project,
+                    subject,
+                    session,
+                    surface_recon_method=surface_recon_method,
+                    anat_only=anat_only,
+                )
+            except FileNotFoundError as error:
+                skipped[subject] = str(error)
+                continue
+            with self.lock:
+                active = [
+                    job
+                    for job in self.jobs.values()
+                    if job["state"] in ACTIVE_STATES
+                    and (job["project"], job["subject"], job["session"]) == (project, subject, session)
+                ]
+                if active:
+                    skipped[subject] = f"already {active[0]['state']} as job {active[0]['id']} by {active[0]['user']}"
+                    continue
+                job = dict(
+                    id=self._next_id(),
+                    project=project,
+                    subject=subject,
+                    session=session,
+                    surface_recon_method=surface_recon_method,
+                    anat_only=anat_only,
+                    user=user,
+                    priority=priority,
+                    deadline=deadline,
+                    state="queued",
+                    predicted_s=self.predict(features),
+                    submitted=_now(),
+                )
+                self.jobs[job["id"]] = job
+                self._update(job)
+            jobs.append(job)
+        self.wake.set()
+        return dict(jobs=jobs, skipped=skipped)
+
+    def cancel(self, job_id, user=None):
+        """Cancel a queued or running job, and return it."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise KeyError(f"No job {job_id}")
+            if job["state"] not in ACTIVE_STATES:
+                raise ValueError(f"Job {job_id} is already {job['state']}")
+            process = self.processes.pop(job_id, None)
+            if process is not None:
+                self._stop(job, process.pid)
+            elif self.orphans.pop(job_id, None) is not None:
+                self._stop(job, job.get("pid"))
+            self._update(job, state="cancelled", cancelled_by=user, finished=_now())
+        self.wake.set()
+        return job
+
+    def _stop(self, job, pid):
+        """Stop the process group of a job (if its pid is known), and its container."""
+        if pid is not None:
+            try:
+                os.killpg(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        # Killing the docker client does not stop the container
+        names = self._containers(job)
+        if names:
+            subprocess.run([self.docker, "stop", *names], capture_output=True)
+
+    def _containers(self, job):
+        """Return the names of the running Nibabies containers of a job."""
+        name = job.get("container") or _container_prefix(job)
+        try:
+            output = subprocess.run(
+                [self.docker, "ps", "--filter", f"name={name}", "--format", "{{.Names}}"],
+                capture_output=True,
+                text=True,
+            ).stdout
+        except OSError:
+            return []
+        return output.split()
+
+    def _is_alive(self, job):
+        """Return whether the process group or a container of a job still runs."""
+        pid = job.get("pid")
+        if pid is not None:
+            try:
+                # The job leads its own process group, a reused pid most likely does not
+                if os.getpgid(pid) == pid:
+                    return True
+            except ProcessLookupError:
+                pass
+        return bool(self._containers(job))
+
+    def status(self, **filters):
+        """Return the jobs that match the filters, for example ``state="queued"``."""
+        with self.lock:
+            jobs = [
+                dict(job)
+                for job in self.jobs.values()
+                if all(str(job.get(key)) == str(value) for key, value in filters.items())
+            ]
+            running = sum(job["state"] == "running" for job in self.jobs.values())
+        return dict(slots=self.slots, running=running, jobs=jobs)
+
+    def _next_job(self):
+        """Return the queued job to start next, see :class:`utils.scheduling.Scheduler`.
+
+        A job that cannot be sorted, for example because of a bad deadline in the
+        ledger, is failed instead of blocking the queue.
+        """
+        now = datetime.now()
+        keys = dict()
+        for job in self.jobs.values():
+            if job["state"] != "queued":
+                continue
+            try:
+                keys[job["id"]] = sort_key(dict(job, order=int(job["id"])), now)
+            except (TypeError, ValueError) as error:
+                self._fail(job, error)
+        if not keys:
+            return None
+        return self.jobs[min(keys, key=keys.get)]
+
+    def _command(self, job):
+        command = [
+            sys.executable,
+            str(REPO_DIR / "00_process_subjects.py"),
+            "--project", job["project"],
+            "--subjects", job["subject"],
+            "--session", job["session"],
+            "--surface-recon-method", job["surface_recon_method"],
+            "--nibabies-version", self.version,
+            "--transfer-profile", self.transfer_profile(),
+            "--concurrent", str(self.slots),
+        ]
+        if job["anat_only"]:
+            command.append("--anat_only")
+        if self.ip_address is not None:
+            command += ["--ip-address", self.ip_address, "--username", self.username]
+        return command + self.extra_args
+
+    def _start(self, job):
+        log_dir = ledger.LEDGER_DIR / "jobs"
+        log_dir.mkdir(parents=True, exist_ok=True)
+        log_file = log_dir / f"job-{job['id']}_sub-{job['subject']}_ses-{job['session']}.log"
+        with open(log_file, "w") as log:
+            # The scripts expect to run from the local root, see utils/config.py. Each
+            # job gets its own process group, so that cancel stops all of it.
+            self.processes[job["id"]] = subprocess.Popen(
+                self._command(job),
+                cwd=get_local_root(),
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+            )
+        # Saved so that a restarted orchestrator can tell whether the job still runs
+        self._update(
+            job,
+            state="running",
+            started=_now(),
+            log=log_file,
+            pid=self.processes[job["id"]].pid,
+            container=_container_prefix(job),
+        )
+        print(f"Started job {job['id']}: sub-{job['subject']} ses-{job['session']} for {job['user']}")
+
+    def _fail(self, job, error):
+        self._update(job, state="failed", error=str(error), finished=_now())
+        print(f"Job {job['id']} failed: sub-{job['subject']} ses-{job['session']}: {error}")
+
+    def step(self):
+        """Record the processes that finished, and start queued jobs in the free slots.
+
+        An error while starting a job (checking the image, measuring the link,
+        starting the process) fails that job only.
+        """
+        with self.lock:
+            for job_id, process in list(self.processes.items()):
+                if process.poll() is None:
+                    continue
+                del self.processes[job_id]
+                job = self.jobs[job_id]
+                state = "done" if process.returncode == 0 else "failed"
+                self._update(job, state=state, returncode=process.returncode, finished=_now())
+                print(f"Job {job_id} {state}: sub-{job['subject']} ses-{job['session']}")
+                # The run was added to the runs ledger
+                self.predictor = None
+            for job_id, job in list(self.orphans.items()):
+                if self._is_alive(job):
+                    continue
+                del self.orphans[job_id]
+                self._update(job, state="interrupted", finished=_now())
+                print(f"Job {job_id} of the previous orchestrator ended: sub-{job['subject']} ses-{job['session']}")
+                self.predictor = None
+            while len(self.processes) + len(self.orphans) < self.slots:
+                job = self._next_job()
+                if job is None:
+                    break
+                try:
+                    if not self.ensure_image(self.version):
+                        self._fail(job, "no Nibabies image")
+                        continue
+                    self._start(job)
+                except Exception as error:
+                    self._fail(job, error)
+
+    def run(self):
+        """Check the jobs until :meth:`stop` is called.
+
+        An unexpected error is printed, and the jobs are checked again at the next
+        poll, so that the queue does not stop silently.
+        """
+        while not self.stopped.is_set():
+            try:
+                self.step()
+            except Exception as error:
+                print(f"Error while checking the jobs: {error!r}")
+            self.wake.wait(self.poll_s)
+            self.wake.clear()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """The HTTP API of an :class:`Orchestrator`.
+
+    ``GET /jobs`` (filters as query parameters), ``POST /jobs`` (submit) and
+    ``POST /jobs/{id}/cancel``. Bodies and replies are JSON.
+    """
+
+    orchestrator = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/jobs":
+            return self._reply(404, dict(error=f"Unknown path {url.path}"))
+        filters = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self._reply(200, self.orchestrator.status(**filters))
+
+    def do_POST(self):
+        parts = urlparse(self.path).path.strip("/").split("/")
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or "{}")
+        try:
+            if parts == ["jobs"]:
+                reply = self.orchestrator.submit(**body)
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "cancel":
+                reply = self.orchestrator.cancel(parts[1], user=body.get("user"))
+            else:
+                return self._reply(404, dict(error=f"Unknown path {self.path}"))
+        except KeyError as error:
+            return self._reply(404, dict(error=str(error.args[0])))
+        except (TypeError, ValueError) as error:
+            return self._reply(400, dict(error=str(error)))
+        self._reply(200, reply)
+
+    def _reply(self, code, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(orchestrator, address=None):
+    """Run the orchestrator, and answer the HTTP API until interrupted."""
+    host, port = (address or get_address()).rsplit(":", 1)
+    handler = type("Handler", (_Handler,), dict(orchestrator=orchestrator))
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    thread = threading.Thread(target=orchestrator.run, daemon=True)
+    thread.start()
+    print(f"Orchestrator listening on {host}:{port} with {orchestrator.slots} slots")
+    # Stop the same way on kill as on Ctrl-C. The running subjects carry on, and keep
+    # their slots in the next orchestrator until they end.
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        orchestrator.stop()
+        server.server_close()
+        thread.join()
+
+
+def request(method, path, data=None, address=None):
+    """Call the HTTP API of a running orchestrator, and return its reply."""
+    url = f"http://{address or get_address()}{path}"
+    body = None if data is None else json.dumps(data).encode()
+    req = Request(url, data=body, method=method, headers={"Content-Type": "application/json"})
+    try:
+        with urlopen(req) as response:
+            return json.loads(response.read())
+    except HTTPError as error:
+        raise RuntimeError(json.loads(error.read()).get("error", str(error))) from error
+    except URLError as error:
+        raise RuntimeError(
+            f"No orchestrator at {address or get_address()}. Start one with: python orchestrator.py serve"
+        ) from error
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def _container_prefix(job):
+    """Return the start of the container names of a job, see :func:`utils.docker.run_nibabies`."""
+    return f"nibabies-{job['project']}-sub-{job['subject']}-ses-{job['session']}-"
+
+
+def _now():
+    return datetime.now().isoformat(timespec="seconds")
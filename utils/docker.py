@@ -1,16 +1,36 @@
 import subprocess
+import sys
+from datetime import datetime
 from pathlib import Path
 
 from pprint import pprint as pp
 
+from .config import get_local_root
+from .tracing import span
 
-def run_docker_command(command):
-    """Run a docker command."""
+
+def run_docker_command(command, container_name=None, monitor_interval_s=None, **labels):
+    """Run a docker command, and return its exit code.
+
+    If ``container_name`` is the ``--name`` of the container, its CPU, memory, I/O
+    and PIDs are sampled every ``monitor_interval_s`` seconds while it runs, and
+    saved to the ``runs`` ledger with ``labels``, see :func:`~utils.monitor.monitored_run`.
+    """
     print("\nRunning Docker command:\n"
           f"    {command}"
           )
     print("\n")
-    subprocess.run(command, shell=True)
+    from .monitor import monitored_run  # see the note in run_nibabies
+
+    with span("docker run", category="container", command=command):
+        returncode, _ = monitored_run(
+            command,
+            shell=True,
+            container_name=container_name,
+            interval_s=monitor_interval_s,
+            **labels,
+            )
+    return returncode
 
 def run_nibabies(
         subject,
@@ -24,7 +44,13 @@ def run_nibabies(
         nibabies_path=None,
         freesurfer_license=None,
         anat_only=False,
-        verbose=True
+        verbose=True,
+        monitor_interval_s=None,
+        resource_monitor=True,
+        concurrent=1,
+        resource_plan=None,
+        escalate=0,
+        check=False,
         ):
     """Run Nibabies on a subject.
     
@@ -39,7 +65,9 @@ def run_nibabies(
     surface_recon_method : str
         The surface reconstruction method. For example, "mcribs", or "freesurfer".
     root : str, optional
-        The root directory. Default is None, which uses "/Users/sealab/MRI_Processing".
+        The root directory. Default is None, which uses the ``MRI_LOCAL_ROOT``
+        environment variable, or this repository ("/Users/sealab/MRI_Processing" on
+        the Whale computer).
     use_precomputed : bool, optional
         Whether to use precomputed derivatives. Default is True.
     version : str, optional
@@ -53,24 +81,73 @@ def run_nibabies(
         "/Users/sealab/devel/repos/nibabies/nibabies". Only used if use_dev is True.
     freesurfer_license : str, optional
         The path to the FreeSurfer licence file. Default is None, which uses
-        "/Applications/freesurfer/7.1.1/license.txt".
+        the license file in ``utils/assets``.
     anat_only : bool, optional
         If true, only run the anatomical processing. Default is False.
     verbose : bool, optional
         If true, run Nibabies in Verbose mode, to print more information. Default is True.
+    monitor_interval_s : float, optional
+        Seconds between two samples of the container's resource usage. Default is None,
+        which uses the ``MRI_MONITOR_INTERVAL_S`` environment variable, or 10 seconds.
+        0 turns the sampling off.
+    resource_monitor : bool, optional
+        If true, Nipype records the runtime, peak memory and CPU usage of each node
+        in the work directory (``--resource-monitor``), see :mod:`utils.nodes`.
+        Default is True.
+    concurrent : int, optional
+        The number of subjects that run at the same time on this computer. The CPUs
+        and memory are divided between them. Default is 1.
+    resource_plan : dict, optional
+        The ``--nprocs``, ``--omp-nthreads`` and ``--mem-mb`` of Nibabies and the
+        ``--cpus`` and ``--memory`` of the container. Default is None, which uses
+        :func:`utils.resources.plan_resources`. Pass ``{}`` to set no limits.
+    escalate : int, optional
+        How many times this subject already ran out of memory. The resource plan
+        gets fewer processes and more memory, see :func:`utils.resources.escalate_plan`.
+        Default is 0.
+    check : bool, optional
+        If true, raise a :class:`utils.errors.StageError` that says why the container
+        failed, instead of returning its non-zero exit code. Default is False.
+
+    Returns
+    -------
+    returncode : int
+        The exit code of ``docker run``.
     """
+    # utils.monitor and utils.resources are also run as scripts (python -m ...), so
+    # they are not imported when the package is.
+    from .errors import container_error
+    from .predict import subject_features
+    from .resources import docker_args, escalate_plan, nibabies_args, plan_resources
+
     if root is None:
-        root = "/Users/sealab/MRI_Processing"
+        root = get_local_root()
+    if resource_plan is None:
+        # Docker Desktop runs the containers in a VM, with less than this computer
+        resource_plan = plan_resources(concurrent, launcher="docker")
+        if escalate:
+            resource_plan = escalate_plan(resource_plan, escalate, launcher="docker")
+        for note in resource_plan["notes"]:
+            print(f"Resource plan: {note}")
     if freesurfer_license is None:
-        freesurfer_license = Path("./utils/assets/license.txt").resolve()
+        freesurfer_license = (Path(__file__).parent / "assets" / "license.txt").resolve()
         assert freesurfer_license.exists()
 
+    # Each subject has its own work directory, so that subjects that run at the same
+    # time (or the clean up of one of them) do not touch each other's Nipype nodes
+    work_dir = Path(f"{root}/{project}/MRI/{session}/derivatives/work/nibabies_work/sub-{subject}")
+    work_dir.mkdir(parents=True, exist_ok=True)
+    container_name = f"nibabies-{project}-sub-{subject}-ses-{session}-{datetime.now():%Y%m%d%H%M%S}"
     command = [
         "docker", "run",
-        "-it",
+        # A terminal only when there is one: the orchestrator and the dispatcher run
+        # this without, and docker refuses -t then
+        *(["-it"] if sys.stdin.isatty() else []),
+        "--name", container_name,
+        *(docker_args(resource_plan) if resource_plan else []),
         "-v", f"{root}/{project}/MRI/{session}/bids:/data:ro",
         "-v", f"{root}/{project}/MRI/{session}/derivatives/Nibabies:/out",
-        "-v", f"{root}/{project}/MRI/{session}/derivatives/work/nibabies_work:/scratch",
+        "-v", f"{work_dir}:/scratch",
         "-v", f"{freesurfer_license}:/opt/freesurfer/license.txt:ro",
         ]
     if use_precomputed:
@@ -107,4 +184,46 @@ def run_nibabies(
         command.extend([
             "--verbose",
             ])
-    run_docker_command(" ".join(command))
+    if resource_monitor:
+        command.extend([
+            "--resource-monitor",
+            ])
+    if resource_plan:
+        command.extend(nibabies_args(resource_plan))
+    try:
+        # Saved with the run record, to train the runtime predictions
+        features = subject_features(
+            project,
+            subject,
+            session,
+            surface_recon_method=surface_recon_method,
+            anat_only=anat_only,
+            bids_dir=f"{root}/{project}/MRI/{session}/bids",
+            )
+    except OSError as error:
+        print(f"Could not read the input features of sub-{subject}: {error}")
+        features = None
+    try:
+        returncode = run_docker_command(
+            " ".join(command),
+            container_name=container_name,
+            monitor_interval_s=monitor_interval_s,
+            tool="nibabies",
+            project=project,
+            subject=subject,
+            session=session,
+            surface_recon_method=surface_recon_method,
+            anat_only=anat_only,
+            features=features,
+            omp_nthreads=resource_plan["omp_nthreads"] if resource_plan else None,
+            )
+        if check and returncode != 0:
+            raise container_error(container_name, returncode)
+    finally:
+        # Each run has its own container name, so the stopped containers would pile
+        # up. Not forced: a container that still runs is left alone.
+        try:
+            subprocess.run(["docker", "rm", container_name], capture_output=True)
+        except OSError:
+            pass
+    return returncode
@@ -0,0 +1,212 @@
+"""Classify why a stage of a subject failed, and retry the failures that a retry can fix.
+
+A failure is one of:
+
+- ``network``: the connection to the server dropped or timed out. Retried with
+  a growing wait, except for rsync, which already retried each command (see
+  :func:`utils.utils.do_rsync`).
+- ``out_of_memory``: the container was killed for using too much memory.
+  Retried with fewer Nipype processes and more memory (see
+  :func:`utils.resources.escalate_plan`). Nibabies picks up from its work
+  directory, so a retry does not start over.
+- ``container_crash``: the container failed for another reason, for example a
+  Nipype node crashed. Retried once.
+- ``disk_full``: there is no space left on a disk. Not retried, since it needs
+  someone to free space.
+- ``input_error``: the inputs are missing or invalid, for example no T2w image.
+  Not retried, since it would fail the same way.
+- ``unknown``: anything else. Not retried.
+
+:func:`run_stage` runs a stage with these retries, and saves every failure to the
+``failures`` ledger. When it gives up it raises a :class:`StageError`, so the
+later stages of the subject (for example pushing incomplete outputs) do not run.
+"""
+
+import errno
+import re
+import socket
+import subprocess
+import time
+from pathlib import Path
+from warnings import warn
+
+from .ledger import append_record
+from .metrics import current_context
+from .tracing import span
+from .transfer import RsyncError
+
+# How many times each kind of failure is retried, and how long to wait before the
+# first retry. The wait doubles before each of the next ones.
+RETRY_POLICY = {
+    "network": {"retries": 3, "backoff_s": 300},
+    "out_of_memory": {"retries": 2, "backoff_s": 0},
+    "container_crash": {"retries": 1, "backoff_s": 60},
+    "disk_full": {"retries": 0, "backoff_s": 0},
+    "input_error": {"retries": 0, "backoff_s": 0},
+    "unknown": {"retries": 0, "backoff_s": 0},
+}
+# Lines of the container log that tell why it failed, checked in this order
+LOG_SIGNATURES = [
+    ("disk_full", re.compile(r"No space left on device|Disk quota exceeded")),
+    (
+        "out_of_memory",
+        re.compile(r"MemoryError|Cannot allocate memory|std::bad_alloc|OOMKilled|Out of memory"),
+    ),
+    (
+        "input_error",
+        re.compile(
+            r"BIDSValidationError|is not a valid BIDS|No (?:T1w|T2w|anatomical) images? found"
+            r"|[Pp]articipant label\(?s?\)? .*not found|pull access denied|manifest unknown"
+        ),
+    ),
+    ("network", re.compile(r"Temporary failure in name resolution|Connection (?:reset|refused|timed out)")),
+]
+# ssh exits with 255 when the connection failed, whatever the remote command returned
+SSH_CONNECTION_EXIT_CODE = 255
+# Exit codes of ``docker run``: the container command could not be run (126) or was
+# not found (127), or the container was killed with SIGKILL (137)
+DOCKER_INPUT_EXIT_CODES = {126, 127}
+DOCKER_KILLED_EXIT_CODE = 137
+
+
+class StageError(RuntimeError):
+    """Raised when a stage failed. ``kind`` is one of ``RETRY_POLICY``."""
+
+    def __init__(self, message, *, kind="unknown", stage=None, returncode=None):
+        self.kind = kind
+        self.stage = stage
+        self.returncode = returncode
+        super().__init__(message)
+
+
+def classify_exception(error):
+    """Return the kind of failure (see ``RETRY_POLICY``) of an exception."""
+    if isinstance(error, StageError):
+        return error.kind
+    if isinstance(error, RsyncError):
+        if error.transient:
+            return "network"
+        # rsync 11 is an error in file I/O, in practice a full disk on the receiving side
+        return "disk_full" if error.returncode == 11 else "input_error"
+    if isinstance(error, OSError) and error.errno in (errno.ENOSPC, errno.EDQUOT):
+        return "disk_full"
+    if isinstance(error, MemoryError) or (isinstance(error, OSError) and error.errno == errno.ENOMEM):
+        return "out_of_memory"
+    if isinstance(error, (ConnectionError, TimeoutError, socket.timeout, subprocess.TimeoutExpired)):
+        return "network"
+    if (
+        isinstance(error, subprocess.CalledProcessError)
+        and error.returncode == SSH_CONNECTION_EXIT_CODE
+        and isinstance(error.cmd, (list, tuple))
+        and error.cmd
+        and Path(error.cmd[0]).name == "ssh"
+    ):
+        return "network"
+    # The scripts assert that the paths they expect exist
+    if isinstance(error, (FileNotFoundError, AssertionError, ValueError, KeyError)):
+        return "input_error"
+    return "unknown"
+
+
+def classify_container(returncode, log_text="", oom_killed=False):
+    """Return the kind of failure of a container from its exit code and log, or None if it succeeded."""
+    if returncode == 0:
+        return None
+    if oom_killed:
+        return "out_of_memory"
+    for kind, pattern in LOG_SIGNATURES:
+        if pattern.search(log_text or ""):
+            return kind
+    if returncode in DOCKER_INPUT_EXIT_CODES:
+        return "input_error"
+    return "container_crash"
+
+
+def container_error(container_name, returncode, *, docker="docker", tail=200):
+    """Return a :class:`StageError` for a failed container, from ``docker inspect`` and ``docker logs``."""
+    oom_killed = False
+    log_text = ""
+    if container_name is not None:
+        inspect = subprocess.run(
+            [docker, "inspect", "--format", "{{.State.OOMKilled}}", container_name],
+            capture_output=True,
+            text=True,
+        )
+        oom_killed = inspect.stdout.strip() == "true"
+        log_text = subprocess.run(
+            [docker, "logs", "--tail", str(tail), container_name],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+        ).stdout
+    kind = classify_container(returncode, log_text, oom_killed=oom_killed)
+    if returncode == DOCKER_KILLED_EXIT_CODE and kind == "container_crash":
+        # Killed without a reason in the log, most likely by the kernel for memory
+        kind = "out_of_memory"
+    last_lines = "\n".join(log_text.strip().splitlines()[-5:])
+    message = f"{container_name} exited with code {returncode} ({kind})"
+    return StageError(
+        f"{message}:\n{last_lines}" if last_lines else message,
+        kind=kind,
+        returncode=returncode,
+    )
+
+
+def run_stage(stage, func, *, policy=None, escalate=False, **kwargs):
+    """Run ``func(**kwargs)``, retrying the failures that a retry can fix.
+
+    If ``escalate`` is True, after an ``out_of_memory`` failure ``func`` is
+    called again with ``escalate`` set to the number of such failures so far, so
+    it can ask for more memory. Otherwise it is called with the same arguments.
+    Returns what ``func`` returns. Raises a :class:`StageError` (with the
+    ``kind`` of the last failure) when the failure is not retried, or when the
+    retries are used up.
+    """
+    policy = RETRY_POLICY if policy is None else policy
+    failures = dict()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return func(**kwargs)
+        except Exception as error:
+            kind = classify_exception(error)
+            failures[kind] = failures.get(kind, 0) + 1
+            rule = policy.get(kind, policy["unknown"])
+            retries, backoff_s = rule["retries"], rule["backoff_s"]
+            if isinstance(error, RsyncError):
+                # do_rsync already retried the transient failures of each command
+                retries = 0
+            retry = failures[kind] <= retries
+            append_record(
+                "failures",
+                dict(
+                    current_context(),
+                    project=kwargs.get("project"),
+                    subject=kwargs.get("subject"),
+                    session=kwargs.get("session"),
+                    stage=stage,
+                    kind=kind,
+                    attempt=attempt,
+                    retry=retry,
+                    returncode=getattr(error, "returncode", None),
+                    error=str(error)[:1000],
+                ),
+            )
+            if not retry:
+                if isinstance(error, StageError) and error.stage is not None:
+                    raise
+                given_up = " after retrying" if retries else ""
+                raise StageError(
+                    f"{stage} failed{given_up} ({kind}): {error}",
+                    kind=kind,
+                    stage=stage,
+                    returncode=getattr(error, "returncode", None),
+                ) from error
+            if escalate and kind == "out_of_memory":
+                kwargs["escalate"] = failures[kind]
+            delay = backoff_s * 2 ** (failures[kind] - 1)
+            warn(f"{stage} failed ({kind}): {error}\nRetrying in {delay} seconds ({failures[kind]}/{retries}).")
+            if delay:
+                with span("retry backoff", category="wait", stage=stage, kind=kind, delay_s=delay):
+                    time.sleep(delay)
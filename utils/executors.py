@@ -0,0 +1,512 @@
+"""Split a cohort between the Whale computer and the ACCRE cluster, and track it.
+
+Each place that can run Nibabies is an executor: :class:`WhaleExecutor` runs
+``00_process_subjects.py`` (Docker, with the server mounted) for a few subjects at
+a time, and :class:`SlurmExecutor` submits job arrays with :mod:`utils.slurm`
+(Singularity, pulling from the server through Whale). The dispatcher predicts the
+runtime of each subject (see :mod:`utils.predict`), and gives the longest subjects
+out first, each to the executor where it would finish first, given the work
+already queued there, the free slots, and how fast and how far from the data
+each executor is. The cohort then finishes in about the shortest combined wall
+time. The state of each subject is saved to the ``dispatch`` ledger::
+
+    python -m utils.executors --project BABIES --session newborn --subjects 1462 1470 1500 \\
+        --whale-slots 2 --slurm-slots 10 --ip-address XX.X.XXX.XXX --username "SEALAB_USERNAME"
+    python -m utils.executors --status
+
+The ``docker``, ``sbatch``, ``squeue`` and ``sacct`` commands can be replaced by
+the stubs in ``benchmarks/stubs`` to try it out.
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+from . import ledger
+from .config import get_local_root
+from .ledger import append_record, read_records
+
+REPO_DIR = Path(__file__).parent.parent
+# The final states of sacct that mean that a task will not succeed
+FAILED_STATES = {"FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE"}
+
+
+def get_squeue():
+    """Return the squeue command, from the ``MRI_SQUEUE`` environment variable."""
+    return os.environ.get("MRI_SQUEUE", "squeue")
+
+
+class Executor:
+    """A place that runs subjects.
+
+    Parameters
+    ----------
+    slots : int
+        How many subjects may run at the same time.
+    speed : float
+        How long a subject takes here, relative to the predicted runtime. For
+        example 1.5 if the CPUs are slower.
+    overhead_s : float
+        Seconds added to each subject, for example to move its files.
+    """
+
+    name = None
+
+    def __init__(self, slots=1, speed=1.0, overhead_s=0.0):
+        self.slots = slots
+        self.speed = speed
+        self.overhead_s = overhead_s
+
+    def queued(self):
+        """Return how many subjects are already running or waiting here."""
+        return 0
+
+    def submit(self, project, subjects, session, *, surface_recon_method, anat_only):
+        """Start (or queue) the subjects."""
+        raise NotImplementedError
+
+    def poll(self):
+        """Return the status of each submitted subject: running, done or failed."""
+        raise NotImplementedError
+
+
+class WhaleExecutor(Executor):
+    """Run subjects on this computer with ``00_process_subjects.py``, ``slots`` at a time.
+
+    Each subject runs in its own process, with its output in
+    ``logs/dispatch/sub-{subject}.log``. ``extra_args`` are passed to each process,
+    for example ``["--transfer-profile", "lan"]``.
+    """
+
+    name = "whale"
+
+    def __init__(self, slots=1, speed=1.0, overhead_s=0.0, extra_args=(), docker="docker"):
+        super().__init__(slots, speed, overhead_s)
+        self.extra_args = list(extra_args)
+        self.docker = docker
+        self.waiting = []
+        self.processes = dict()
+        self.status = dict()
+
+    def queued(self):
+        """Count the Nibabies containers that run on this computer now."""
+        try:
+            output = subprocess.run(
+                [self.docker, "ps", "--filter", "name=nibabies-", "--format", "{{.Names}}"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return 0
+        return len(output.split())
+
+    def submit(self, project, subjects, session, *, surface_recon_method, anat_only):
+        for subject in subjects:
+            command = [
+                sys.executable,
+                str(REPO_DIR / "00_process_subjects.py"),
+                "--project", project,
+                "--subjects", subject,
+                "--session", session,
+                "--surface-recon-method", surface_recon_method,
+                "--concurrent", str(self.slots),
+            ]
+            if anat_only:
+                command.append("--anat_only")
+            self.waiting.append((subject, command + self.extra_args))
+            self.status[subject] = "waiting"
+        self._start()
+
+    def _start(self):
+        log_dir = ledger.LEDGER_DIR / "dispatch"
+        log_dir.mkdir(parents=True, exist_ok=True)
+        while self.waiting and sum(status == "running" for status in self.status.values()) < self.slots:
+            subject, command = self.waiting.pop(0)
+            with open(log_dir / f"sub-{subject}.log", "w") as log:
+                # The scripts expect to run from the local root, see utils/config.py
+                self.processes[subject] = subprocess.Popen(
+                    command,
+                    cwd=get_local_root(),
+                    stdin=subprocess.DEVNULL,
+                    stdout=log,
+                    stderr=subprocess.STDOUT,
+                )
+            self.status[subject] = "running"
+
+    def poll(self):
+        for subject, process in self.processes.items():
+            if self.status[subject] == "running" and process.poll() is not None:
+                self.status[subject] = "done" if process.returncode == 0 else "failed"
+        self._start()
+        return {
+            subject: "running" if status == "waiting" else status
+            for subject, status in self.status.items()
+        }
+
+
+class SlurmExecutor(Executor):
+    """Submit subjects to SLURM as chained job arrays, see :func:`utils.slurm.submit_cohort`.
+
+    ``slots`` is the number of Nibabies tasks that may run at the same time (the
+    throttle of the array). The default ``overhead_s`` accounts for pulling and
+    pushing the files through Whale.
+    """
+
+    name = "slurm"
+
+    def __init__(
+        self,
+        slots=10,
+        speed=1.0,
+        overhead_s=1800.0,
+        *,
+        ip_address=None,
+        username=None,
+        sbatch=None,
+        squeue=None,
+        sacct=None,
+    ):
+        super().__init__(slots, speed, overhead_s)
+        self.ip_address = ip_address
+        self.username = username
+        self.sbatch = sbatch
+        self.squeue = squeue
+        self.sacct = sacct
+        self.job_ids = dict()
+        self.subjects = []
+
+    def queued(self):
+        """Count our jobs that are running or pending on the cluster."""
+        try:
+            output = subprocess.run(
+                [self.squeue or get_squeue(), "--noheader", "--me", "--format=%i"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        except (OSError, subprocess.CalledProcessError):
+            return 0
+        return len(output.split())
+
+    def submit(self, project, subjects, session, *, surface_recon_method, anat_only):
+        from .slurm import submit_cohort
+
+        self.subjects = list(subjects)
+        self.job_ids = submit_cohort(
+            project,
+            self.subjects,
+            session,
+            surface_recon_method=surface_recon_method,
+            anat_only=anat_only,
+            ip_address=self.ip_address,
+            username=self.username,
+            throttle={"nibabies": self.slots},
+            sbatch=self.sbatch,
+        )
+
+    def poll(self):
+        from .accounting import parse_sacct, query_sacct
+
+        jobs = parse_sacct(query_sacct(job_ids=list(self.job_ids.values()), sacct=self.sacct))
+        last_stage = list(self.job_ids)[-1]
+        status = dict()
+        for task, subject in enumerate(self.subjects):
+            states = {
+                stage: jobs.get(f"{job_id}_{task}", {}).get("state")
+                for stage, job_id in self.job_ids.items()
+            }
+            if any(state in FAILED_STATES for state in states.values()):
+                status[subject] = "failed"
+            elif states[last_stage] == "COMPLETED":
+                status[subject] = "done"
+            else:
+                status[subject] = "running"
+        return status
+
+
+def predict_runtimes(project, subjects, session, *, surface_recon_method="freesurfer", anat_only=False):
+    """Return the predicted Nibabies runtime of each subject, in seconds."""
+    from .predict import load_predictor, predict, subject_features
+
+    predictor = load_predictor("nibabies")
+    method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
+    return {
+        subject: predict(
+            subject_features(project, subject, session, surface_recon_method=method, anat_only=anat_only),
+            predictor=predictor,
+        )["elapsed_s"]
+        for subject in subjects
+    }
+
+
+def plan_dispatch(runtimes, executors, queued=None):
+    """Assign each subject to the executor where it would finish first.
+
+    The longest subjects are placed first (longest processing time first). Each
+    executor has ``slots`` parallel lanes, which start out busy with the work it
+    already has: ``queued[name]`` subjects of average length.
+
+    Parameters
+    ----------
+    runtimes : dict
+        The predicted seconds of each subject, see :func:`predict_runtimes`.
+    executors : list of Executor
+    queued : dict, optional
+        The number of subjects already queued on each executor. Default is None,
+        which asks each executor (see :meth:`Executor.queued`).
+
+    Returns
+    -------
+    assignment : dict
+        The subjects of each executor, by name, longest first.
+    finish_s : dict
+        The predicted seconds until each executor is done.
+    """
+    mean_s = sum(runtimes.values()) / len(runtimes) if runtimes else 0.0
+    lanes = dict()
+    for executor in executors:
+        n_queued = executor.queued() if queued is None else queued.get(executor.name, 0)
+        busy_s = n_queued * (mean_s * executor.speed + executor.overhead_s) / executor.slots
+        lanes[executor.name] = [busy_s] * executor.slots
+    assignment = {executor.name: [] for executor in executors}
+    for subject in sorted(runtimes, key=runtimes.get, reverse=True):
+        best, best_finish = None, None
+        for executor in executors:
+            start = min(lanes[executor.name])
+            finish = start + runtimes[subject] * executor.speed + executor.overhead_s
+            if best_finish is None or finish < best_finish:
+                best, best_finish = executor, finish
+        lane = lanes[best.name].index(min(lanes[best.name]))
+        lanes[best.name][lane] = best_finish
+        assignment[best.name].append(subject)
+    finish_s = {
+        name: max(lane_s) if assignment[name] else 0.0 for name, lane_s in lanes.items()
+    }
+    return assignment, finish_s
+
+
+def relative_speed(records=None, min_runs=3):
+    """Return how much longer Nibabies takes on SLURM than on Whale, from past runs.
+
+    Runs with a ``slurm_job_id`` ran on the cluster. Returns 1.0 if either place
+    has fewer than ``min_runs`` successful runs.
+    """
+    from .monitor import unique_runs
+
+    if records is None:
+        records = read_records("runs", tool="nibabies")
+    records = [
+        record
+        for record in unique_runs(records)
+        if record.get("returncode") == 0 and record.get("elapsed_s")
+    ]
+    slurm = [record["elapsed_s"] for record in records if record.get("slurm_job_id")]
+    whale = [record["elapsed_s"] for record in records if not record.get("slurm_job_id")]
+    if len(slurm) < min_runs or len(whale) < min_runs:
+        return 1.0
+    return round((sum(slurm) / len(slurm)) / (sum(whale) / len(whale)), 2)
+
+
+def dispatch(
+    project,
+    subjects,
+    session,
+    executors,
+    *,
+    surface_recon_method="freesurfer",
+    anat_only=False,
+    runtimes=None,
+    poll_s=60,
+    wait=True,
+):
+    """Split the subjects between the executors, run them, and track them to the end.
+
+    Parameters
+    ----------
+    executors : list of Executor
+        For example ``[WhaleExecutor(slots=2), SlurmExecutor(slots=10, ...)]``.
+    runtimes : dict, optional
+        The predicted seconds of each subject. Default is None, which uses
+        :func:`predict_runtimes`.
+    poll_s : float
+        Seconds between two checks of the executors.
+    wait : bool
+        If False, return after submitting. Default is True.
+
+    Returns
+    -------
+    status : dict
+        The final status of each subject: done or failed (or running, if not
+        ``wait``). Every change is saved to the ``dispatch`` ledger.
+    """
+    subjects = [str(subject) for subject in subjects]
+    if runtimes is None:
+        runtimes = predict_runtimes(
+            project, subjects, session, surface_recon_method=surface_recon_method, anat_only=anat_only
+        )
+    assignment, finish_s = plan_dispatch(runtimes, executors)
+    batch = f"{datetime.now():%Y%m%d-%H%M%S}"
+    labels = dict(batch=batch, project=project, session=session)
+    for executor in executors:
+        assigned = assignment[executor.name]
+        print(
+            f"{executor.name}: {len(assigned)} subjects, done in about"
+            f" {finish_s[executor.name] / 3600:.1f} h"
+        )
+        if not assigned:
+            continue
+        for subject in assigned:
+            append_record(
+                "dispatch",
+                dict(
+                    labels,
+                    subject=subject,
+                    executor=executor.name,
+                    status="submitted",
+                    predicted_s=round(runtimes[subject]),
+                ),
+            )
+        executor.submit(
+            project, assigned, session, surface_recon_method=surface_recon_method, anat_only=anat_only
+        )
+
+    status = {subject: "running" for subject in subjects}
+    owner = {subject: name for name, assigned in assignment.items() for subject in assigned}
+    while True:
+        for executor in executors:
+            if not assignment[executor.name]:
+                continue
+            for subject, new_status in executor.poll().items():
+                if new_status != status.get(subject):
+                    status[subject] = new_status
+                    append_record(
+                        "dispatch",
+                        dict(labels, subject=subject, executor=owner[subject], status=new_status),
+                    )
+                    print(f"sub-{subject} on {owner[subject]}: {new_status}")
+        if not wait or all(value in {"done", "failed"} for value in status.values()):
+            break
+        time.sleep(poll_s)
+    return status
+
+
+def dispatch_status(**filters):
+    """Return the latest record of each subject in the ``dispatch`` ledger."""
+    latest = dict()
+    for record in read_records("dispatch", **filters):
+        latest[(record.get("batch"), record["subject"])] = record
+    return list(latest.values())
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a cohort on Whale and ACCRE at the same time.")
+    parser.add_argument("--project", choices=["BABIES", "ABC"])
+    parser.add_argument("--session", choices=["newborn", "sixmonth"])
+    parser.add_argument("--subjects", nargs="+", help="Space separated subject labels.")
+    parser.add_argument(
+        "--surface-recon-method",
+        default="freesurfer",
+        choices=["freesurfer", "mcribs"],
+        dest="surface_recon_method",
+    )
+    parser.add_argument("--anat-only", action="store_true", dest="anat_only")
+    parser.add_argument(
+        "--whale-slots",
+        type=int,
+        default=1,
+        dest="whale_slots",
+        help="Subjects that run at the same time on Whale. 0 does not use Whale.",
+    )
+    parser.add_argument(
+        "--whale-args",
+        default="",
+        dest="whale_args",
+        help="Extra arguments for 00_process_subjects.py, for example '--transfer-profile lan'.",
+    )
+    parser.add_argument(
+        "--slurm-slots",
+        type=int,
+        default=10,
+        dest="slurm_slots",
+        help="Nibabies tasks that run at the same time on ACCRE. 0 does not use ACCRE.",
+    )
+    parser.add_argument(
+        "--slurm-speed",
+        type=float,
+        default=None,
+        dest="slurm_speed",
+        help="How much longer a subject takes on ACCRE than on Whale. Default is"
+        " estimated from past runs.",
+    )
+    parser.add_argument(
+        "--slurm-overhead",
+        type=float,
+        default=1800,
+        dest="slurm_overhead_s",
+        help="Seconds added to each subject on ACCRE for the transfers. Default is 1800.",
+    )
+    parser.add_argument("--ip-address", dest="ip_address", default=None)
+    parser.add_argument("--username", dest="username", default=None)
+    parser.add_argument("--poll", type=float, default=60, dest="poll_s")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="Print the assignment of the subjects without running them.",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Print the latest status of each dispatched subject, and exit.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    if args["status"]:
+        for record in dispatch_status():
+            print(
+                f"{record.get('batch')}  sub-{record['subject']:<8} {record['executor']:<6}"
+                f" {record['status']:<10} {record['timestamp']}"
+            )
+        return 0
+    if not (args["project"] and args["session"] and args["subjects"]):
+        raise SystemExit("--project, --session and --subjects are required")
+    executors = []
+    if args["whale_slots"] > 0:
+        executors.append(
+            WhaleExecutor(slots=args["whale_slots"], extra_args=shlex.split(args["whale_args"]))
+        )
+    if args["slurm_slots"] > 0:
+        executors.append(
+            SlurmExecutor(
+                slots=args["slurm_slots"],
+                speed=args["slurm_speed"] if args["slurm_speed"] is not None else relative_speed(),
+                overhead_s=args["slurm_overhead_s"],
+                ip_address=args["ip_address"],
+                username=args["username"],
+            )
+        )
+    if not executors:
+        raise SystemExit("Use at least one of Whale and ACCRE")
+    options = dict(surface_recon_method=args["surface_recon_method"], anat_only=args["anat_only"])
+    if args["plan"]:
+        runtimes = predict_runtimes(args["project"], args["subjects"], args["session"], **options)
+        assignment, finish_s = plan_dispatch(runtimes, executors)
+        for name, subjects in assignment.items():
+            print(f"{name} ({finish_s[name] / 3600:.1f} h): {' '.join(subjects)}")
+        return 0
+    status = dispatch(
+        args["project"], args["subjects"], args["session"], executors, poll_s=args["poll_s"], **options
+    )
+    return 0 if all(value == "done" for value in status.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,363 @@
+"""Keep the Singularity images of the pipeline in a shared cache of ``.sif`` files.
+
+Running ``singularity run docker://...`` converts the Docker image again in every
+job, and fails when the registry cannot be reached from the compute nodes.
+Instead, each image is built once into the cache, from the image digest that the
+tag pointed to when it was first pinned, and every job runs the cached file::
+
+    IMAGE=$(python -m utils.images path nibabies)
+
+Builds are serialized with a lock file, so that jobs that start together do not
+build the same image twice. Each ``.sif`` has a ``.sha256`` sidecar (in the format
+of ``sha256sum``) and a ``.json`` sidecar with its source, digest and last use,
+which is used to evict the versions that were not used for the longest time::
+
+    python -m utils.images list
+    python -m utils.images evict --keep 2
+"""
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import urllib.request
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# Docker images are built into the cache. File images (already built .sif files)
+# are used where they are, and only their checksum is pinned.
+IMAGES = {
+    "nibabies": {"source": "docker://nipreps/nibabies", "tag": "23.1.0"},
+    "bibsnet": {"path": "/gpfs51/dors2/l3_humphreys_lab/dev/images/bibsnet_fork.sif"},
+}
+DEFAULT_CACHE_DIR = Path(__file__).parent.parent / "images"
+REGISTRY_TIMEOUT_S = 20
+
+
+def get_cache_dir():
+    """Return the image cache, from the ``MRI_IMAGE_CACHE`` environment variable."""
+    return Path(os.environ.get("MRI_IMAGE_CACHE", DEFAULT_CACHE_DIR))
+
+
+def get_singularity():
+    """Return the singularity command, from the ``MRI_SINGULARITY`` environment variable."""
+    return os.environ.get("MRI_SINGULARITY", "singularity")
+
+
+@contextmanager
+def locked(fpath):
+    """Hold an exclusive lock on ``fpath`` (created if needed), waiting for it if needed."""
+    fpath = Path(fpath)
+    fpath.parent.mkdir(parents=True, exist_ok=True)
+    with fpath.open("a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def sha256sum(fpath, chunk_size=2**24):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(fpath, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def resolve_digest(source, tag):
+    """Return the digest (``sha256:...``) that a Docker Hub tag points to.
+
+    Raises OSError if the registry cannot be reached.
+    """
+    repository = source[len("docker://"):] if source.startswith("docker://") else source
+    if repository.count("/") != 1:
+        raise ValueError(f"Only Docker Hub images (user/name) can be pinned, but got: {source}")
+    token_url = (
+        "https://auth.docker.io/token?service=registry.docker.io"
+        f"&scope=repository:{repository}:pull"
+    )
+    with urllib.request.urlopen(token_url, timeout=REGISTRY_TIMEOUT_S) as response:
+        token = json.load(response)["token"]
+    request = urllib.request.Request(
+        f"https://registry-1.docker.io/v2/{repository}/manifests/{tag}",
+        method="HEAD",
+        headers={
+            "Authorization": f"Bearer {token}",
+            "Accept": ", ".join(
+                [
+                    "application/vnd.oci.image.index.v1+json",
+                    "application/vnd.docker.distribution.manifest.list.v2+json",
+                    "application/vnd.docker.distribution.manifest.v2+json",
+                ]
+            ),
+        },
+    )
+    with urllib.request.urlopen(request, timeout=REGISTRY_TIMEOUT_S) as response:
+        return response.headers["Docker-Content-Digest"]
+
+
+def _read_json(fpath):
+    fpath = Path(fpath)
+    if not fpath.exists():
+        return dict()
+    with fpath.open("r") as file:
+        return json.load(file)
+
+
+def _write_json(fpath, data):
+    tmp = Path(f"{fpath}.tmp")
+    with tmp.open("w") as file:
+        json.dump(data, file, indent=2, default=str)
+    os.replace(tmp, fpath)
+
+
+def read_pins(cache_dir=None):
+    """Return the pinned digest of each ``name:tag``, see :func:`pin_image`."""
+    return _read_json((get_cache_dir() if cache_dir is None else Path(cache_dir)) / "pins.json")
+
+
+def pin_image(name, tag=None, *, cache_dir=None, digest=None):
+    """Pin the digest that an image tag points to now, and return it.
+
+    Later builds of this tag use the pinned digest, even if the tag is pushed
+    again. ``digest`` can be given to pin a known digest without asking the
+    registry.
+    """
+    cache_dir = get_cache_dir() if cache_dir is None else Path(cache_dir)
+    spec = IMAGES[name]
+    tag = spec["tag"] if tag is None else tag
+    if digest is None:
+        digest = resolve_digest(spec["source"], tag)
+    with locked(cache_dir / "pins.lock"):
+        pins = read_pins(cache_dir)
+        pins[f"{name}:{tag}"] = digest
+        _write_json(cache_dir / "pins.json", pins)
+    return digest
+
+
+def _sidecars(sif):
+    return Path(f"{sif}.sha256"), Path(f"{sif}.json")
+
+
+def _write_sidecars(sif, metadata):
+    checksum_file, metadata_file = _sidecars(sif)
+    stat = Path(sif).stat()
+    metadata.update(
+        sha256=sha256sum(sif),
+        size=stat.st_size,
+        mtime=stat.st_mtime,
+        last_used=datetime.now().isoformat(timespec="seconds"),
+    )
+    checksum_file.write_text(f"{metadata['sha256']}  {Path(sif).name}\n")
+    _write_json(metadata_file, metadata)
+    return metadata
+
+
+def verify_image(sif, full=False):
+    """Check a cached image against its sidecars, and return True if it matches.
+
+    The quick check (default) compares the size and modification time of the file
+    with the ones recorded when it was built. ``full`` hashes the whole file.
+    """
+    sif = Path(sif)
+    checksum_file, metadata_file = _sidecars(sif)
+    if not sif.exists() or not checksum_file.exists() or not metadata_file.exists():
+        return False
+    metadata = _read_json(metadata_file)
+    stat = sif.stat()
+    if stat.st_size != metadata.get("size") or stat.st_mtime != metadata.get("mtime"):
+        return False
+    if full:
+        return sha256sum(sif) == checksum_file.read_text().split()[0]
+    return True
+
+
+def _touch(sif):
+    metadata_file = _sidecars(sif)[1]
+    metadata = _read_json(metadata_file)
+    metadata["last_used"] = datetime.now().isoformat(timespec="seconds")
+    _write_json(metadata_file, metadata)
+
+
+def _file_image(name, spec, cache_dir, full):
+    """Check an already built image against the checksum pinned in the cache."""
+    sif = Path(spec["path"])
+    if not sif.exists():
+        raise FileNotFoundError(f"Image file not found: {sif}")
+    pin_file = cache_dir / f"{name}.json"
+    with locked(cache_dir / f"{name}.lock"):
+        pinned = _read_json(pin_file)
+        stat = sif.stat()
+        unchanged = (
+            pinned.get("path") == str(sif)
+            and pinned.get("size") == stat.st_size
+            and pinned.get("mtime") == stat.st_mtime
+        )
+        if not pinned or full or not unchanged:
+            sha256 = sha256sum(sif)
+            if pinned.get("sha256") and sha256 != pinned["sha256"]:
+                raise RuntimeError(
+                    f"{sif} changed since it was pinned (sha256 {pinned['sha256'][:12]} ->"
+                    f" {sha256[:12]}). If the new image is intended, run:"
+                    f" python -m utils.images pin {name}"
+                )
+            pinned.update(path=str(sif), sha256=sha256, size=stat.st_size, mtime=stat.st_mtime)
+        pinned["last_used"] = datetime.now().isoformat(timespec="seconds")
+        _write_json(pin_file, pinned)
+    return sif
+
+
+def ensure_image(name, tag=None, *, cache_dir=None, full=False, singularity=None):
+    """Return the path of the cached ``.sif`` of an image, building it if needed.
+
+    Parameters
+    ----------
+    name : str
+        A key of ``IMAGES``, for example ``"nibabies"``.
+    tag : str, optional
+        The image tag. Default is None, which uses the tag of ``IMAGES``.
+    cache_dir : path-like, optional
+        Default is None, which uses :func:`get_cache_dir`.
+    full : bool
+        If True, hash the whole image to verify it. Default is False, which only
+        compares its size and modification time with its sidecar.
+    singularity : str, optional
+        The singularity command. Default is None, which uses :func:`get_singularity`.
+
+    Returns
+    -------
+    sif : pathlib.Path
+        The image to run.
+    """
+    cache_dir = get_cache_dir() if cache_dir is None else Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    spec = IMAGES[name]
+    if "path" in spec:
+        return _file_image(name, spec, cache_dir, full)
+    tag = spec["tag"] if tag is None else tag
+
+    with locked(cache_dir / f"{name}_{tag}.lock"):
+        digest = read_pins(cache_dir).get(f"{name}:{tag}")
+        if digest is None:
+            try:
+                digest = pin_image(name, tag, cache_dir=cache_dir)
+            except (OSError, KeyError) as error:
+                print(
+                    f"Could not resolve the digest of {name}:{tag} ({error}), using the tag",
+                    file=sys.stderr,
+                )
+        version = digest.split(":")[-1][:12] if digest else "unpinned"
+        sif = cache_dir / f"{name}_{tag}_{version}.sif"
+        if verify_image(sif, full=full):
+            _touch(sif)
+            return sif
+
+        source = f"{spec['source']}@{digest}" if digest else f"{spec['source']}:{tag}"
+        # Shell scripts read the path from stdout, so the build logs go to stderr
+        print(f"Building {sif.name} from {source}", file=sys.stderr)
+        tmp = sif.with_name(f".{sif.name}.building")
+        tmp.unlink(missing_ok=True)
+        subprocess.run(
+            [singularity or get_singularity(), "build", str(tmp), source],
+            stdout=sys.stderr,
+            check=True,
+        )
+        os.replace(tmp, sif)
+        _write_sidecars(
+            sif,
+            dict(
+                name=name,
+                tag=tag,
+                source=source,
+                digest=digest,
+                built=datetime.now().isoformat(timespec="seconds"),
+            ),
+        )
+    return sif
+
+
+def list_images(cache_dir=None):
+    """Return the metadata of the cached images, most recently used first."""
+    cache_dir = get_cache_dir() if cache_dir is None else Path(cache_dir)
+    images = []
+    for sif in cache_dir.glob("*.sif"):
+        metadata = _read_json(_sidecars(sif)[1])
+        images.append(dict(metadata, path=sif))
+    images.sort(key=lambda image: image.get("last_used", ""), reverse=True)
+    return images
+
+
+def evict(keep=2, cache_dir=None, dry_run=False):
+    """Delete all but the ``keep`` most recently used versions of each image.
+
+    Returns the paths that were deleted.
+    """
+    cache_dir = get_cache_dir() if cache_dir is None else Path(cache_dir)
+    kept = dict()
+    evicted = []
+    for image in list_images(cache_dir):
+        name = image.get("name", image["path"].stem)
+        kept[name] = kept.get(name, 0) + 1
+        if kept[name] <= keep:
+            continue
+        with locked(cache_dir / f"{name}_{image.get('tag')}.lock"):
+            print(f"Evicting {image['path'].name} (last used {image.get('last_used')})")
+            if not dry_run:
+                for fpath in [image["path"], *_sidecars(image["path"])]:
+                    fpath.unlink(missing_ok=True)
+        evicted.append(image["path"])
+    return evicted
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage the cache of Singularity images.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help in [
+        ("path", "Print the path of the cached image, building it if needed."),
+        ("pin", "Pin the digest (or checksum) of an image as it is now."),
+        ("verify", "Hash a cached image and compare it with its sidecar."),
+    ]:
+        subparser = subparsers.add_parser(command, help=help)
+        subparser.add_argument("name", choices=list(IMAGES))
+        subparser.add_argument("--tag", default=None)
+    subparsers.add_parser("list", help="List the cached images.")
+    evict_parser = subparsers.add_parser("evict", help="Delete the least recently used versions.")
+    evict_parser.add_argument("--keep", type=int, default=2)
+    evict_parser.add_argument("--dry-run", action="store_true", dest="dry_run")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    if args["command"] == "path":
+        print(ensure_image(args["name"], args["tag"]))
+    elif args["command"] == "pin":
+        if "path" in IMAGES[args["name"]]:
+            pin_file = get_cache_dir() / f"{args['name']}.json"
+            pin_file.unlink(missing_ok=True)
+            ensure_image(args["name"], full=True)
+            print(_read_json(pin_file)["sha256"])
+        else:
+            print(pin_image(args["name"], args["tag"]))
+    elif args["command"] == "verify":
+        sif = ensure_image(args["name"], args["tag"], full=True)
+        print(f"{sif} OK")
+    elif args["command"] == "list":
+        for image in list_images():
+            print(
+                f"{image['path'].name:<50} {image.get('size', 0) / 1e9:>6.2f} GB"
+                f"  last used {image.get('last_used')}"
+            )
+    elif args["command"] == "evict":
+        evict(keep=args["keep"], dry_run=args["dry_run"])
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
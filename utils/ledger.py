@@ -0,0 +1,48 @@
+import json
+from datetime import datetime
+from pathlib import Path
+
+LEDGER_DIR = Path(__file__).parent.parent / "logs"
+
+
+def append_record(name, record, ledger_dir=None):
+    """Append a record to the JSON lines ledger ``logs/{name}.jsonl``.
+
+    Parameters
+    ----------
+    name : str
+        The ledger name, for example ``"transfers"``.
+    record : dict
+        The record to save. Paths are saved as strings. A ``"timestamp"`` key is
+        added if the record does not have one.
+    ledger_dir : path-like, optional
+        The directory that holds the ledgers. Default is None, which uses the
+        ``logs`` directory of this repository.
+    """
+    ledger_dir = LEDGER_DIR if ledger_dir is None else Path(ledger_dir)
+    ledger_dir.mkdir(parents=True, exist_ok=True)
+    record = dict(record)
+    record.setdefault("timestamp", datetime.now().isoformat(timespec="seconds"))
+    with (ledger_dir / f"{name}.jsonl").open("a") as file:
+        file.write(json.dumps(record, default=str) + "\n")
+    return record
+
+
+def read_records(name, ledger_dir=None, **filters):
+    """Read the records of a ledger, keeping those that match all the filters.
+
+    For example, ``read_records("transfers", subject="1073")``.
+    """
+    ledger_dir = LEDGER_DIR if ledger_dir is None else Path(ledger_dir)
+    fpath = ledger_dir / f"{name}.jsonl"
+    if not fpath.exists():
+        return []
+    records = []
+    with fpath.open("r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if all(record.get(key) == value for key, value in filters.items()):
+                records.append(record)
+    return records
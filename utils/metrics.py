@@ -0,0 +1,187 @@
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+
+from .ledger import append_record, read_records
+
+# Labels (batch, project, subject, session, stage) that are added to every record
+_CONTEXT = dict()
+
+_SUFFIXES = {"": 1, "K": 1e3, "M": 1e6, "G": 1e9, "T": 1e12}
+
+_STATS_PATTERNS = {
+    "n_files": r"Number of files: ([\d.,]+[KMGT]?)",
+    "n_files_transferred": r"Number of (?:regular )?files transferred: ([\d.,]+[KMGT]?)",
+    "total_size": r"Total file size: ([\d.,]+[KMGT]?) bytes",
+    "transferred_size": r"Total transferred file size: ([\d.,]+[KMGT]?) bytes",
+    "bytes_sent": r"sent ([\d.,]+[KMGT]?) bytes",
+    "bytes_received": r"received ([\d.,]+[KMGT]?) bytes",
+    "speedup": r"speedup is ([\d.,]+)",
+}
+
+
+@contextmanager
+def transfer_context(**labels):
+    """Add labels, such as the subject or the batch, to the transfers done inside.
+
+    Contexts can be nested, and the inner labels take precedence.
+    """
+    previous = dict(_CONTEXT)
+    _CONTEXT.update(labels)
+    try:
+        yield
+    finally:
+        _CONTEXT.clear()
+        _CONTEXT.update(previous)
+
+
+def current_context():
+    """Return the labels of the current :func:`transfer_context`."""
+    return dict(_CONTEXT)
+
+
+@lru_cache(maxsize=1)
+def rsync_version():
+    """Return the local rsync version as a tuple, for example ``(3, 2, 7)``."""
+    output = subprocess.run(
+        ["rsync", "--version"], capture_output=True, text=True
+    ).stdout
+    match = re.search(r"version (\d+)\.(\d+)\.(\d+)", output)
+    return tuple(int(part) for part in match.groups()) if match else (0, 0, 0)
+
+
+def _parse_number(text):
+    text = text.replace(",", "")
+    suffix = text[-1] if text[-1] in _SUFFIXES else ""
+    value = float(text[: -1] if suffix else text) * _SUFFIXES[suffix]
+    return value if "." in text and not suffix else int(value)
+
+
+def parse_rsync_stats(output):
+    """Parse the output of ``rsync --stats`` into a dict.
+
+    Works with the output of rsync 2.6.9 (macOS) and 3.x, with or without ``-h``.
+    Values that are missing from the output are None.
+    """
+    stats = dict()
+    for key, pattern in _STATS_PATTERNS.items():
+        matches = re.findall(pattern, output)
+        stats[key] = _parse_number(matches[-1]) if matches else None
+    return stats
+
+
+def run_rsync(command, save=True):
+    """Run an rsync command, echo its output and collect transfer metrics.
+
+    ``--stats`` is added to the command. The output is still printed to the terminal
+    as it arrives. With ``save=False`` (for a dry run), the metrics are not saved.
+
+    Returns
+    -------
+    returncode : int
+        The exit code of rsync.
+    record : dict
+        The transfer metrics, see :func:`record_transfer`.
+    """
+    command = list(command) + ["--stats"]
+    output = bytearray()
+    start = time.perf_counter()
+    with subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    ) as process:
+        for chunk in iter(lambda: process.stdout.read1(4096), b""):
+            output.extend(chunk)
+            sys.stdout.buffer.write(chunk)
+            sys.stdout.flush()
+    elapsed = time.perf_counter() - start
+    stats = parse_rsync_stats(output.decode(errors="replace"))
+    record = record_transfer(
+        source=command[2],
+        destination=command[3],
+        elapsed_s=elapsed,
+        returncode=process.returncode,
+        transport="rsync",
+        save=save,
+        **stats,
+    )
+    return process.returncode, record
+
+
+def record_transfer(*, elapsed_s, bytes_sent=None, bytes_received=None, save=True, **metrics):
+    """Save the metrics of one transfer to the ``transfers`` ledger.
+
+    The current :func:`transfer_context` labels are added, along with the wire
+    throughput in MB/s, computed from the bytes sent and received. With
+    ``save=False``, the record is returned without being saved, so that dry runs
+    do not skew the throughput and sizes that are estimated from the ledger.
+    """
+    wire_bytes = (bytes_sent or 0) + (bytes_received or 0)
+    record = dict(_CONTEXT)
+    record.update(metrics)
+    record.update(
+        elapsed_s=round(elapsed_s, 3),
+        bytes_sent=bytes_sent,
+        bytes_received=bytes_received,
+        throughput_mbps=round(wire_bytes / 1e6 / elapsed_s, 3) if elapsed_s else None,
+    )
+    if not save:
+        return record
+    return append_record("transfers", record)
+
+
+def summarize_transfers(records=None, by="subject", **filters):
+    """Summarize transfer records, grouped by one of their labels.
+
+    Parameters
+    ----------
+    records : list of dict, optional
+        The records to summarize. Default is None, which reads the ``transfers``
+        ledger, keeping the records that match ``filters`` (for example
+        ``batch="20240131-101500"``).
+    by : str
+        The label to group by, for example ``"subject"``, ``"stage"``,
+        ``"destination"`` or ``"batch"``. Default is ``"subject"``.
+
+    Returns
+    -------
+    summary : dict
+        For each group, the number of transfers, the number of files transferred,
+        the total bytes on the wire, the total elapsed time and the throughput.
+    """
+    if records is None:
+        records = read_records("transfers", **filters)
+    summary = dict()
+    for record in records:
+        group = summary.setdefault(
+            record.get(by),
+            {"transfers": 0, "files": 0, "bytes": 0, "elapsed_s": 0.0},
+        )
+        group["transfers"] += 1
+        group["files"] += record.get("n_files_transferred") or 0
+        group["bytes"] += (record.get("bytes_sent") or 0) + (
+            record.get("bytes_received") or 0
+        )
+        group["elapsed_s"] += record.get("elapsed_s") or 0.0
+    for group in summary.values():
+        group["throughput_mbps"] = (
+            round(group["bytes"] / 1e6 / group["elapsed_s"], 3)
+            if group["elapsed_s"]
+            else None
+        )
+    return summary
+
+
+def print_transfer_summary(summary, title="Transfer summary"):
+    """Print the output of :func:`summarize_transfers` as a table."""
+    print(f"\n{title}")
+    print(f"{'group':<40} {'n':>4} {'files':>8} {'MB':>10} {'s':>8} {'MB/s':>8}")
+    for group, values in summary.items():
+        throughput = values["throughput_mbps"]
+        print(
+            f"{str(group):<40} {values['transfers']:>4} {values['files']:>8}"
+            f" {values['bytes'] / 1e6:>10.1f} {values['elapsed_s']:>8.1f}"
+            f" {throughput if throughput is not None else '-':>8}"
+        )
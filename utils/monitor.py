@@ -0,0 +1,541 @@
+"""Sample the CPU, memory, I/O and PIDs of a container while it runs.
+
+Docker containers are sampled with ``docker stats``. Singularity containers are
+ordinary child processes, so they are sampled from ``/proc`` (the whole process
+tree of the command), or from a cgroup directory, for example the one SLURM
+creates for the job.
+
+A command can also be run under the monitor from the shell, which is how the
+SLURM scripts use it::
+
+    python -m utils.monitor --tool nibabies --subject 1462 -- ./SLURM/run_nibabies.sh ...
+"""
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from . import ledger
+from .ledger import append_record, read_records
+from .metrics import current_context
+from .resources import host_capacity
+
+# Seconds between two samples. Override with the MRI_MONITOR_INTERVAL_S environment
+# variable, 0 turns the monitor off.
+DEFAULT_INTERVAL_S = 10.0
+
+_UNITS = {
+    "b": 1, "kb": 1e3, "mb": 1e6, "gb": 1e9, "tb": 1e12,
+    "kib": 2**10, "mib": 2**20, "gib": 2**30, "tib": 2**40,
+}
+
+
+def get_monitor_interval():
+    """Return the sampling interval in seconds, see ``DEFAULT_INTERVAL_S``."""
+    return float(os.environ.get("MRI_MONITOR_INTERVAL_S", DEFAULT_INTERVAL_S))
+
+
+def _parse_size(text):
+    """Parse a size from ``docker stats``, such as ``"1.5GiB"`` or ``"12.3kB"``."""
+    match = re.match(r"\s*([\d.]+)\s*([a-zA-Z]*)", text)
+    if match is None:
+        return None
+    value, unit = match.groups()
+    return int(float(value) * _UNITS.get(unit.lower() or "b", 1))
+
+
+def _split_pair(text):
+    first, _, second = text.partition("/")
+    return _parse_size(first), _parse_size(second)
+
+
+class DockerStatsSource:
+    """Sample a running docker container by name with ``docker stats``."""
+
+    def __init__(self, container_name):
+        self.container_name = container_name
+
+    def sample(self):
+        output = subprocess.run(
+            [
+                "docker", "stats", "--no-stream",
+                "--format", "{{json .}}",
+                self.container_name,
+            ],
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if not output:
+            # The container has not started yet, or has already exited
+            return None
+        stats = json.loads(output.splitlines()[-1])
+        mem_bytes, mem_limit_bytes = _split_pair(stats.get("MemUsage", ""))
+        read_bytes, write_bytes = _split_pair(stats.get("BlockIO", ""))
+        return {
+            "cpu_percent": float(stats.get("CPUPerc", "0").rstrip("%") or 0),
+            "mem_bytes": mem_bytes,
+            "mem_limit_bytes": mem_limit_bytes,
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes,
+            "pids": int(stats.get("PIDs") or 0),
+        }
+
+
+class ProcessTreeSource:
+    """Sample a process and all its descendants from ``/proc`` (Linux only).
+
+    The CPU usage is computed from the CPU time used since the previous sample, so
+    the first sample has no ``cpu_percent``.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self._ticks = os.sysconf("SC_CLK_TCK")
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        self._previous = None
+
+    def _descendants(self):
+        children = dict()
+        for stat_file in Path("/proc").glob("[0-9]*/stat"):
+            try:
+                stat = stat_file.read_text()
+            except OSError:
+                continue
+            # The process name is in parentheses and may contain spaces
+            fields = stat[stat.rindex(")") + 2 :].split()
+            children.setdefault(int(fields[1]), []).append(int(stat_file.parent.name))
+        pids, stack = [], [self.pid]
+        while stack:
+            pid = stack.pop()
+            pids.append(pid)
+            stack.extend(children.get(pid, []))
+        return pids
+
+    def sample(self):
+        cpu_ticks = rss_pages = read_bytes = write_bytes = 0
+        pids = 0
+        for pid in self._descendants():
+            proc = Path("/proc") / str(pid)
+            try:
+                stat = (proc / "stat").read_text()
+                fields = stat[stat.rindex(")") + 2 :].split()
+                cpu_ticks += int(fields[11]) + int(fields[12])  # utime + stime
+                rss_pages += int((proc / "statm").read_text().split()[1])
+                io = dict(
+                    line.split(": ") for line in (proc / "io").read_text().splitlines()
+                )
+                read_bytes += int(io["read_bytes"])
+                write_bytes += int(io["write_bytes"])
+            except (OSError, ValueError, KeyError):
+                # The process exited, or we are not allowed to read its io file
+                pass
+            pids += 1
+        now = time.monotonic()
+        cpu_percent = None
+        if self._previous is not None:
+            previous_ticks, previous_time = self._previous
+            elapsed = now - previous_time
+            used = max(cpu_ticks - previous_ticks, 0) / self._ticks
+            cpu_percent = round(100 * used / elapsed, 1) if elapsed else None
+        self._previous = (cpu_ticks, now)
+        return {
+            "cpu_percent": cpu_percent,
+            "mem_bytes": rss_pages * self._page_size,
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes,
+            "pids": pids,
+        }
+
+
+class CgroupSource:
+    """Sample a cgroup v2 directory, such as the cgroup of a SLURM job."""
+
+    def __init__(self, cgroup_dir):
+        self.cgroup_dir = Path(cgroup_dir)
+        self._previous = None
+
+    def _read(self, name):
+        fpath = self.cgroup_dir / name
+        return fpath.read_text() if fpath.exists() else ""
+
+    def sample(self):
+        cpu_stat = dict(line.split() for line in self._read("cpu.stat").splitlines())
+        usage_s = int(cpu_stat.get("usage_usec", 0)) / 1e6
+        read_bytes = write_bytes = 0
+        for line in self._read("io.stat").splitlines():
+            values = dict(item.split("=") for item in line.split()[1:])
+            read_bytes += int(values.get("rbytes", 0))
+            write_bytes += int(values.get("wbytes", 0))
+        now = time.monotonic()
+        cpu_percent = None
+        if self._previous is not None:
+            elapsed = now - self._previous[1]
+            cpu_percent = round(100 * (usage_s - self._previous[0]) / elapsed, 1) if elapsed else None
+        self._previous = (usage_s, now)
+        memory = self._read("memory.current").strip()
+        pids = self._read("pids.current").strip()
+        return {
+            "cpu_percent": cpu_percent,
+            "mem_bytes": int(memory) if memory else None,
+            "read_bytes": read_bytes,
+            "write_bytes": write_bytes,
+            "pids": int(pids) if pids else None,
+        }
+
+
+class ResourceMonitor(threading.Thread):
+    """Sample a source every ``interval_s`` seconds in a background thread.
+
+    Use it as a context manager. The samples are in ``self.samples``, each with the
+    seconds since the monitor started in ``"t_s"``.
+    """
+
+    def __init__(self, source, interval_s=DEFAULT_INTERVAL_S):
+        super().__init__(name="resource-monitor", daemon=True)
+        self.source = source
+        self.interval_s = interval_s
+        self.samples = []
+        self._start = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        self._start = time.monotonic()
+        while True:
+            try:
+                sample = self.source.sample()
+            except Exception as error:  # never let the monitor kill the run
+                print(f"Resource monitor: could not take a sample: {error}")
+                sample = None
+            if sample is not None:
+                sample["t_s"] = round(time.monotonic() - self._start, 2)
+                self.samples.append(sample)
+            if self._stop_event.wait(self.interval_s):
+                break
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop_event.set()
+        self.join()
+
+
+def slurm_job_id():
+    """Return the id of the SLURM job we run in, as sacct shows it, or None.
+
+    Tasks of a job array are ``{array job id}_{task id}``.
+    """
+    if os.environ.get("SLURM_ARRAY_JOB_ID") and os.environ.get("SLURM_ARRAY_TASK_ID"):
+        return f"{os.environ['SLURM_ARRAY_JOB_ID']}_{os.environ['SLURM_ARRAY_TASK_ID']}"
+    return os.environ.get("SLURM_JOB_ID")
+
+
+def unique_runs(records):
+    """Drop the SLURM accounting records of jobs that were also monitored.
+
+    A job run under :func:`monitored_run` is recorded twice: by the monitor, and by
+    :mod:`utils.accounting` after it finished. The monitor's record is kept.
+    """
+    monitored = {
+        record["slurm_job_id"]
+        for record in records
+        if record.get("slurm_job_id") and record.get("source") != "sacct"
+    }
+    return [
+        record
+        for record in records
+        if record.get("source") != "sacct" or record.get("slurm_job_id") not in monitored
+    ]
+
+
+def summarize_samples(samples):
+    """Return the peak and average CPU, memory and PIDs of a list of samples."""
+    summary = {"n_samples": len(samples)}
+    for key in ["cpu_percent", "mem_bytes", "pids"]:
+        values = [sample[key] for sample in samples if sample.get(key) is not None]
+        summary[f"peak_{key}"] = max(values) if values else None
+        summary[f"avg_{key}"] = round(sum(values) / len(values), 1) if values else None
+    for key in ["read_bytes", "write_bytes"]:
+        values = [sample[key] for sample in samples if sample.get(key) is not None]
+        # These are cumulative counters
+        summary[key] = max(values) if values else None
+    return summary
+
+
+def monitored_run(
+    command,
+    *,
+    tool,
+    container_name=None,
+    cgroup_dir=None,
+    interval_s=None,
+    shell=False,
+    stdout=None,
+    stderr=None,
+    **labels,
+):
+    """Run a container command while sampling its resource usage.
+
+    Parameters
+    ----------
+    command : str | list of str
+        The command to run.
+    tool : str
+        What the command runs, for example ``"nibabies"`` or ``"bibsnet"``.
+    container_name : str, optional
+        The name of the docker container (see ``docker run --name``). If given, the
+        container is sampled with ``docker stats``.
+    cgroup_dir : path-like, optional
+        If given (and ``container_name`` is not), sample this cgroup v2 directory.
+        Default is None, which samples the process tree of the command.
+    interval_s : float, optional
+        Seconds between two samples. Default is None, which uses
+        :func:`get_monitor_interval`. If 0, nothing is sampled, but the run is still
+        recorded.
+    stdout, stderr : file-like, optional
+        Where the output of the command goes, as in :class:`subprocess.Popen`.
+        Default is None, which inherits the output of this process.
+    **labels
+        Saved with the run record, for example ``subject="1462"``.
+
+    Returns
+    -------
+    returncode : int
+        The exit code of the command.
+    record : dict
+        The run record, which is saved to the ``runs`` ledger. The samples are saved
+        next to it, in ``logs/runs/{run_id}.jsonl``.
+    """
+    interval_s = get_monitor_interval() if interval_s is None else interval_s
+    started = datetime.now()
+    run_id = f"{tool}-{labels.get('subject', 'run')}-{started:%Y%m%d-%H%M%S}"
+    start = time.perf_counter()
+    with subprocess.Popen(command, shell=shell, stdout=stdout, stderr=stderr) as process:
+        if not interval_s:
+            process.wait()
+            samples = []
+        else:
+            if container_name is not None:
+                source = DockerStatsSource(container_name)
+            elif cgroup_dir is not None:
+                source = CgroupSource(cgroup_dir)
+            else:
+                source = ProcessTreeSource(process.pid)
+            with ResourceMonitor(source, interval_s=interval_s) as monitor:
+                process.wait()
+            samples = monitor.samples
+    elapsed_s = time.perf_counter() - start
+
+    samples_file = None
+    if samples:
+        samples_file = ledger.LEDGER_DIR / "runs" / f"{run_id}.jsonl"
+        samples_file.parent.mkdir(parents=True, exist_ok=True)
+        with samples_file.open("w") as file:
+            for sample in samples:
+                file.write(json.dumps(sample) + "\n")
+    record = current_context()
+    if slurm_job_id() is not None:
+        record["slurm_job_id"] = slurm_job_id()
+    record.update(labels)
+    record.update(
+        run_id=run_id,
+        tool=tool,
+        container_name=container_name,
+        started=started.isoformat(timespec="seconds"),
+        elapsed_s=round(elapsed_s, 1),
+        returncode=process.returncode,
+        interval_s=interval_s,
+        samples_file=samples_file,
+        **summarize_samples(samples),
+    )
+    return process.returncode, append_record("runs", record)
+
+
+def read_samples(record):
+    """Return the samples of a run record, see :func:`monitored_run`."""
+    if not record.get("samples_file") or not Path(record["samples_file"]).exists():
+        return []
+    with open(record["samples_file"], "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def summarize_runs(records=None, by="tool", **filters):
+    """Summarize the run records, grouped by one of their labels.
+
+    Parameters
+    ----------
+    records : list of dict, optional
+        The records to summarize. Default is None, which reads the ``runs`` ledger,
+        keeping the records that match ``filters`` (for example ``tool="nibabies"``).
+    by : str
+        The label to group by, for example ``"tool"``, ``"subject"`` or ``"batch"``.
+
+    Returns
+    -------
+    summary : dict
+        For each group, the number of runs, the mean elapsed time, the highest peak
+        and the mean average of the CPU and memory usage, and how many of these
+        containers fit on this computer at the same time.
+    """
+    if records is None:
+        records = unique_runs(read_records("runs", **filters))
+    groups = dict()
+    for record in records:
+        groups.setdefault(record.get(by), []).append(record)
+
+    def _values(runs, key):
+        return [run[key] for run in runs if run.get(key) is not None]
+
+    n_cpus, mem_bytes = host_capacity()
+    summary = dict()
+    for group, runs in groups.items():
+        values = {
+            "runs": len(runs),
+            "mean_elapsed_s": round(sum(_values(runs, "elapsed_s")) / len(runs), 1),
+        }
+        for key in ["cpu_percent", "mem_bytes"]:
+            peaks, averages = _values(runs, f"peak_{key}"), _values(runs, f"avg_{key}")
+            values[f"peak_{key}"] = max(peaks) if peaks else None
+            values[f"avg_{key}"] = round(sum(averages) / len(averages), 1) if averages else None
+        # Size by the average CPU (cores are shared) but by the peak memory (an
+        # out-of-memory kill loses the whole run).
+        fits = []
+        if values["avg_cpu_percent"] and n_cpus:
+            fits.append(100 * n_cpus / values["avg_cpu_percent"])
+        if values["peak_mem_bytes"] and mem_bytes:
+            fits.append(mem_bytes / values["peak_mem_bytes"])
+        values["concurrent_fit"] = int(min(fits)) if fits else None
+        summary[group] = values
+    return summary
+
+
+def print_run_summary(summary, title="Container resource usage"):
+    """Print the output of :func:`summarize_runs` as a table."""
+    print(f"\n{title}")
+    print(
+        f"{'group':<30} {'n':>4} {'mean s':>9} {'peak CPU%':>10} {'avg CPU%':>9}"
+        f" {'peak GB':>8} {'avg GB':>7} {'fit':>4}"
+    )
+
+    def _fmt(value, scale=1, digits=1):
+        return "-" if value is None else f"{value / scale:.{digits}f}"
+
+    for group, values in summary.items():
+        print(
+            f"{str(group):<30} {values['runs']:>4} {values['mean_elapsed_s']:>9}"
+            f" {_fmt(values['peak_cpu_percent']):>10} {_fmt(values['avg_cpu_percent']):>9}"
+            f" {_fmt(values['peak_mem_bytes'], 1e9, 2):>8}"
+            f" {_fmt(values['avg_mem_bytes'], 1e9, 2):>7}"
+            f" {values['concurrent_fit'] if values['concurrent_fit'] is not None else '-':>4}"
+        )
+
+
+def export_run_summaries(fpath, records=None, **filters):
+    """Save one line per run, with its peak and average usage, to a CSV file."""
+    import csv
+
+    if records is None:
+        records = read_records("runs", **filters)
+    columns = [
+        "run_id", "tool", "project", "subject", "session", "batch", "started",
+        "elapsed_s", "returncode", "n_samples", "peak_cpu_percent", "avg_cpu_percent",
+        "peak_mem_bytes", "avg_mem_bytes", "peak_pids", "read_bytes", "write_bytes",
+    ]
+    with open(fpath, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+    return fpath
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run a command and sample its resource usage, or summarize past runs."
+    )
+    parser.add_argument("--tool", default="nibabies", help="What the command runs.")
+    parser.add_argument("--project", default=None)
+    parser.add_argument("--subject", default=None)
+    parser.add_argument("--session", default=None)
+    parser.add_argument(
+        "--surface-recon-method",
+        default=None,
+        dest="surface_recon_method",
+        help="Saved with the run, along with the input features used to predict runtimes.",
+    )
+    parser.add_argument("--anat-only", action="store_true", dest="anat_only")
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=None,
+        dest="interval_s",
+        help="Seconds between two samples. Default is MRI_MONITOR_INTERVAL_S, or 10.",
+    )
+    parser.add_argument(
+        "--cgroup",
+        default=None,
+        dest="cgroup_dir",
+        help="Sample this cgroup v2 directory instead of the process tree of the command.",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store_true",
+        help="Print the summary of the recorded runs instead of running a command.",
+    )
+    parser.add_argument(
+        "--export",
+        default=None,
+        help="Save the peak and average usage of each recorded run to this CSV file.",
+    )
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="The command to run, after --.")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    command = args.pop("command")
+    if command and command[0] == "--":
+        command = command[1:]
+    if args["summary"] or args["export"]:
+        if args["export"]:
+            export_run_summaries(args["export"])
+        print_run_summary(summarize_runs())
+        return 0
+    labels = {
+        key: args[key]
+        for key in ["project", "subject", "session", "surface_recon_method"]
+        if args[key] is not None
+    }
+    if all(key in labels for key in ["project", "subject", "session"]):
+        from .predict import subject_features
+
+        labels["anat_only"] = args["anat_only"]
+        try:
+            labels["features"] = subject_features(
+                labels["project"],
+                labels["subject"],
+                labels["session"],
+                surface_recon_method=labels.get("surface_recon_method", "infantfs"),
+                anat_only=args["anat_only"],
+            )
+        except OSError as error:
+            print(f"Could not read the input features: {error}")
+    returncode, _ = monitored_run(
+        command,
+        tool=args["tool"],
+        cgroup_dir=args["cgroup_dir"],
+        interval_s=args["interval_s"],
+        **labels,
+    )
+    return returncode
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+"""Collect the runtime and memory use of each Nipype node of a Nibabies run.
+
+Nibabies is run with ``--resource-monitor``, so Nipype records the duration, peak
+memory and CPU usage of every node in the node's ``_report/report.rst`` in the
+work directory. They are collected before the work directory is deleted, saved to
+the ``nodes`` ledger, and ranked across subjects to find the nodes that take the
+most time::
+
+    python -m utils.nodes --top 30
+"""
+
+import argparse
+import json
+import re
+from datetime import datetime
+from pathlib import Path
+
+from .ledger import append_record, read_records
+
+# Make the node names of different subjects and runs comparable
+NODE_NAME_SUBSTITUTIONS = [
+    (re.compile(r"single_subject_[^.]+?_wf"), "single_subject_wf"),
+    (re.compile(r"_run_\d+"), "_run_N"),
+    (re.compile(r"_echo_\d+"), "_echo_N"),
+]
+
+_RUNTIME_KEYS = {
+    "duration": "duration_s",
+    "mem_peak_gb": "mem_peak_gb",
+    "cpu_percent": "cpu_percent",
+}
+
+
+def normalize_node_name(name):
+    """Remove the subject and run labels from a node name."""
+    for pattern, replacement in NODE_NAME_SUBSTITUTIONS:
+        name = pattern.sub(replacement, name)
+    return name
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_report(fpath):
+    """Parse the runtime info of one node from its ``_report/report.rst``.
+
+    Returns a dict with the node ``name`` (its hierarchy in the workflow), and the
+    ``duration_s``, ``mem_peak_gb`` and ``cpu_percent`` of the node. Values that are
+    missing from the report (for example the memory, if the resource monitor was
+    off) are None. Returns None if the node did not run.
+    """
+    text = Path(fpath).read_text(errors="replace")
+    hierarchy = re.search(r"^Hierarchy\s*:\s*(\S+)", text, flags=re.MULTILINE)
+    info = dict(re.findall(r"^\*\s*(\w+)\s*:\s*(.*?)\s*$", text, flags=re.MULTILINE))
+    if "duration" not in info:
+        return None
+    name = hierarchy.group(1) if hierarchy else Path(fpath).parent.parent.name
+    record = {"name": name}
+    for key, record_key in _RUNTIME_KEYS.items():
+        record[record_key] = _to_number(info.get(key))
+    return record
+
+
+def parse_callback_log(fpath):
+    """Parse a Nipype callback log (see ``nipype.utils.profiler.log_nodes_cb``).
+
+    Each finished node is a JSON line with its start and finish times, and the
+    threads and memory that it used.
+    """
+    records = []
+    with open(fpath, "r") as file:
+        for line in file:
+            try:
+                node = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "finish" not in node or "start" not in node:
+                continue
+            duration = (
+                datetime.fromisoformat(node["finish"]) - datetime.fromisoformat(node["start"])
+            ).total_seconds()
+            records.append(
+                {
+                    "name": node.get("id", node.get("name")),
+                    "duration_s": duration,
+                    "mem_peak_gb": _to_number(node.get("runtime_memory_gb")),
+                    "cpu_percent": (
+                        100 * node["runtime_threads"]
+                        if _to_number(node.get("runtime_threads")) is not None
+                        else None
+                    ),
+                }
+            )
+    return records
+
+
+def collect_node_stats(work_dir, subject=None):
+    """Return the runtime info of all the nodes that ran in a Nipype work directory.
+
+    Callback logs (``*callback.log``) are used if there are any, else the
+    ``report.rst`` of each node. If ``subject`` is given, only the nodes of its
+    ``single_subject_{subject}_wf`` workflow are returned, so that what other
+    subjects left in the work directory is not counted as theirs. Callback log
+    nodes whose name has no subject workflow are kept.
+    """
+    work_dir = Path(work_dir)
+    workflow = None if subject is None else f"single_subject_{subject}_wf"
+    callback_logs = sorted(work_dir.rglob("*callback.log"))
+    if callback_logs:
+        records = []
+        for fpath in callback_logs:
+            records.extend(
+                record
+                for record in parse_callback_log(fpath)
+                if workflow is None
+                or "single_subject_" not in (record["name"] or "")
+                or workflow in record["name"].split(".")
+            )
+        return records
+    roots = [work_dir] if workflow is None else sorted(work_dir.glob(f"*/{workflow}"))
+    records = []
+    for root in roots:
+        for fpath in root.rglob("_report/report.rst"):
+            record = parse_report(fpath)
+            if record is not None:
+                records.append(record)
+    return records
+
+
+def record_node_stats(work_dir, **labels):
+    """Save the runtime info of the nodes in work_dir to the ``nodes`` ledger.
+
+    ``labels``, such as the subject, are saved with each node. If there is a
+    ``subject`` label, only the nodes of that subject are saved. Returns the
+    number of nodes that were saved.
+    """
+    records = collect_node_stats(work_dir, subject=labels.get("subject"))
+    for record in records:
+        record = dict(labels, node=normalize_node_name(record["name"]), **record)
+        append_record("nodes", record)
+    print(f"Saved the runtime info of {len(records)} Nipype nodes from {work_dir}")
+    return len(records)
+
+
+def rank_nodes(records=None, by="total_s", top=20, **filters):
+    """Aggregate node records across subjects, and rank them.
+
+    Parameters
+    ----------
+    records : list of dict, optional
+        Default is None, which reads the ``nodes`` ledger, keeping the records that
+        match ``filters`` (for example ``project="BABIES"``).
+    by : str
+        ``"total_s"`` (default), ``"mean_s"``, ``"max_mem_gb"`` or
+        ``"mean_threads"``.
+    top : int | None
+        How many nodes to return. None returns all of them.
+
+    Returns
+    -------
+    ranking : list of dict
+        One dict per node, with the number of times it ran, the total and mean
+        duration, the share of the total duration of all nodes, the highest peak
+        memory and the mean number of threads (CPU percent / 100).
+    """
+    if records is None:
+        records = read_records("nodes", **filters)
+    nodes = dict()
+    for record in records:
+        node = nodes.setdefault(
+            record.get("node") or normalize_node_name(record["name"]),
+            {"runs": 0, "total_s": 0.0, "mem": [], "cpu": []},
+        )
+        node["runs"] += 1
+        node["total_s"] += record.get("duration_s") or 0.0
+        if record.get("mem_peak_gb") is not None:
+            node["mem"].append(record["mem_peak_gb"])
+        if record.get("cpu_percent") is not None:
+            node["cpu"].append(record["cpu_percent"])
+    grand_total = sum(node["total_s"] for node in nodes.values()) or 1.0
+    ranking = []
+    for name, node in nodes.items():
+        ranking.append(
+            {
+                "node": name,
+                "runs": node["runs"],
+                "total_s": round(node["total_s"], 1),
+                "mean_s": round(node["total_s"] / node["runs"], 1),
+                "share": round(node["total_s"] / grand_total, 4),
+                "max_mem_gb": round(max(node["mem"]), 2) if node["mem"] else None,
+                "mean_threads": (
+                    round(sum(node["cpu"]) / len(node["cpu"]) / 100, 2) if node["cpu"] else None
+                ),
+            }
+        )
+    ranking.sort(key=lambda node: node[by] if node[by] is not None else -1, reverse=True)
+    return ranking if top is None else ranking[:top]
+
+
+def print_node_report(ranking, title="Nipype nodes"):
+    """Print the output of :func:`rank_nodes` as a table."""
+    print(f"\n{title}")
+    print(
+        f"{'node':<70} {'runs':>5} {'total h':>8} {'mean s':>8} {'share':>6}"
+        f" {'mem GB':>7} {'threads':>7}"
+    )
+    for node in ranking:
+        name = node["node"] if len(node["node"]) <= 70 else "..." + node["node"][-67:]
+        print(
+            f"{name:<70} {node['runs']:>5} {node['total_s'] / 3600:>8.2f}"
+            f" {node['mean_s']:>8.1f} {node['share']:>6.1%}"
+            f" {node['max_mem_gb'] if node['max_mem_gb'] is not None else '-':>7}"
+            f" {node['mean_threads'] if node['mean_threads'] is not None else '-':>7}"
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rank the Nipype nodes of Nibabies runs.")
+    parser.add_argument(
+        "--work-dir",
+        default=None,
+        dest="work_dir",
+        help="Report on the nodes in this work directory, instead of the nodes ledger.",
+    )
+    parser.add_argument("--project", default=None)
+    parser.add_argument("--subject", default=None)
+    parser.add_argument("--session", default=None)
+    parser.add_argument(
+        "--by",
+        default="total_s",
+        choices=["total_s", "mean_s", "max_mem_gb", "mean_threads"],
+        help="How to rank the nodes. Default is the total duration across subjects.",
+    )
+    parser.add_argument("--top", type=int, default=20, help="Number of nodes to show.")
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="Save the nodes of --work-dir to the nodes ledger, for example before a"
+        " node-local work directory is deleted.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    records = None
+    filters = {
+        key: args[key] for key in ["project", "subject", "session"] if args[key] is not None
+    }
+    if args["record"]:
+        if args["work_dir"] is None:
+            raise ValueError("--record needs --work-dir")
+        record_node_stats(args["work_dir"], **filters)
+        return
+    if args["work_dir"] is not None:
+        records = collect_node_stats(args["work_dir"])
+    print_node_report(rank_nodes(records, by=args["by"], top=args["top"], **filters))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""Estimate what a cohort will cost before running it, without running anything.
+
+For a list of subjects, :func:`plan_cohort` reports:
+
+- the bytes to pull, from the sizes of the files on the server that
+  ``pull_subject_files`` would copy (see :func:`utils.utils.create_filter_file`),
+- the bytes to push, from the ratio of pushed to pulled bytes of past subjects
+  (the ``transfers`` ledger),
+- the predicted Nibabies container hours (see :mod:`utils.predict`),
+- the peak local disk use, when ``concurrent`` subjects are on the disk at once.
+  The Nibabies work directory is not included,
+- the number of SLURM jobs and array tasks that :func:`utils.slurm.submit_cohort`
+  would submit,
+- when the cohort would be done, if ``concurrent`` subjects run at a time in the
+  order of :class:`utils.scheduling.Scheduler`, each taking its predicted runtime
+  plus its transfers at the past throughput.
+"""
+
+import os
+from datetime import datetime, timedelta
+from statistics import median
+
+from .config import get_server_root
+from .ledger import read_records
+from .scheduling import Scheduler
+
+
+def _tree_size(path, exclude=lambda name: False):
+    """Return the number of files and the bytes under a path."""
+    n_files, n_bytes = 0, 0
+    for root, _, fnames in os.walk(path):
+        for fname in fnames:
+            if not exclude(fname):
+                n_files += 1
+                n_bytes += os.stat(os.path.join(root, fname)).st_size
+    return n_files, n_bytes
+
+
+def pull_size(project, subject, session, *, anat_only=False, bids_only=False):
+    """Return the number of files and bytes that pulling a subject copies from the server.
+
+    The same files as the filter of :func:`utils.utils.create_filter_file`: the
+    anatomical images without the ``*_raw.nii.gz``, the functional and field map
+    images unless ``anat_only`` (without the DWI ones), and the recon-all directory
+    unless ``bids_only``. Returns None if the server is not mounted.
+    """
+    session_dir = "six_month" if session == "sixmonth" else session
+    session_bids = "sixmonth" if session_dir == "six_month" else session_dir
+    root = get_server_root() / project / "MRI" / session_dir
+    subject_dir = root / "bids" / f"sub-{subject}" / f"ses-{session_bids}"
+    if not subject_dir.exists():
+        return None
+    sizes = [_tree_size(subject_dir / "anat", exclude=lambda name: name.endswith("_raw.nii.gz"))]
+    if not anat_only:
+        sizes.append(_tree_size(subject_dir / "func"))
+        sizes.append(_tree_size(subject_dir / "fmap", exclude=lambda name: "_acq-dwi" in name))
+    if not bids_only:
+        sizes.append(_tree_size(root / "derivatives" / "recon-all" / f"sub-{subject}"))
+    return sum(n_files for n_files, _ in sizes), sum(n_bytes for _, n_bytes in sizes)
+
+
+def transfer_history(records=None):
+    """Summarize past transfers, to extrapolate the ones of new subjects.
+
+    Returns a dict with ``push_ratio`` (the median of pushed over pulled bytes of
+    the subjects that have both), ``push_bytes`` (the median pushed bytes of a
+    subject) and ``pull_mbps`` and ``push_mbps`` (the throughput of each stage).
+    Values without history are None.
+    """
+    if records is None:
+        records = read_records("transfers")
+    per_subject = dict()
+    totals = {"pull": [0, 0.0], "push": [0, 0.0]}
+    for record in records:
+        stage = record.get("stage")
+        if stage not in totals:
+            continue
+        n_bytes = (record.get("bytes_sent") or 0) + (record.get("bytes_received") or 0)
+        key = (record.get("project"), record.get("subject"), record.get("session"))
+        per_subject.setdefault(key, {"pull": 0, "push": 0})[stage] += n_bytes
+        totals[stage][0] += n_bytes
+        totals[stage][1] += record.get("elapsed_s") or 0.0
+    ratios = [sizes["push"] / sizes["pull"] for sizes in per_subject.values() if sizes["pull"] and sizes["push"]]
+    pushes = [sizes["push"] for sizes in per_subject.values() if sizes["push"]]
+    return {
+        "push_ratio": median(ratios) if ratios else None,
+        "push_bytes": median(pushes) if pushes else None,
+        **{
+            f"{stage}_mbps": n_bytes / 1e6 / elapsed_s if elapsed_s else None
+            for stage, (n_bytes, elapsed_s) in totals.items()
+        },
+    }
+
+
+def slurm_jobs(subjects, *, bibsnet=False, pack_bibsnet_hours=None, bibsnet_seconds=None):
+    """Return the number of jobs and of array tasks of :func:`utils.slurm.submit_cohort`.
+
+    With ``pack_bibsnet_hours``, BIBSnet runs as packed jobs instead of an array
+    (see :func:`utils.slurm.pack_bibsnet_jobs`), from the predicted
+    ``bibsnet_seconds`` of each subject.
+    """
+    from .slurm import pack_subjects
+
+    arrays = ["prepare", "nibabies", "push"]
+    jobs = {"arrays": len(arrays), "tasks": len(arrays) * len(subjects), "bibsnet_jobs": 0}
+    if bibsnet and pack_bibsnet_hours:
+        jobs["bibsnet_jobs"] = len(pack_subjects(bibsnet_seconds, pack_bibsnet_hours * 3600 / 1.2))
+    elif bibsnet:
+        jobs["arrays"] += 1
+        jobs["tasks"] += len(subjects)
+    jobs["total"] = jobs["arrays"] + jobs["bibsnet_jobs"]
+    return jobs
+
+
+def plan_cohort(
+    project,
+    subjects,
+    session,
+    *,
+    surface_recon_method="freesurfer",
+    anat_only=False,
+    concurrent=1,
+    bibsnet=False,
+    pack_bibsnet_hours=None,
+    start=None,
+):
+    """Estimate the transfers, disk, container hours, SLURM jobs and finish time of a cohort.
+
+    Returns a dict with the estimates of each subject (``subjects``) and of the
+    cohort (``totals``). Estimates that have no data behind them are None.
+    """
+    from .predict import load_predictor, predict, subject_features
+
+    subjects = [str(subject) for subject in subjects]
+    start = datetime.now() if start is None else start
+    history = transfer_history()
+    predictor = load_predictor("nibabies")
+    bibsnet_predictor = load_predictor("bibsnet") if bibsnet else None
+    method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
+
+    estimates = dict()
+    for subject in subjects:
+        size = pull_size(project, subject, session, anat_only=anat_only)
+        pull_bytes = size[1] if size else None
+        if pull_bytes is not None and history["push_ratio"] is not None:
+            push_bytes = pull_bytes * history["push_ratio"]
+        else:
+            push_bytes = history["push_bytes"]
+        features = subject_features(
+            project, subject, session, surface_recon_method=method, anat_only=anat_only
+        )
+        prediction = predict(features, predictor=predictor)
+        transfer_s = 0.0
+        for n_bytes, mbps in ((pull_bytes, history["pull_mbps"]), (push_bytes, history["push_mbps"])):
+            if n_bytes and mbps:
+                transfer_s += n_bytes / 1e6 / mbps
+        estimates[subject] = {
+            "pull_files": size[0] if size else None,
+            "pull_bytes": pull_bytes,
+            "push_bytes": push_bytes,
+            "nibabies_s": prediction["elapsed_s"],
+            "nibabies_s_upper": prediction["elapsed_s_upper"],
+            "peak_mem_bytes": prediction["peak_mem_bytes_upper"],
+            "transfer_s": transfer_s,
+            "source": prediction["source"],
+        }
+        if bibsnet:
+            estimates[subject]["bibsnet_s"] = predict(
+                subject_features(project, subject, session), "bibsnet", bibsnet_predictor
+            )["elapsed_s_upper"]
+
+    # Run the subjects in the order of the scheduler, each in the first free slot
+    scheduler = Scheduler(
+        dict(subject=subject, predicted_s=estimates[subject]["nibabies_s"]) for subject in subjects
+    )
+    free_at = [start] * max(1, concurrent)
+    events = []
+    for item in scheduler.ordered(start):
+        estimate = estimates[item["subject"]]
+        slot = free_at.index(min(free_at))
+        estimate["start"] = free_at[slot]
+        estimate["finish"] = free_at[slot] + timedelta(
+            seconds=estimate["nibabies_s"] + estimate["transfer_s"]
+        )
+        free_at[slot] = estimate["finish"]
+        disk = (estimate["pull_bytes"] or 0) + (estimate["push_bytes"] or 0)
+        events += [(estimate["start"], disk), (estimate["finish"], -disk)]
+    peak_disk = disk_now = 0
+    # At the same time, the subject that finishes frees its disk before the next starts
+    for _, change in sorted(events, key=lambda event: (event[0], event[1])):
+        disk_now += change
+        peak_disk = max(peak_disk, disk_now)
+
+    def _total(key):
+        values = [estimate[key] for estimate in estimates.values()]
+        return None if any(value is None for value in values) else sum(values)
+
+    pull_bytes, push_bytes = _total("pull_bytes"), _total("push_bytes")
+    totals = {
+        "n_subjects": len(subjects),
+        "pull_bytes": pull_bytes,
+        "push_bytes": push_bytes,
+        # Unknown sizes would count as 0
+        "peak_disk_bytes": None if pull_bytes is None or push_bytes is None else peak_disk,
+        "container_hours": _total("nibabies_s") / 3600,
+        "container_hours_upper": _total("nibabies_s_upper") / 3600,
+        "transfer_hours": _total("transfer_s") / 3600,
+        "concurrent": concurrent,
+        "finish": max((estimate["finish"] for estimate in estimates.values()), default=start),
+        "slurm": slurm_jobs(
+            subjects,
+            bibsnet=bibsnet,
+            pack_bibsnet_hours=pack_bibsnet_hours,
+            bibsnet_seconds={subject: estimate.get("bibsnet_s") for subject, estimate in estimates.items()},
+        ),
+        "model": "history" if predictor else "defaults",
+    }
+    return {"subjects": estimates, "totals": totals}
+
+
+def _gb(n_bytes):
+    return "?" if n_bytes is None else f"{n_bytes / 1e9:.1f}"
+
+
+def print_plan(plan):
+    """Print the output of :func:`plan_cohort` as a table."""
+    print(f"{'subject':<10}{'pull GB':>9}{'push GB':>9}{'Nibabies h':>12}{'start':>13}{'done':>13}")
+    for subject, estimate in sorted(plan["subjects"].items(), key=lambda item: item[1]["start"]):
+        print(
+            f"{subject:<10}{_gb(estimate['pull_bytes']):>9}{_gb(estimate['push_bytes']):>9}"
+            f"{estimate['nibabies_s'] / 3600:>12.1f}{format(estimate['start'], '%a %H:%M'):>13}"
+            f"{format(estimate['finish'], '%a %H:%M'):>13}"
+        )
+    totals = plan["totals"]
+    slurm = totals["slurm"]
+    print(f"\n{totals['n_subjects']} subjects, {totals['concurrent']} at a time")
+    print(f"    pull:            {_gb(totals['pull_bytes'])} GB")
+    print(f"    push:            {_gb(totals['push_bytes'])} GB")
+    print(f"    peak local disk: {_gb(totals['peak_disk_bytes'])} GB, without the Nibabies work directory")
+    print(
+        f"    container hours: {totals['container_hours']:.1f} "
+        f"(up to {totals['container_hours_upper']:.1f}, from {totals['model']})"
+    )
+    print(f"    transfer hours:  {totals['transfer_hours']:.1f}")
+    print(
+        f"    SLURM:           {slurm['total']} jobs ({slurm['arrays']} arrays of {slurm['tasks']} tasks"
+        + (f", {slurm['bibsnet_jobs']} packed BIBSnet jobs" if slurm["bibsnet_jobs"] else "")
+        + ")"
+    )
+    print(f"    done around:     {totals['finish']:%a %d %b %H:%M}")
@@ -0,0 +1,322 @@
+"""Predict the runtime and peak memory of a Nibabies or BIBSnet run.
+
+The model is a ridge regression of the log of the elapsed time (and of the peak
+memory) on features of the subject's inputs: the age, the surface reconstruction
+method, ``--anat-only``, and the number, size and dimensions of the BOLD runs. It
+is trained on the ``runs`` ledger (see :mod:`utils.monitor`), and trained again
+whenever runs were added since the last time, so the predictions improve as the
+cohort is processed. Until there are enough runs, the defaults of the SLURM
+scripts are used.
+
+The predictions give the ``--time``/``--mem`` of SLURM jobs and the ETA of local
+batches::
+
+    python -m utils.predict --project BABIES --session newborn --subjects 1462 1470 --format sbatch
+"""
+
+import argparse
+import gzip
+import json
+import math
+import os
+import struct
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from . import ledger
+from .config import get_local_root, get_server_root
+from .ledger import read_records
+from .monitor import unique_runs
+
+FEATURES = [
+    "age_months",
+    "mcribs",
+    "anat_only",
+    "n_func_runs",
+    "func_gb",
+    "func_mvoxels",
+    "anat_mvoxels",
+]
+# Used until there are enough runs to train on, from nibabies.sbatch and
+# SLURM/submit_bibsnet_job.sbatch
+DEFAULTS = {
+    "nibabies": {"elapsed_s": 8 * 3600, "peak_mem_bytes": 20 * 2**30},
+    "bibsnet": {"elapsed_s": 3600, "peak_mem_bytes": 50 * 2**30},
+}
+AGE_MONTHS = {"newborn": 1, "sixmonth": 6, "six_month": 6, "twelvemonth": 12}
+# Request the prediction times exp(z * residual std), i.e. ~95% of runs fit
+SAFETY_Z = 1.65
+
+
+def read_nifti_header(fpath):
+    """Return the ``dim`` and ``pixdim`` of a NIfTI-1 or NIfTI-2 file, or None.
+
+    Only the header is read, so this is fast even for large ``.nii.gz`` files.
+    """
+    opener = gzip.open if str(fpath).endswith(".gz") else open
+    try:
+        with opener(fpath, "rb") as file:
+            header = file.read(540)
+    except (OSError, EOFError):
+        return None
+    for endian in "<>":
+        if len(header) >= 348 and struct.unpack(f"{endian}i", header[:4])[0] == 348:
+            dim = struct.unpack(f"{endian}8h", header[40:56])
+            pixdim = struct.unpack(f"{endian}8f", header[76:108])
+            break
+        if len(header) >= 540 and struct.unpack(f"{endian}i", header[:4])[0] == 540:
+            dim = struct.unpack(f"{endian}8q", header[16:80])
+            pixdim = struct.unpack(f"{endian}8d", header[104:168])
+            break
+    else:
+        return None
+    n_dims = max(0, min(int(dim[0]), 7))
+    return {"dim": list(dim[1 : n_dims + 1]), "pixdim": list(pixdim[1 : n_dims + 1])}
+
+
+def _n_voxels(fpath):
+    header = read_nifti_header(fpath)
+    return math.prod(header["dim"]) if header and header["dim"] else 0
+
+
+def subject_features(
+    project,
+    subject,
+    session,
+    *,
+    surface_recon_method="infantfs",
+    anat_only=False,
+    bids_dir=None,
+):
+    """Return the input features of one subject, see ``FEATURES``.
+
+    The BIDS directory is the local one if the subject was pulled, else the one on
+    the server (which must be mounted). Missing files give zeros.
+    """
+    session_dir = "six_month" if session == "sixmonth" and project == "BABIES" else session
+    if bids_dir is None:
+        bids_dir = get_local_root() / project / "MRI" / session_dir / "bids"
+        if not (bids_dir / f"sub-{subject}").exists():
+            bids_dir = get_server_root() / project / "MRI" / session_dir / "bids"
+    subject_dir = Path(bids_dir) / f"sub-{subject}"
+    func = [] if anat_only else sorted(subject_dir.glob("ses-*/func/*_bold.nii*"))
+    anat = sorted(subject_dir.glob("ses-*/anat/*_T[12]w.nii*"))
+    return {
+        "age_months": AGE_MONTHS.get(session, 1),
+        "mcribs": int(surface_recon_method == "mcribs"),
+        "anat_only": int(anat_only),
+        "n_func_runs": len(func),
+        "func_gb": round(sum(fpath.stat().st_size for fpath in func) / 1e9, 3),
+        "func_mvoxels": round(sum(_n_voxels(fpath) for fpath in func) / 1e6, 3),
+        "anat_mvoxels": round(sum(_n_voxels(fpath) for fpath in anat) / 1e6, 3),
+    }
+
+
+def _solve(a, b):
+    """Solve the linear system a x = b with Gaussian elimination."""
+    n = len(b)
+    m = [list(row) + [value] for row, value in zip(a, b)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda row: abs(m[row][col]))
+        m[col], m[pivot] = m[pivot], m[col]
+        if abs(m[col][col]) < 1e-12:
+            continue
+        for row in range(n):
+            if row != col:
+                factor = m[row][col] / m[col][col]
+                m[row] = [x - factor * y for x, y in zip(m[row], m[col])]
+    return [m[ii][n] / m[ii][ii] if abs(m[ii][ii]) > 1e-12 else 0.0 for ii in range(n)]
+
+
+def fit_ridge(rows, targets, alpha=1.0):
+    """Fit a ridge regression. The features are standardized and the intercept is
+    not penalized. Returns a dict that :func:`predict_ridge` can use."""
+    n_features = len(rows[0])
+    means = [sum(row[jj] for row in rows) / len(rows) for jj in range(n_features)]
+    stds = [
+        math.sqrt(sum((row[jj] - means[jj]) ** 2 for row in rows) / len(rows)) or 1.0
+        for jj in range(n_features)
+    ]
+    x = [[1.0] + [(row[jj] - means[jj]) / stds[jj] for jj in range(n_features)] for row in rows]
+    xtx = [[sum(r[ii] * r[jj] for r in x) for jj in range(n_features + 1)] for ii in range(n_features + 1)]
+    for ii in range(1, n_features + 1):
+        xtx[ii][ii] += alpha
+    xty = [sum(r[ii] * y for r, y in zip(x, targets)) for ii in range(n_features + 1)]
+    weights = _solve(xtx, xty)
+    residuals = [y - sum(w * v for w, v in zip(weights, r)) for r, y in zip(x, targets)]
+    dof = max(len(rows) - n_features - 1, 1)
+    return {
+        "weights": weights,
+        "means": means,
+        "stds": stds,
+        "residual_std": math.sqrt(sum(r**2 for r in residuals) / dof),
+        "n": len(rows),
+    }
+
+
+def predict_ridge(model, row):
+    x = [1.0] + [(v - m) / s for v, m, s in zip(row, model["means"], model["stds"])]
+    return sum(w * v for w, v in zip(model["weights"], x))
+
+
+def train(tool="nibabies", records=None, min_runs=None):
+    """Train the runtime and memory models of a tool on the ``runs`` ledger.
+
+    Only successful runs that were recorded with their ``features`` are used.
+    Returns None if there are fewer than ``min_runs`` of them (default: the number
+    of features + 2).
+    """
+    if records is None:
+        records = read_records("runs", tool=tool)
+    runs = [
+        record
+        for record in unique_runs(records)
+        if record.get("returncode") == 0
+        and record.get("features")
+        and record.get("elapsed_s")
+    ]
+    min_runs = len(FEATURES) + 2 if min_runs is None else min_runs
+    if len(runs) < min_runs:
+        return None
+    rows = [[float(run["features"].get(name, 0)) for name in FEATURES] for run in runs]
+    models = {
+        "elapsed_s": fit_ridge(rows, [math.log(run["elapsed_s"]) for run in runs])
+    }
+    with_mem = [(row, run) for row, run in zip(rows, runs) if run.get("peak_mem_bytes")]
+    if len(with_mem) >= min_runs:
+        models["peak_mem_bytes"] = fit_ridge(
+            [row for row, _ in with_mem],
+            [math.log(run["peak_mem_bytes"]) for _, run in with_mem],
+        )
+    return {"tool": tool, "n_runs": len(runs), "features": FEATURES, "models": models}
+
+
+def load_predictor(tool="nibabies", model_dir=None):
+    """Return the trained models of a tool, training them again if runs were added.
+
+    The models are cached in ``logs/models/{tool}.json``. Returns None if there are
+    not enough runs yet.
+    """
+    model_dir = ledger.LEDGER_DIR / "models" if model_dir is None else Path(model_dir)
+    fpath = model_dir / f"{tool}.json"
+    records = read_records("runs", tool=tool)
+    if fpath.exists():
+        with fpath.open("r") as file:
+            cached = json.load(file)
+        if cached.get("n_records") == len(records) and cached.get("features") == FEATURES:
+            return cached if cached.get("models") else None
+    predictor = train(tool, records=records) or {"tool": tool, "features": FEATURES}
+    predictor["n_records"] = len(records)
+    predictor["trained"] = datetime.now().isoformat(timespec="seconds")
+    model_dir.mkdir(parents=True, exist_ok=True)
+    # Write a copy and rename it, so concurrent runs never read a half-written file
+    tmp = fpath.with_name(f"{fpath.name}.{os.getpid()}.tmp")
+    with tmp.open("w") as file:
+        json.dump(predictor, file, indent=2)
+    os.replace(tmp, fpath)
+    return predictor if predictor.get("models") else None
+
+
+def predict(features, tool="nibabies", predictor=None):
+    """Predict the elapsed time and the peak memory of a run.
+
+    Returns a dict with ``elapsed_s`` and ``peak_mem_bytes`` (the expected values),
+    ``elapsed_s_upper`` and ``peak_mem_bytes_upper`` (what to request, see
+    ``SAFETY_Z``) and ``source``, which is ``"model"`` or ``"default"``.
+    """
+    if predictor is None:
+        predictor = load_predictor(tool)
+    prediction = {"source": "default"}
+    for target, default in DEFAULTS[tool].items():
+        prediction[target] = prediction[f"{target}_upper"] = default
+    if not predictor:
+        return prediction
+    row = [float(features.get(name, 0)) for name in predictor["features"]]
+    for target, model in predictor["models"].items():
+        log_value = predict_ridge(model, row)
+        prediction[target] = round(math.exp(log_value))
+        prediction[f"{target}_upper"] = round(
+            math.exp(log_value + SAFETY_Z * model["residual_std"])
+        )
+    prediction["source"] = "model"
+    return prediction
+
+
+def sbatch_resources(prediction, *, margin=1.2, min_minutes=30, max_hours=48):
+    """Turn a prediction into the ``--time`` and ``--mem`` of a SLURM job.
+
+    The time is rounded up to 15 minutes and the memory to the GB. A ``"default"``
+    prediction is already the request of the sbatch scripts, so it gets no margin.
+    """
+    if prediction.get("source") == "default":
+        margin = 1.0
+    minutes = prediction["elapsed_s_upper"] * margin / 60
+    minutes = min(max(math.ceil(minutes / 15) * 15, min_minutes), max_hours * 60)
+    hours, minutes = divmod(int(minutes), 60)
+    mem_gb = math.ceil(prediction["peak_mem_bytes_upper"] * margin / 2**30)
+    return {"time": f"{hours}:{minutes:02d}:00", "mem": f"{mem_gb}G"}
+
+
+def estimate_batch(project, subjects, session, *, start=None, tool="nibabies", **feature_kwargs):
+    """Predict when each subject of a batch that runs one after the other finishes.
+
+    Returns a list of ``(subject, predicted seconds, predicted finish time)``.
+    """
+    predictor = load_predictor(tool)
+    finish = datetime.now() if start is None else start
+    estimates = []
+    for subject in subjects:
+        features = subject_features(project, subject, session, **feature_kwargs)
+        seconds = predict(features, tool=tool, predictor=predictor)["elapsed_s"]
+        finish = finish + timedelta(seconds=seconds)
+        estimates.append((subject, seconds, finish))
+    return estimates
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Predict the runtime of subjects.")
+    parser.add_argument("--project", required=True, choices=["BABIES", "ABC"])
+    parser.add_argument("--session", required=True, choices=["newborn", "sixmonth", "twelvemonth"])
+    parser.add_argument("--subjects", nargs="+", required=True)
+    parser.add_argument("--tool", default="nibabies", choices=list(DEFAULTS))
+    parser.add_argument(
+        "--surface-recon-method",
+        default="infantfs",
+        choices=["infantfs", "freesurfer", "mcribs"],
+        dest="surface_recon_method",
+    )
+    parser.add_argument("--anat-only", action="store_true", dest="anat_only")
+    parser.add_argument(
+        "--format",
+        default="table",
+        choices=["table", "sbatch"],
+        help="'sbatch' prints '<subject> --time=... --mem=...' lines. Default is 'table'.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    predictor = load_predictor(args["tool"])
+    for subject in args["subjects"]:
+        features = subject_features(
+            args["project"],
+            subject,
+            args["session"],
+            surface_recon_method=args["surface_recon_method"],
+            anat_only=args["anat_only"],
+        )
+        prediction = predict(features, tool=args["tool"], predictor=predictor)
+        resources = sbatch_resources(prediction)
+        if args["format"] == "sbatch":
+            print(f"{subject} --time={resources['time']} --mem={resources['mem']}")
+        else:
+            print(
+                f"{subject:<10} {prediction['elapsed_s'] / 3600:>6.2f} h"
+                f" {prediction['peak_mem_bytes'] / 2**30:>6.1f} GB"
+                f"  request {resources['time']} {resources['mem']} ({prediction['source']})"
+            )
+
+
+if __name__ == "__main__":
+    main()
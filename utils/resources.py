@@ -0,0 +1,315 @@
+"""Plan the CPUs and memory of each Nibabies container.
+
+The plan divides the capacity of the host (or of the SLURM allocation, or of the
+Docker VM) between the subjects that run at the same time, and uses the recorded peak memory of past runs
+(see :mod:`utils.monitor` and :mod:`utils.nodes`) to check that they fit. The same
+plan is turned into Nibabies arguments (``--nprocs``, ``--omp-nthreads``,
+``--mem-mb``) for both launchers, and into Docker limits (``--cpus``,
+``--memory``). Under SLURM, the job's cgroup already enforces the limits, so the
+singularity launcher only needs the Nibabies arguments::
+
+    python -m utils.resources --format nibabies
+"""
+
+import argparse
+import math
+import os
+import subprocess
+
+from .ledger import read_records
+
+# Nibabies' own default, ANTs and FreeSurfer nodes rarely scale past 8 threads
+MAX_OMP_NTHREADS = 8
+# Nipype's memory estimates are rough, so we leave some headroom in the container
+NIPYPE_MEM_FRACTION = 0.9
+
+
+def host_capacity():
+    """Return the number of CPUs and the bytes of memory that we are allowed to use.
+
+    Inside a SLURM job, this is the allocation (``SLURM_CPUS_PER_TASK`` and
+    ``SLURM_MEM_PER_NODE``), else the CPUs this process may run on and the physical
+    memory of the computer.
+    """
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        n_cpus = int(os.environ["SLURM_CPUS_PER_TASK"])
+    elif hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count()
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        mem_bytes = int(os.environ["SLURM_MEM_PER_NODE"]) * 2**20
+    elif os.environ.get("SLURM_MEM_PER_CPU"):
+        mem_bytes = int(os.environ["SLURM_MEM_PER_CPU"]) * 2**20 * n_cpus
+    else:
+        try:
+            mem_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        except (ValueError, OSError):
+            mem_bytes = None
+    return n_cpus, mem_bytes
+
+
+def docker_capacity(docker="docker"):
+    """Return the number of CPUs and the bytes of memory that Docker containers can use.
+
+    On macOS, Docker Desktop runs the containers in a virtual machine that has fewer
+    CPUs and less memory than the computer, so :func:`host_capacity` is too much.
+    Returns None if ``docker info`` fails.
+    """
+    try:
+        output = subprocess.run(
+            [docker, "info", "--format", "{{.NCPU}} {{.MemTotal}}"],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=60,
+        ).stdout
+        n_cpus, mem_bytes = (int(value) for value in output.split())
+    except (OSError, subprocess.SubprocessError, ValueError):
+        return None
+    return n_cpus, mem_bytes
+
+
+def get_capacity(launcher=None):
+    """Return the CPUs and memory to divide, and where they were read from.
+
+    For the ``"docker"`` launcher, this is :func:`docker_capacity`. Otherwise, or if
+    Docker does not answer, this is :func:`host_capacity`.
+    """
+    if launcher == "docker":
+        capacity = docker_capacity()
+        if capacity is not None:
+            return (*capacity, "docker info")
+    n_cpus, mem_bytes = host_capacity()
+    if os.environ.get("SLURM_CPUS_PER_TASK") or os.environ.get("SLURM_MEM_PER_NODE"):
+        source = "the SLURM allocation"
+    else:
+        source = "this computer"
+    if launcher == "docker":
+        source += ", docker info failed"
+    return n_cpus, mem_bytes, source
+
+
+def historical_usage(ledger_dir=None, **filters):
+    """Return the peak memory and threads of past Nibabies runs, from the ledgers.
+
+    Returns a dict with ``peak_mem_bytes`` (the highest peak of the ``runs``
+    ledger), ``max_node_mem_gb`` (the most memory a single Nipype node used),
+    ``max_node_threads`` (the most threads, on average, a single node used) and
+    ``max_omp_nthreads`` (the most threads a node was allowed to use in a run, as
+    recorded by :func:`utils.docker.run_nibabies`). Values are None when nothing
+    was recorded.
+    """
+    runs = read_records("runs", ledger_dir=ledger_dir, tool="nibabies", **filters)
+    nodes = read_records("nodes", ledger_dir=ledger_dir, **filters)
+    run_peaks = [run["peak_mem_bytes"] for run in runs if run.get("peak_mem_bytes")]
+    node_mem = [node["mem_peak_gb"] for node in nodes if node.get("mem_peak_gb")]
+    node_threads = [node["cpu_percent"] / 100 for node in nodes if node.get("cpu_percent")]
+    omp_nthreads = [run["omp_nthreads"] for run in runs if run.get("omp_nthreads")]
+    return {
+        "peak_mem_bytes": max(run_peaks) if run_peaks else None,
+        "max_node_mem_gb": max(node_mem) if node_mem else None,
+        "max_node_threads": max(node_threads) if node_threads else None,
+        "max_omp_nthreads": max(omp_nthreads) if omp_nthreads else None,
+    }
+
+
+def plan_resources(
+    concurrent=1,
+    *,
+    n_cpus=None,
+    mem_bytes=None,
+    reserve_cpus=1,
+    reserve_mem_gb=2,
+    history=None,
+    launcher=None,
+):
+    """Plan the CPUs, threads and memory of each of ``concurrent`` containers.
+
+    Parameters
+    ----------
+    concurrent : int
+        The number of subjects that run at the same time on this host. Default is 1.
+    n_cpus, mem_bytes : int, optional
+        The capacity to divide. Default is None, which uses :func:`get_capacity`.
+    reserve_cpus, reserve_mem_gb : int
+        What to keep for the operating system, Docker and the transfers. Not used
+        inside a SLURM job, where the allocation is only for us. Default is 1 CPU
+        and 2 GB.
+    history : dict | None
+        The output of :func:`historical_usage`. Default is None, which reads it from
+        the ledgers. Pass ``{}`` to ignore past runs.
+    launcher : str | None
+        ``"docker"`` to divide the capacity of Docker (see :func:`docker_capacity`)
+        instead of the one of this computer. Default is None.
+
+    Returns
+    -------
+    plan : dict
+        ``nprocs``, ``omp_nthreads`` and ``mem_mb`` for Nibabies, ``cpus`` and
+        ``memory_mb`` for the container, ``max_concurrent`` (how many subjects fit
+        at the same time according to past runs, or None) and ``notes``, which
+        explain the choices.
+    """
+    if concurrent < 1:
+        raise ValueError(f"concurrent must be at least 1, but got: {concurrent}")
+    notes = []
+    if n_cpus is None or mem_bytes is None:
+        host_cpus, host_mem, source = get_capacity(launcher)
+        n_cpus = host_cpus if n_cpus is None else n_cpus
+        mem_bytes = host_mem if mem_bytes is None else mem_bytes
+        memory = "unknown memory" if mem_bytes is None else f"{mem_bytes / 2**30:.1f} GB"
+        notes.append(f"{n_cpus} CPUs and {memory}, from {source}")
+    if history is None:
+        history = historical_usage()
+    if mem_bytes is None:
+        mem_bytes = 16 * 2**30
+        notes.append("could not read the memory of this computer, assuming 16 GB")
+    if os.environ.get("SLURM_JOB_ID"):
+        reserve_cpus, reserve_mem_gb = 0, 0
+        notes.append("inside a SLURM job, the whole allocation is used")
+
+    cpus = max(1, (n_cpus - reserve_cpus) // concurrent)
+    memory_mb = max(1024, int((mem_bytes / 2**20 - reserve_mem_gb * 1024) / concurrent))
+    if concurrent > 1 and (n_cpus - reserve_cpus) < concurrent:
+        notes.append(
+            f"{concurrent} subjects on {n_cpus} CPUs oversubscribes the cores,"
+            " each container gets 1 CPU"
+        )
+
+    omp_nthreads = min(cpus, MAX_OMP_NTHREADS)
+    if cpus > 1:
+        # Leave a core for the other nodes that run at the same time
+        omp_nthreads = min(omp_nthreads, cpus - 1)
+    if history.get("max_node_threads") and history.get("max_omp_nthreads"):
+        # Threads that no node ever used are better spent running nodes in parallel.
+        # A node can't use more threads than it was given, so this only tells that
+        # threads are wasted when a run gave the nodes more than they used.
+        useful = math.ceil(history["max_node_threads"])
+        if useful < history["max_omp_nthreads"] and useful < omp_nthreads:
+            omp_nthreads = max(1, useful)
+            notes.append(
+                f"no node used more than {useful} of the {history['max_omp_nthreads']}"
+                " threads it was given in past runs"
+            )
+
+    max_concurrent = None
+    if history.get("peak_mem_bytes"):
+        peak_mb = history["peak_mem_bytes"] / 2**20
+        max_concurrent = max(1, int((mem_bytes / 2**20 - reserve_mem_gb * 1024) // peak_mb))
+        if peak_mb > memory_mb:
+            notes.append(
+                f"past runs peaked at {peak_mb:.0f} MB, more than the {memory_mb} MB of"
+                f" each container. Run at most {max_concurrent} subjects at a time."
+            )
+    if history.get("max_node_mem_gb") and history["max_node_mem_gb"] * 1024 > memory_mb:
+        notes.append(
+            f"a node used {history['max_node_mem_gb']:.1f} GB in past runs, more than"
+            f" the {memory_mb} MB of each container"
+        )
+    return {
+        "nprocs": cpus,
+        "omp_nthreads": omp_nthreads,
+        "mem_mb": int(memory_mb * NIPYPE_MEM_FRACTION),
+        "cpus": cpus,
+        "memory_mb": memory_mb,
+        "concurrent": concurrent,
+        "max_concurrent": max_concurrent,
+        "notes": notes,
+    }
+
+
+def escalate_plan(plan, level=1, *, mem_bytes=None, reserve_mem_gb=2, launcher=None):
+    """Return a plan for running a subject again after it ran out of memory.
+
+    Each ``level`` halves the number of Nipype nodes that run at the same time
+    (``nprocs``), which lowers the peak memory the most, and doubles the memory of
+    the container, up to what this computer has (less ``reserve_mem_gb``). The
+    other subjects that run at the same time may then have to wait for memory.
+    ``launcher`` is the one of :func:`plan_resources`.
+    """
+    if mem_bytes is None:
+        mem_bytes = get_capacity(launcher)[1] or plan["memory_mb"] * 2**20 * plan["concurrent"]
+    if os.environ.get("SLURM_JOB_ID"):
+        reserve_mem_gb = 0
+    max_memory_mb = int(mem_bytes / 2**20 - reserve_mem_gb * 1024)
+    plan = dict(plan)
+    plan["nprocs"] = max(1, plan["nprocs"] // 2**level)
+    plan["omp_nthreads"] = min(plan["omp_nthreads"], plan["nprocs"])
+    plan["memory_mb"] = max(plan["memory_mb"], min(plan["memory_mb"] * 2**level, max_memory_mb))
+    plan["mem_mb"] = int(plan["memory_mb"] * NIPYPE_MEM_FRACTION)
+    plan["notes"] = plan["notes"] + [
+        f"ran out of memory {level} time(s), retrying with {plan['nprocs']} processes"
+        f" and {plan['memory_mb']} MB"
+    ]
+    return plan
+
+
+def nibabies_args(plan):
+    """Return the Nibabies arguments of a plan, see :func:`plan_resources`."""
+    return [
+        "--nprocs", str(plan["nprocs"]),
+        "--omp-nthreads", str(plan["omp_nthreads"]),
+        "--mem-mb", str(plan["mem_mb"]),
+    ]
+
+
+def docker_args(plan):
+    """Return the ``docker run`` limits of a plan, see :func:`plan_resources`."""
+    return ["--cpus", str(plan["cpus"]), "--memory", f"{plan['memory_mb']}m"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Plan the resources of Nibabies containers.")
+    parser.add_argument(
+        "--concurrent",
+        type=int,
+        default=1,
+        help="Number of subjects that run at the same time. Default is 1.",
+    )
+    parser.add_argument(
+        "--format",
+        default="summary",
+        choices=["summary", "nibabies", "docker"],
+        help="'nibabies' and 'docker' print the arguments to pass to Nibabies or to"
+        " docker run, so that shell scripts can use them. Default is 'summary'.",
+    )
+    parser.add_argument(
+        "--ignore-history",
+        action="store_true",
+        dest="ignore_history",
+        help="Do not use the resource usage of past runs.",
+    )
+    parser.add_argument(
+        "--launcher",
+        default=None,
+        choices=["docker", "singularity"],
+        help="'docker' divides the CPUs and memory that Docker reports, which can be"
+        " less than the computer's (Docker Desktop). Default is 'docker' with"
+        " --format docker, else the capacity of this computer or SLURM allocation.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    launcher = args["launcher"] or ("docker" if args["format"] == "docker" else None)
+    plan = plan_resources(
+        args["concurrent"],
+        history={} if args["ignore_history"] else None,
+        launcher=launcher,
+    )
+    if args["format"] == "nibabies":
+        print(" ".join(nibabies_args(plan)))
+    elif args["format"] == "docker":
+        print(" ".join(docker_args(plan)))
+    else:
+        for key, value in plan.items():
+            if key != "notes":
+                print(f"{key:<16} {value}")
+        for note in plan["notes"]:
+            print(f"note: {note}")
+
+
+if __name__ == "__main__":
+    main()
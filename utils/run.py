@@ -1,4 +1,5 @@
-from .config import SubjectConfig
+from .config import SubjectConfig, get_local_root
+from .tracing import span
 from .utils import (
     create_filter_file,
     create_precomputed_files,
@@ -21,6 +22,9 @@ def prepare_subject_files(
     check_args=None,
     mri_processing_dir=None,
     verbose="INFO",
+    archive=False,
+    profile="auto",
+    transport=None,
 ):
     """Prepare the files for a single subject to be run through Nibabies.
 
@@ -33,9 +37,9 @@ def prepare_subject_files(
     session : str
         The session label. For example, "newborn" or "sixmonth".
     mri_processing_dir : str, optional
-        The path to the MRI-Processing directory that contains these scripts. Default
-        is None, which assumes that the current directory is the MRI-Processing
-        directory. If not None, this should be the path to the MRI-Processing directory.
+        The directory that holds the project directories, where the files are pulled
+        to. Default is None, which uses :func:`utils.config.get_local_root` (the
+        ``MRI_LOCAL_ROOT`` environment variable, or this repository).
     anat_only : bool, optional
         If true, only pull files for the anatomical data. Default is False.
     bids_only : bool, optional
@@ -56,6 +60,16 @@ def prepare_subject_files(
         The username must be an actual account on the Whale computer. Default is None,
         does nothing if the IP address is None, but raises an error if the IP address
         is not None.
+    archive : bool, optional
+        If true, pull the subject's recon-all directory as a single compressed tar
+        archive instead of file by file. Default is False.
+    profile : str, optional
+        The rsync transfer profile, ``"auto"``, ``"default"``, ``"lan"`` or ``"wan"``.
+        Default is ``"auto"``, which picks one from a measurement of the link.
+    transport : str, optional
+        The name of the transport used to pull the files, for example ``"rsync"`` or
+        ``"local"``. Default is None, which uses the ``MRI_TRANSPORT`` environment
+        variable, or rsync if it is not set.
     """
     server_is_mounted = ip_address is None
 
@@ -73,41 +87,49 @@ def prepare_subject_files(
     project = config["project"]
     subject_id = config["subject_id"]
     session = config["session"]
-    p_root = "." if mri_processing_dir is None else mri_processing_dir
+    p_root = get_local_root() if mri_processing_dir is None else mri_processing_dir
 
-    pull_subject_files(
-        project,
-        subject_id,
-        session,
-        output_dir=p_root,
-        anat_only=anat_only,
-        bids_only=bids_only,
-        dry_run=dry_run,
-        ip_address=ip_address,
-        username=username,
-        verbose=verbose,
-    )
+    with span("pull"):
+        pull_subject_files(
+            project,
+            subject_id,
+            session,
+            output_dir=p_root,
+            anat_only=anat_only,
+            bids_only=bids_only,
+            dry_run=dry_run,
+            ip_address=ip_address,
+            username=username,
+            verbose=verbose,
+            archive=archive,
+            profile=profile,
+            transport=transport,
+        )
+    if dry_run:
+        # Nothing was pulled, so there are no files to make the precomputed ones from
+        return
 
-    config.get_spatial_file()
-    config.check_paths(local=True, server=False, mode="error")
-    rename_t1w_files(config["local_paths"]["sub_anatpath"])
+    with span("precomputed"):
+        config.get_spatial_file()
+        config.check_paths(local=True, server=False, mode="error")
+        rename_t1w_files(config["local_paths"]["sub_anatpath"])
 
-    if bids_only:
-        return
+        if bids_only:
+            return
 
-    create_precomputed_files(
-        reconall_dir=config["local_paths"]["reconall"],
-        output_dir=config["local_paths"]["precomputed"],
-        subject=config["subject_id"],
-        session=config["session"],
-        space=config["space"],
-        overwrite=True,
-    )
+        create_precomputed_files(
+            reconall_dir=config["local_paths"]["reconall"],
+            output_dir=config["local_paths"]["precomputed"],
+            subject=config["subject_id"],
+            session=config["session"],
+            space=config["space"],
+            overwrite=True,
+        )
 
-    create_precomputed_jsons(
-        precomputed_dir=config["local_paths"]["precomputed"],
-        spatial_reference_fname=config["spatial_file"],
-        subject=config["subject_id"],
-        session=config["session"],
-        space=config["space"],
-    )
+        create_precomputed_jsons(
+            precomputed_dir=config["local_paths"]["precomputed"],
+            spatial_reference_fname=config["spatial_file"],
+            subject=config["subject_id"],
+            session=config["session"],
+            space=config["space"],
+        )
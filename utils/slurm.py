@@ -0,0 +1,481 @@
+"""Submit a cohort to SLURM as job arrays, one array per stage.
+
+The stages of each subject are chained with ``--dependency=aftercorr``, so task
+``i`` of a stage starts as soon as task ``i`` of the previous stage succeeded,
+without waiting for the other subjects::
+
+    prepare (pull + precomputed) -> [bibsnet] -> nibabies -> push (+ clean up)
+
+Each array reads its subject from line ``SLURM_ARRAY_TASK_ID + 1`` of a subjects
+file, see the SLURM scripts. The whole cohort is submitted in one call::
+
+    python -m utils.slurm --project BABIES --session newborn --subjects 1462 1470 \\
+        --ip-address XX.X.XXX.XXX --username "SEALAB_USERNAME" --throttle nibabies=10
+
+The ``sbatch`` command can be replaced (``--sbatch`` or the ``MRI_SBATCH``
+environment variable), for example by ``benchmarks/stubs/sbatch``.
+"""
+
+import argparse
+import os
+import shlex
+import subprocess
+from datetime import datetime
+from pathlib import Path
+
+from .ledger import append_record
+
+REPO_DIR = Path(__file__).parent.parent
+
+# The script of each stage, and the directory it must run from
+STAGES = {
+    "prepare": {"script": "SLURM/prepare_subject.sbatch", "chdir": "."},
+    "bibsnet": {"script": "SLURM/submit_bibsnet_job.sbatch", "chdir": "SLURM"},
+    "nibabies": {"script": "nibabies.sbatch", "chdir": "."},
+    "push": {"script": "SLURM/push_subject.sbatch", "chdir": "."},
+}
+# How many tasks of each stage may run at the same time (the %N of --array). The
+# transfers share the link to the lab server, and BIBSnet needs GPUs.
+DEFAULT_THROTTLE = {"prepare": 4, "bibsnet": 2, "nibabies": None, "push": 4}
+
+
+def get_sbatch():
+    """Return the sbatch command, from the ``MRI_SBATCH`` environment variable."""
+    return os.environ.get("MRI_SBATCH", "sbatch")
+
+
+def parse_job_id(output):
+    """Parse the output of ``sbatch --parsable``, i.e. ``<job id>[;<cluster>]``."""
+    return output.strip().splitlines()[-1].split(";")[0]
+
+
+def stage_arguments(
+    stage,
+    project,
+    session,
+    *,
+    surface_recon_method="freesurfer",
+    anat_only=False,
+    ip_address=None,
+    username=None,
+):
+    """Return the command line arguments of the script of a stage.
+
+    The subject argument is a placeholder, the scripts read it from the subjects
+    file.
+    """
+    anat_flag = ["--anat-only"] if anat_only else []
+    if stage == "prepare":
+        return [project, "array", session, ip_address, username] + anat_flag
+    if stage == "bibsnet":
+        return [project, "array", session]
+    if stage == "nibabies":
+        method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
+        return [project, "array", session, method] + anat_flag
+    if stage == "push":
+        return [project, "array", session, surface_recon_method, ip_address, username] + anat_flag
+    raise ValueError(f"stage must be one of {list(STAGES)}, but got: {stage}")
+
+
+def submit_array(
+    script,
+    arguments,
+    *,
+    n_tasks,
+    subjects_file,
+    job_name,
+    dependency=None,
+    throttle=None,
+    time=None,
+    mem=None,
+    chdir=".",
+    sbatch=None,
+    dry_run=False,
+):
+    """Submit a job array of ``n_tasks`` tasks, and return its job id.
+
+    ``dependency`` is the job id of the previous stage, which is waited for with
+    ``aftercorr``. ``time`` and ``mem`` override the ``#SBATCH`` lines of the script.
+    With ``dry_run``, the command is printed, and a placeholder job id is returned.
+    """
+    array = f"0-{n_tasks - 1}" + (f"%{throttle}" if throttle else "")
+    command = [
+        sbatch or get_sbatch(),
+        "--parsable",
+        f"--array={array}",
+        f"--job-name={job_name}",
+        f"--chdir={(REPO_DIR / chdir).resolve()}",
+        f"--output={(REPO_DIR / 'SLURM' / 'log').resolve()}/%A_%a.out",
+        f"--export=ALL,SUBJECTS_FILE={Path(subjects_file).resolve()}",
+    ]
+    if dependency is not None:
+        command.append(f"--dependency=aftercorr:{dependency}")
+    if time is not None:
+        command.append(f"--time={time}")
+    if mem is not None:
+        command.append(f"--mem={mem}")
+    command += [str((REPO_DIR / script).resolve())] + [str(arg) for arg in arguments]
+    return _submit(command, job_name, dry_run)
+
+
+def _submit(command, job_name, dry_run):
+    print(" ".join(shlex.quote(part) for part in command))
+    if dry_run:
+        return f"<{job_name}>"
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    return parse_job_id(output)
+
+
+def pack_subjects(durations, capacity_s):
+    """Pack subjects into as few jobs as possible, each at most ``capacity_s`` long.
+
+    ``durations`` are the predicted seconds of each subject, by subject. Subjects
+    are placed longest first, each in the first job that still has room for it
+    (first fit decreasing). A subject that is longer than ``capacity_s`` gets a
+    job of its own. Returns a list of lists of subjects.
+    """
+    jobs = []
+    for subject in sorted(durations, key=durations.get, reverse=True):
+        for job in jobs:
+            if job["total_s"] + durations[subject] <= capacity_s:
+                break
+        else:
+            job = {"subjects": [], "total_s": 0.0}
+            jobs.append(job)
+        job["subjects"].append(subject)
+        job["total_s"] += durations[subject]
+    return [job["subjects"] for job in jobs]
+
+
+def pack_bibsnet_jobs(
+    project,
+    subjects,
+    session,
+    *,
+    max_hours=4,
+    margin=1.2,
+    sbatch=None,
+    dry_run=False,
+):
+    """Submit BIBSnet for many subjects as a few jobs that run several subjects each.
+
+    Each job loads the container and holds its GPUs once for all of its subjects,
+    instead of once per subject. The subjects are packed with :func:`pack_subjects`
+    from their predicted runtimes (see :mod:`utils.predict`), so that each job fits
+    in ``max_hours``, and the ``--time`` and ``--mem`` of each job are the sum of
+    the predicted runtimes and the largest predicted memory of its subjects.
+
+    Returns a dict of job id to the subjects of the job.
+    """
+    from .predict import load_predictor, predict, sbatch_resources, subject_features
+
+    subjects = [str(subject) for subject in subjects]
+    predictor = load_predictor("bibsnet")
+    predictions = {
+        subject: predict(subject_features(project, subject, session), "bibsnet", predictor)
+        for subject in subjects
+    }
+    durations = {subject: predictions[subject]["elapsed_s_upper"] for subject in subjects}
+    batch = f"{datetime.now():%Y%m%d-%H%M%S}"
+    jobs = dict()
+    for ii, packed in enumerate(pack_subjects(durations, max_hours * 3600 / margin)):
+        subjects_file = (
+            REPO_DIR / "SLURM" / "arrays" / f"bibsnet_{project}_{session}_{batch}_{ii}.txt"
+        )
+        subjects_file.parent.mkdir(parents=True, exist_ok=True)
+        subjects_file.write_text("\n".join(packed) + "\n")
+        resources = sbatch_resources(
+            {
+                "elapsed_s_upper": sum(durations[subject] for subject in packed),
+                "peak_mem_bytes_upper": max(
+                    predictions[subject]["peak_mem_bytes_upper"] for subject in packed
+                ),
+            },
+            margin=margin,
+        )
+        job_name = f"bibsnet_{project}_{session}_{ii}"
+        command = [
+            sbatch or get_sbatch(),
+            "--parsable",
+            f"--job-name={job_name}",
+            f"--chdir={(REPO_DIR / STAGES['bibsnet']['chdir']).resolve()}",
+            f"--output={(REPO_DIR / 'SLURM' / 'log').resolve()}/%j.out",
+            f"--export=ALL,BIBSNET_SUBJECTS_FILE={subjects_file.resolve()}",
+            f"--time={resources['time']}",
+            f"--mem={resources['mem']}",
+            str((REPO_DIR / STAGES["bibsnet"]["script"]).resolve()),
+            project,
+            "batch",
+            session,
+        ]
+        job_id = _submit(command, job_name, dry_run)
+        jobs[job_id] = packed
+        if not dry_run:
+            append_record(
+                "submissions",
+                dict(
+                    batch=batch,
+                    job_id=job_id,
+                    stage="bibsnet",
+                    packed=True,
+                    project=project,
+                    session=session,
+                    subjects=packed,
+                    subjects_file=subjects_file,
+                    time=resources["time"],
+                    mem=resources["mem"],
+                ),
+            )
+    print(f"Packed {len(subjects)} subjects into {len(jobs)} BIBSnet jobs")
+    return jobs
+
+
+def _nibabies_resources(project, subjects, session, *, surface_recon_method, anat_only):
+    """Return the largest predicted ``--time`` and ``--mem`` of the subjects."""
+    from .predict import load_predictor, predict, sbatch_resources, subject_features
+
+    predictor = load_predictor("nibabies")
+    if predictor is None:
+        return None, None
+    method = "infantfs" if surface_recon_method == "freesurfer" else surface_recon_method
+    predictions = []
+    for subject in subjects:
+        features = subject_features(
+            project, subject, session, surface_recon_method=method, anat_only=anat_only
+        )
+        if not features["anat_mvoxels"]:
+            # The inputs are not on this computer yet, keep the script's defaults
+            return None, None
+        prediction = predict(features, predictor=predictor)
+        if prediction["source"] == "default":
+            # Keep the #SBATCH lines of the script rather than a copy of them
+            return None, None
+        predictions.append(prediction)
+    # The tasks of an array share the same request, so it must fit the longest one
+    longest = max(predictions, key=lambda prediction: prediction["elapsed_s_upper"])
+    largest = max(predictions, key=lambda prediction: prediction["peak_mem_bytes_upper"])
+    return sbatch_resources(longest)["time"], sbatch_resources(largest)["mem"]
+
+
+def submit_cohort(
+    project,
+    subjects,
+    session,
+    *,
+    surface_recon_method="freesurfer",
+    anat_only=False,
+    ip_address=None,
+    username=None,
+    bibsnet=False,
+    stages=None,
+    throttle=None,
+    predict_resources=True,
+    sbatch=None,
+    dry_run=False,
+):
+    """Submit all the stages of a list of subjects as chained job arrays.
+
+    Parameters
+    ----------
+    project, session : str
+        For example ``"BABIES"`` and ``"newborn"``.
+    subjects : list of str
+        The subject labels, for example ``["1462", "1470"]``.
+    surface_recon_method : str
+        ``"freesurfer"`` or ``"mcribs"``. Default is ``"freesurfer"``.
+    ip_address, username : str
+        The address and the lab account of the Whale computer, used by the prepare
+        and push stages to reach the lab server.
+    bibsnet : bool
+        If True, run BIBSnet between the prepare and the Nibabies stages. Default is
+        False.
+    stages : list of str, optional
+        The stages to submit, in order. Default is None, which submits
+        ``prepare``, ``bibsnet`` (if ``bibsnet``), ``nibabies`` and ``push``.
+    throttle : dict, optional
+        How many tasks of each stage may run at the same time, for example
+        ``{"nibabies": 10}``. Stages that are not in the dict use
+        ``DEFAULT_THROTTLE``.
+    predict_resources : bool
+        If True, the ``--time`` and ``--mem`` of the Nibabies array are predicted
+        from past runs (see :mod:`utils.predict`), when there are enough of them.
+        Default is True.
+    sbatch : str, optional
+        The sbatch command. Default is None, which uses :func:`get_sbatch`.
+    dry_run : bool
+        If True, print the sbatch commands without submitting them.
+
+    Returns
+    -------
+    job_ids : dict
+        The job id of each stage. Each submission is also saved to the
+        ``submissions`` ledger, so that tasks can be mapped back to subjects.
+    """
+    subjects = [str(subject) for subject in subjects]
+    if not subjects:
+        raise ValueError("subjects must not be empty")
+    if stages is None:
+        stages = ["prepare"] + (["bibsnet"] if bibsnet else []) + ["nibabies", "push"]
+    if {"prepare", "push"} & set(stages) and (ip_address is None or username is None):
+        raise ValueError("The prepare and push stages need an ip_address and a username.")
+    throttle = {**DEFAULT_THROTTLE, **(throttle or {})}
+
+    batch = f"{datetime.now():%Y%m%d-%H%M%S}"
+    subjects_file = REPO_DIR / "SLURM" / "arrays" / f"{project}_{session}_{batch}.txt"
+    subjects_file.parent.mkdir(parents=True, exist_ok=True)
+    subjects_file.write_text("\n".join(subjects) + "\n")
+
+    job_ids = dict()
+    previous = None
+    for stage in stages:
+        time = mem = None
+        if stage == "nibabies" and predict_resources:
+            time, mem = _nibabies_resources(
+                project,
+                subjects,
+                session,
+                surface_recon_method=surface_recon_method,
+                anat_only=anat_only,
+            )
+        job_id = submit_array(
+            STAGES[stage]["script"],
+            stage_arguments(
+                stage,
+                project,
+                session,
+                surface_recon_method=surface_recon_method,
+                anat_only=anat_only,
+                ip_address=ip_address,
+                username=username,
+            ),
+            n_tasks=len(subjects),
+            subjects_file=subjects_file,
+            job_name=f"{stage}_{project}_{session}",
+            dependency=previous,
+            throttle=throttle.get(stage),
+            time=time,
+            mem=mem,
+            chdir=STAGES[stage]["chdir"],
+            sbatch=sbatch,
+            dry_run=dry_run,
+        )
+        job_ids[stage] = previous = job_id
+        if not dry_run:
+            append_record(
+                "submissions",
+                dict(
+                    batch=batch,
+                    job_id=job_id,
+                    stage=stage,
+                    project=project,
+                    session=session,
+                    surface_recon_method=surface_recon_method,
+                    anat_only=anat_only,
+                    subjects=subjects,
+                    subjects_file=subjects_file,
+                    time=time,
+                    mem=mem,
+                ),
+            )
+    print(f"Submitted {len(subjects)} subjects: " + ", ".join(f"{k}={v}" for k, v in job_ids.items()))
+    return job_ids
+
+
+def _parse_throttle(values):
+    throttle = dict()
+    for value in values or []:
+        stage, _, limit = value.partition("=")
+        if stage not in STAGES or not limit.isdigit():
+            raise argparse.ArgumentTypeError(
+                f"--throttle expects <stage>=<number> with a stage in {list(STAGES)}, but got: {value}"
+            )
+        throttle[stage] = int(limit) or None
+    return throttle
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Submit subjects to SLURM as job arrays.")
+    parser.add_argument("--project", required=True, choices=["BABIES", "ABC"])
+    parser.add_argument("--session", required=True, choices=["newborn", "sixmonth"])
+    subjects = parser.add_mutually_exclusive_group(required=True)
+    subjects.add_argument("--subjects", nargs="+", help="Space separated subject labels.")
+    subjects.add_argument(
+        "--subjects-file",
+        dest="subjects_file",
+        help="A text file with one subject label per line.",
+    )
+    parser.add_argument(
+        "--surface-recon-method",
+        default="freesurfer",
+        choices=["freesurfer", "mcribs"],
+        dest="surface_recon_method",
+    )
+    parser.add_argument("--anat-only", action="store_true", dest="anat_only")
+    parser.add_argument("--ip-address", dest="ip_address", default=None)
+    parser.add_argument("--username", dest="username", default=None)
+    parser.add_argument(
+        "--bibsnet", action="store_true", help="Run BIBSnet before Nibabies."
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=None,
+        help="Only submit these stages, in this order. Default is all of them.",
+    )
+    parser.add_argument(
+        "--throttle",
+        nargs="+",
+        default=None,
+        help="Maximum running tasks per stage, for example 'prepare=4 nibabies=10'."
+        " 0 means no limit.",
+    )
+    parser.add_argument(
+        "--no-predict",
+        action="store_false",
+        dest="predict_resources",
+        help="Keep the --time and --mem of nibabies.sbatch instead of predicting them.",
+    )
+    parser.add_argument(
+        "--pack-bibsnet",
+        type=float,
+        default=None,
+        dest="pack_bibsnet",
+        metavar="HOURS",
+        help="Only submit BIBSnet, packing several subjects into each job of at most"
+        " HOURS hours, instead of the job arrays of all the stages.",
+    )
+    parser.add_argument("--sbatch", default=None, help="The sbatch command to use.")
+    parser.add_argument("--dry-run", action="store_true", dest="dry_run")
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    subjects_file = args.pop("subjects_file")
+    if subjects_file is not None:
+        args["subjects"] = [
+            line.strip() for line in Path(subjects_file).read_text().splitlines() if line.strip()
+        ]
+    args["throttle"] = _parse_throttle(args["throttle"])
+    pack_hours = args.pop("pack_bibsnet")
+    if pack_hours is not None:
+        pack_bibsnet_jobs(
+            args["project"],
+            args["subjects"],
+            args["session"],
+            max_hours=pack_hours,
+            sbatch=args["sbatch"],
+            dry_run=args["dry_run"],
+        )
+        return
+    submit_cohort(
+        args.pop("project"),
+        args.pop("subjects"),
+        args.pop("session"),
+        **args,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+
+from . import ledger
+
+# Thread id of the stack samples in the trace, see StackSampler
+SAMPLER_TID = 0
+
+_TRACER = None
+
+
+class Tracer:
+    """Collect timed spans, and save them in the Chrome trace format.
+
+    The trace can be opened with https://ui.perfetto.dev or ``chrome://tracing``.
+    Spans are saved as complete (``"X"``) events, so that the spans of each thread
+    show up as a nested timeline.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = datetime.now()
+        self.events = []
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+        self._threads = dict()
+        self._lock = threading.Lock()
+
+    def now_us(self):
+        """Return the time since the tracer was created, in microseconds."""
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def add_span(self, name, start_us, end_us, *, category="stage", tid=None, **args):
+        """Add a span that started and ended at the given times (see :meth:`now_us`)."""
+        if tid is None:
+            tid = threading.get_ident()
+            self._threads.setdefault(tid, threading.current_thread().name)
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": round(start_us, 1),
+            "dur": round(end_us - start_us, 1),
+            "pid": self._pid,
+            "tid": tid,
+            "args": args,
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def to_dict(self):
+        """Return the trace as a dict in the Chrome trace format."""
+        threads = dict(self._threads)
+        if any(event["tid"] == SAMPLER_TID for event in self.events):
+            threads[SAMPLER_TID] = "sampled Python stacks"
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": self._pid, "args": {"name": self.name}}
+        ]
+        metadata += [
+            {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+            for tid, name in threads.items()
+        ]
+        return {
+            "traceEvents": metadata + self.events,
+            "displayTimeUnit": "ms",
+            "otherData": {"name": self.name, "started": self.started.isoformat()},
+        }
+
+    def save(self, fpath):
+        fpath = Path(fpath)
+        fpath.parent.mkdir(parents=True, exist_ok=True)
+        with fpath.open("w") as file:
+            json.dump(self.to_dict(), file, default=str)
+        return fpath
+
+
+def _stack_labels(frame, max_depth=64):
+    """Return the labels of the frames of a stack, outermost first."""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        code = frame.f_code
+        labels.append(f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return labels[::-1]
+
+
+class StackSampler(threading.Thread):
+    """Sample the Python stack of a thread, and add it to a trace as nested spans.
+
+    A frame that stays on the stack for consecutive samples becomes one span, so a
+    stall shows up as a long span under the function that was waiting.
+    """
+
+    def __init__(self, tracer, thread_id=None, interval_s=0.01):
+        super().__init__(name="stack-sampler", daemon=True)
+        self.tracer = tracer
+        self.thread_id = threading.get_ident() if thread_id is None else thread_id
+        self.interval_s = interval_s
+        self._stop_event = threading.Event()
+
+    def run(self):
+        open_frames = []  # (label, start_us), outermost first
+        while not self._stop_event.wait(self.interval_s):
+            stack = _stack_labels(sys._current_frames().get(self.thread_id))
+            now = self.tracer.now_us()
+            common = 0
+            while (
+                common < min(len(stack), len(open_frames))
+                and stack[common] == open_frames[common][0]
+            ):
+                common += 1
+            self._close(open_frames[common:], now)
+            open_frames = open_frames[:common] + [(label, now) for label in stack[common:]]
+        self._close(open_frames, self.tracer.now_us())
+
+    def _close(self, frames, end_us):
+        for label, start_us in reversed(frames):
+            self.tracer.add_span(label, start_us, end_us, category="sample", tid=SAMPLER_TID)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextmanager
+def span(name, category="stage", **args):
+    """Time the code inside, and add it to the current trace as a span.
+
+    Spans can be nested. ``args`` are saved with the span, for example the subject
+    or the path being transferred. This does nothing when no trace is running, see
+    :func:`trace`.
+    """
+    tracer = _TRACER
+    if tracer is None:
+        yield
+        return
+    start = tracer.now_us()
+    try:
+        yield
+    except BaseException as error:
+        args["error"] = repr(error)
+        raise
+    finally:
+        tracer.add_span(name, start, tracer.now_us(), category=category, **args)
+
+
+def traced(name=None, category="stage"):
+    """Decorate a function so that each call is a span, see :func:`span`."""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, category=category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace(name, trace_dir=None, profile=None, interval_s=0.01):
+    """Record the spans of the code inside, and save them to ``{trace_dir}/{name}.json``.
+
+    Parameters
+    ----------
+    name : str
+        The name of the trace, for example the batch id.
+    trace_dir : path-like, optional
+        Where to save the trace. Default is None, which uses ``logs/traces``.
+    profile : str, optional
+        Also profile the Python code of this thread. ``"cprofile"`` saves the output
+        of :mod:`cProfile` to ``{trace_dir}/{name}.prof``, which can be read with
+        :mod:`pstats` or snakeviz. ``"sample"`` samples the stack every
+        ``interval_s`` seconds and adds it to the trace, under its own thread, so it
+        lines up with the spans. Default is None, which does not profile.
+    """
+    global _TRACER
+    if profile not in [None, "cprofile", "sample"]:
+        raise ValueError(f"profile must be None, 'cprofile' or 'sample', but got: {profile}")
+    trace_dir = ledger.LEDGER_DIR / "traces" if trace_dir is None else Path(trace_dir)
+    previous = _TRACER
+    tracer = _TRACER = Tracer(name)
+    profiler = cProfile.Profile() if profile == "cprofile" else None
+    sampler = StackSampler(tracer, interval_s=interval_s) if profile == "sample" else None
+    if profiler is not None:
+        profiler.enable()
+    if sampler is not None:
+        sampler.start()
+    try:
+        yield tracer
+    finally:
+        trace_dir.mkdir(parents=True, exist_ok=True)
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(trace_dir / f"{name}.prof")
+            print(f"Saved the Python profile to {trace_dir / f'{name}.prof'}")
+        if sampler is not None:
+            sampler.stop()
+        _TRACER = previous
+        fpath = tracer.save(trace_dir / f"{name}.json")
+        print(f"Saved the trace to {fpath}")
@@ -0,0 +1,498 @@
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from shlex import quote
+
+from .metrics import record_transfer
+from .tracing import traced
+
+
+# rsync exit codes that are usually caused by a flaky or dropped connection, and
+# that are worth retrying: socket I/O (10), protocol data stream (12), timeouts (30,
+# 35) and SSH errors (255). Everything else, such as syntax errors (1), missing
+# files (23) or a full disk (11), is permanent.
+RSYNC_TRANSIENT_EXIT_CODES = {10, 12, 30, 35, 255}
+# Some source files vanished during the transfer. Not an error for us.
+RSYNC_VANISHED_EXIT_CODE = 24
+
+
+class RsyncError(RuntimeError):
+    """Raised when rsync fails. ``transient`` is True if a retry could succeed."""
+
+    def __init__(self, command, returncode):
+        self.command = command
+        self.returncode = returncode
+        self.transient = returncode in RSYNC_TRANSIENT_EXIT_CODES
+        kind = "transient" if self.transient else "permanent"
+        super().__init__(
+            f"rsync failed with exit code {returncode} ({kind}): {' '.join(command)}"
+        )
+
+
+def plan_transfers(
+    sources,
+    destinations,
+    *,
+    live_root=None,
+    snapshot_root=None,
+    previous_snapshot=None,
+):
+    """Build a de-duplicated list of rsync transfers.
+
+    Parameters
+    ----------
+    sources : list of path-like
+        The local files or directories to push.
+    destinations : list of path-like
+        The server directory that each source should be pushed into. Must be the same
+        length as ``sources``.
+    live_root : path-like, optional
+        The server directory that is normally written to, for example
+        ``".../derivatives/Nibabies"``. Only used if ``snapshot_root`` is not None.
+    snapshot_root : path-like, optional
+        If not None, every destination that lives under ``live_root`` is redirected to
+        the same relative location under ``snapshot_root``, and the original location
+        is passed to rsync as a ``--link-dest``. Files that did not change since the
+        last run are then hard-linked on the server instead of being sent again.
+    previous_snapshot : path-like, optional
+        A snapshot directory from an earlier run. If provided, it is also passed to
+        rsync as a ``--link-dest``. Only used if ``snapshot_root`` is not None.
+
+    Returns
+    -------
+    plan : list of dict
+        One dict per transfer, with the keys ``"source"``, ``"destination"`` and
+        ``"link_dest"`` (a list of server directories, possibly empty).
+
+    Notes
+    -----
+    Exact duplicates (same source and same destination) are dropped. If the same
+    source is pushed to more than one destination, only the first push sends the
+    data, and later pushes use the first destination as a ``--link-dest``, so that the
+    server hard-links the files that were just copied.
+    """
+    if len(sources) != len(destinations):
+        raise ValueError(
+            f"Got {len(sources)} sources but {len(destinations)} destinations."
+        )
+    if snapshot_root is not None and live_root is None:
+        raise ValueError("live_root must be provided if snapshot_root is not None.")
+
+    plan = []
+    seen = set()
+    first_destination = dict()
+    for source, destination in zip(sources, destinations):
+        source = Path(source)
+        destination = Path(destination)
+        key = (source.resolve(), destination)
+        if key in seen:
+            continue
+        seen.add(key)
+
+        link_dest = []
+        if snapshot_root is not None and destination.is_relative_to(live_root):
+            relative_path = destination.relative_to(live_root)
+            link_dest.append(destination)
+            if previous_snapshot is not None:
+                link_dest.append(Path(previous_snapshot) / relative_path)
+            destination = Path(snapshot_root) / relative_path
+        if source.resolve() in first_destination:
+            link_dest.insert(0, first_destination[source.resolve()])
+        else:
+            first_destination[source.resolve()] = destination
+        plan.append(
+            {"source": source, "destination": destination, "link_dest": link_dest}
+        )
+    return plan
+
+
+def get_previous_snapshot(snapshots_dir, exclude=None):
+    """Return the most recent snapshot directory in snapshots_dir, or None.
+
+    Snapshot labels are expected to start with a ``YYYYMMDD`` date, so sorting by name
+    returns them in chronological order. This only works if the server is mounted.
+    """
+    snapshots_dir = Path(snapshots_dir)
+    if not snapshots_dir.exists():
+        return None
+    snapshots = sorted(
+        path
+        for path in snapshots_dir.iterdir()
+        if path.is_dir() and path.name != exclude
+    )
+    return snapshots[-1] if snapshots else None
+
+
+def make_server_dirs(paths, *, server_is_mounted=True, ip_address=None, username=None):
+    """Create directories on the server, so that rsync can push into them."""
+    if server_is_mounted:
+        for path in paths:
+            Path(path).mkdir(parents=True, exist_ok=True)
+        return
+    command = ["ssh", f"{username}@{ip_address}", "mkdir", "-p"]
+    command += [str(path) for path in paths]
+    print(" ".join(command))
+    subprocess.run(command, check=True)
+
+
+def file_sha256(fpath, chunk_size=2**20):
+    """Return the sha256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with Path(fpath).open("rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _run_pipeline(command):
+    """Run a shell pipeline and raise an error if any part of it fails."""
+    print(f"\n{command}\n")
+    subprocess.run(["bash", "-o", "pipefail", "-c", command], check=True)
+
+
+def _check_zstd():
+    if shutil.which("zstd") is None:
+        raise FileNotFoundError(
+            "The archive transport needs the zstd command line tool. "
+            "Install it, for example with 'brew install zstd' or 'conda install zstd'."
+        )
+
+
+@traced("pack archive", category="transfer")
+def pack_directory(source_dir, archive_fpath):
+    """Pack a directory into a single zstd compressed tar file.
+
+    The archive contains the directory itself (not only its contents), and is
+    compressed with all available cores (``zstd -T0``). Returns the sha256 of the
+    archive.
+    """
+    _check_zstd()
+    source_dir = Path(source_dir).resolve()
+    if not source_dir.is_dir():
+        raise FileNotFoundError(f"{source_dir} does not exist or is not a directory")
+    _run_pipeline(
+        f"tar -C {quote(str(source_dir.parent))} -cf - {quote(source_dir.name)}"
+        f" | zstd -T0 -q -f -o {quote(str(archive_fpath))}"
+    )
+    return file_sha256(archive_fpath)
+
+
+@traced("unpack archive", category="transfer")
+def unpack_archive(archive_fpath, destination_dir):
+    """Unpack an archive created by :func:`pack_directory` into destination_dir."""
+    _check_zstd()
+    destination_dir = Path(destination_dir)
+    destination_dir.mkdir(parents=True, exist_ok=True)
+    _run_pipeline(
+        f"zstd -dc -T0 {quote(str(archive_fpath))}"
+        f" | tar -C {quote(str(destination_dir))} -xf -"
+    )
+
+
+def _record_archive(local_dir, source_dir, destination_dir, start, **wire_bytes):
+    """Save the metrics of an archive transfer. local_dir is the local copy."""
+    n_files = sum(1 for fpath in Path(local_dir).rglob("*") if fpath.is_file())
+    record_transfer(
+        source=source_dir,
+        destination=destination_dir,
+        elapsed_s=time.perf_counter() - start,
+        transport="archive",
+        n_files_transferred=n_files,
+        **wire_bytes,
+    )
+
+
+def push_archive(
+    source_dir,
+    destination_dir,
+    *,
+    server_is_mounted=True,
+    ip_address=None,
+    username=None,
+):
+    """Push a directory to the server as one compressed tar stream.
+
+    This is much faster than rsync for directories with thousands of small files,
+    such as ``sourcedata/freesurfer/sub-XXXX`` or ``sub-XXXX/figures``. The result on
+    the server is the same as ``rsync source_dir destination_dir``, i.e.
+    ``destination_dir/<source_dir name>``.
+
+    Parameters
+    ----------
+    source_dir : path-like
+        The local directory to push.
+    destination_dir : path-like
+        The directory on the server to unpack ``source_dir`` into.
+    server_is_mounted : bool
+        Must be False: the archive is streamed over one SSH connection, its checksum
+        is verified on the server, and then it is unpacked there. The server must
+        have ``zstd`` and ``shasum`` installed. Unpacking into a mounted server
+        directory writes the files one by one over the share, which costs as much
+        as rsync plus the packing, so it raises a ValueError.
+    ip_address : str
+        The IP address of the Whale computer. Only used if server_is_mounted is False.
+    username : str
+        The username to use on the Whale computer. Only used if server_is_mounted is
+        False.
+    """
+    if server_is_mounted:
+        raise ValueError(
+            "An archive only speeds up a push over SSH. Push to a mounted server with rsync."
+        )
+    source_dir = Path(source_dir)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_fpath = Path(tmp_dir) / f"{source_dir.name}.tar.zst"
+        start = time.perf_counter()
+        checksum = pack_directory(source_dir, archive_fpath)
+        print(f"Packed {source_dir} into {archive_fpath} (sha256 {checksum})")
+
+        remote_archive = f"{destination_dir}/.{archive_fpath.name}"
+        remote_command = (
+            f"mkdir -p {quote(str(destination_dir))}"
+            f" && cat > {quote(remote_archive)}"
+            f" && echo {quote(f'{checksum}  {remote_archive}')} | shasum -a 256 -c -"
+            f" && zstd -dc -T0 {quote(remote_archive)}"
+            f" | tar -C {quote(str(destination_dir))} -xf -;"
+            f" status=$?; rm -f {quote(remote_archive)}; exit $status"
+        )
+        print(f"Streaming {archive_fpath.name} to {username}@{ip_address}:{destination_dir}")
+        with archive_fpath.open("rb") as file:
+            subprocess.run(
+                ["ssh", f"{username}@{ip_address}", remote_command],
+                stdin=file,
+                check=True,
+            )
+        _record_archive(
+            source_dir,
+            source_dir,
+            destination_dir,
+            start,
+            bytes_sent=archive_fpath.stat().st_size,
+        )
+    return checksum
+
+
+def pull_archive(
+    source_dir,
+    destination_dir,
+    *,
+    server_is_mounted=True,
+    ip_address=None,
+    username=None,
+):
+    """Pull a directory from the server as one compressed tar stream.
+
+    The counterpart of :func:`push_archive`. The result is
+    ``destination_dir/<source_dir name>``. If the server is not mounted, the archive
+    is built on the server, its checksum is sent back along with it, and it is
+    verified before it is unpacked locally.
+    """
+    source_dir = Path(source_dir)
+    destination_dir = Path(destination_dir)
+    start = time.perf_counter()
+    if server_is_mounted:
+        destination_dir.mkdir(parents=True, exist_ok=True)
+        _run_pipeline(
+            f"tar -C {quote(str(source_dir.parent))} -cf - {quote(source_dir.name)}"
+            f" | tar -C {quote(str(destination_dir))} -xf -"
+        )
+        _record_archive(
+            destination_dir / source_dir.name, source_dir, destination_dir, start
+        )
+        return None
+
+    remote_command = (
+        'tmp=$(mktemp -t mri_transfer.XXXXXX)'
+        f" && tar -C {quote(str(source_dir.parent))} -cf - {quote(source_dir.name)}"
+        ' | zstd -T0 -q -c > "$tmp"'
+        ' && shasum -a 256 "$tmp" >&2'
+        ' && cat "$tmp"; status=$?; rm -f "$tmp"; exit $status'
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        archive_fpath = Path(tmp_dir) / f"{source_dir.name}.tar.zst"
+        print(f"Streaming {username}@{ip_address}:{source_dir} to {archive_fpath}")
+        with archive_fpath.open("wb") as file:
+            result = subprocess.run(
+                ["ssh", f"{username}@{ip_address}", remote_command],
+                stdout=file,
+                stderr=subprocess.PIPE,
+                text=True,
+                check=True,
+            )
+        remote_checksums = re.findall(r"^([0-9a-f]{64})\s", result.stderr, re.M)
+        checksum = file_sha256(archive_fpath)
+        if not remote_checksums or remote_checksums[-1] != checksum:
+            raise OSError(
+                f"Checksum mismatch for {source_dir}: the server reported "
+                f"{remote_checksums[-1] if remote_checksums else 'nothing'}, "
+                f"but the received archive has {checksum}."
+            )
+        unpack_archive(archive_fpath, destination_dir)
+        _record_archive(
+            destination_dir / source_dir.name,
+            source_dir,
+            destination_dir,
+            start,
+            bytes_received=archive_fpath.stat().st_size,
+        )
+    return checksum
+
+
+# rsync options for each kind of link. "lan" sends whole files, because on a fast
+# link computing the delta costs more than sending the data. "wan" compresses the
+# stream and keeps the delta algorithm.
+TRANSFER_PROFILES = {
+    "default": dict(whole_file=False, compress=False, progress=True),
+    "lan": dict(whole_file=True, compress=False, progress=True),
+    "wan": dict(whole_file=False, compress=True, progress=True),
+}
+
+# A link is treated as a LAN if it is at least this fast and this responsive.
+LAN_MIN_BANDWIDTH_MBPS = 40
+LAN_MAX_LATENCY_S = 0.005
+
+_LINK_CACHE = dict()
+
+
+def probe_link(*, ip_address, username, probe_mb=8, refresh=False, timeout_s=60):
+    """Measure the latency and bandwidth of the SSH link to the Whale computer.
+
+    Everything goes through ``ssh``, so the host, port and keys of
+    ``~/.ssh/config`` apply. The result is cached for the lifetime of the Python
+    process, so a batch of subjects only probes the link once. Pass
+    ``refresh=True`` to measure again.
+
+    Returns
+    -------
+    link : dict
+        ``"latency_s"`` is the median time for a line to be echoed back by the
+        server, i.e. one round trip, and ``"bandwidth_mbps"`` is the upload rate in
+        megabytes per second.
+
+    Raises
+    ------
+    OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired
+        If the server cannot be reached over SSH.
+    """
+    key = f"{username}@{ip_address}"
+    if key in _LINK_CACHE and not refresh:
+        return _LINK_CACHE[key]
+    # Never ask for a password, and give up on an unreachable host
+    ssh = ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10", key]
+    # Echo a few lines through one session. The first one also waits for the
+    # connection to be set up, so it is left out.
+    round_trips = []
+    with subprocess.Popen(ssh + ["cat"], stdin=subprocess.PIPE, stdout=subprocess.PIPE) as process:
+        for _ in range(4):
+            start = time.perf_counter()
+            process.stdin.write(b"probe\n")
+            process.stdin.flush()
+            if process.stdout.readline() != b"probe\n":
+                raise OSError(f"Could not reach {key} over ssh (exit code {process.wait()})")
+            round_trips.append(time.perf_counter() - start)
+        process.stdin.close()
+    latency = sorted(round_trips[1:])[1]
+
+    start = time.perf_counter()
+    subprocess.run(ssh + ["true"], check=True, timeout=timeout_s)
+    handshake = time.perf_counter() - start
+
+    payload = os.urandom(probe_mb * 1024**2)
+    start = time.perf_counter()
+    subprocess.run(ssh + ["cat > /dev/null"], input=payload, check=True, timeout=timeout_s)
+    elapsed = max(time.perf_counter() - start - handshake, 1e-3)
+    link = {"latency_s": latency, "bandwidth_mbps": probe_mb / elapsed}
+    print(
+        f"Link to {ip_address}: {link['latency_s'] * 1000:.1f} ms latency,"
+        f" {link['bandwidth_mbps']:.1f} MB/s"
+    )
+    _LINK_CACHE[key] = link
+    return link
+
+
+def is_small_file_tree(path, min_files=1000, max_mean_size_kb=256):
+    """Return True if path is a directory with many small files."""
+    path = Path(path)
+    if not path.is_dir():
+        return False
+    n_files = 0
+    total_size = 0
+    for fpath in path.rglob("*"):
+        if fpath.is_file():
+            n_files += 1
+            total_size += fpath.stat().st_size
+    return n_files >= min_files and total_size / n_files <= max_mean_size_kb * 1024
+
+
+def measure_profile(*, server_is_mounted=True, ip_address=None, username=None):
+    """Return ``"lan"`` or ``"wan"``, from a measurement of the link to the server.
+
+    A mounted server is always ``"lan"``. If the link cannot be measured, for
+    example behind a firewall, returns ``"default"`` and leaves it to the
+    transfer itself to fail or succeed. See :func:`select_profile`.
+    """
+    if server_is_mounted:
+        return "lan"
+    try:
+        link = probe_link(ip_address=ip_address, username=username)
+    except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired) as error:
+        print(f"Could not measure the link to {ip_address} ({error}), using the default rsync options")
+        return "default"
+    is_lan = (
+        link["bandwidth_mbps"] >= LAN_MIN_BANDWIDTH_MBPS
+        and link["latency_s"] <= LAN_MAX_LATENCY_S
+    )
+    return "lan" if is_lan else "wan"
+
+
+def select_profile(
+    profile="auto",
+    *,
+    source=None,
+    server_is_mounted=True,
+    ip_address=None,
+    username=None,
+):
+    """Pick the rsync options for a transfer.
+
+    Parameters
+    ----------
+    profile : str | dict
+        ``"auto"`` (default) picks ``"lan"`` or ``"wan"`` from a measurement of the
+        link (see :func:`probe_link`), or ``"default"`` if the link cannot be
+        measured. A mounted server is always treated as
+        ``"lan"``, since rsync sees it as a local directory. Can also be the name of
+        one of the ``TRANSFER_PROFILES``, or a dict of options, to override the
+        automatic choice at a call site.
+    source : path-like, optional
+        The local directory being pushed. If it holds many small files, per-file
+        progress output is turned off, because printing it slows the transfer down.
+
+    Returns
+    -------
+    options : dict
+        The ``whole_file``, ``compress`` and ``progress`` options for
+        :func:`~utils.utils.do_rsync`.
+    """
+    if isinstance(profile, dict):
+        return dict(profile)
+    if profile != "auto":
+        if profile not in TRANSFER_PROFILES:
+            raise ValueError(
+                f"profile must be 'auto' or one of {list(TRANSFER_PROFILES)}, "
+                f"but got: {profile}"
+            )
+        return dict(TRANSFER_PROFILES[profile])
+
+    name = measure_profile(
+        server_is_mounted=server_is_mounted, ip_address=ip_address, username=username
+    )
+    options = dict(TRANSFER_PROFILES[name])
+    if source is not None and is_small_file_tree(source):
+        options["progress"] = False
+    return options
@@ -0,0 +1,410 @@
+import fcntl
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+
+from .metrics import record_transfer
+from .transfer import pull_archive, push_archive
+
+# ioctl that asks Linux copy-on-write file systems (btrfs, XFS) to clone a file
+_FICLONE = 0x40049409
+
+
+class FilterRules:
+    """Evaluate the rsync filter rules written by :func:`~utils.utils.create_filter_file`.
+
+    Supports the ``+``/``-`` rules with ``*``, ``**``, ``***`` and ``?`` wildcards,
+    trailing ``/`` (directories only) and leading ``/`` (anchored) patterns. Like
+    rsync, the first matching rule wins, and paths that match no rule are included.
+    """
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for sign, pattern in rules:
+            dir_only = pattern.endswith("/")
+            if pattern.endswith("/***"):
+                # "dir/***" matches the directory itself and everything inside it
+                self.rules.append((sign, _compile(pattern[:-4], False)))
+                pattern, dir_only = pattern[:-4] + "/**", False
+            self.rules.append((sign, _compile(pattern.rstrip("/"), dir_only)))
+
+    @classmethod
+    def from_file(cls, fpath):
+        rules = []
+        with Path(fpath).open("r") as file:
+            for line in file:
+                line = line.strip()
+                if line and line[0] in "+-":
+                    rules.append((line[0], line[2:]))
+        return cls(rules)
+
+    def included(self, relative_path, is_dir=False):
+        relative_path = str(relative_path)
+        for sign, (regex, dir_only) in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.search(relative_path):
+                return sign == "+"
+        return True
+
+
+def _compile(pattern, dir_only):
+    anchored = pattern.startswith("/")
+    regex = ""
+    for token in re.split(r"(\*\*|\*|\?)", pattern.lstrip("/")):
+        regex += {"**": ".*", "*": "[^/]*", "?": "[^/]"}.get(token, re.escape(token))
+    prefix = "^" if anchored else "(?:^|/)"
+    return re.compile(f"{prefix}{regex}$"), dir_only
+
+
+def _split_relative(source):
+    """Split an rsync ``-R`` source ``"root/./relative"`` into its two parts."""
+    source = str(source)
+    if "/./" in source:
+        root, relative = source.split("/./", 1)
+        return Path(root), Path(relative)
+    source = Path(source)
+    return source.parent, Path(source.name)
+
+
+def _walk(root, relative, rules):
+    """Yield the files under root/relative that the filter rules include."""
+    top = root / relative
+    if top.is_file():
+        yield relative
+        return
+    for dirpath, dirnames, filenames in os.walk(top):
+        dir_relative = Path(dirpath).relative_to(root)
+        dirnames[:] = sorted(
+            name for name in dirnames if rules.included(dir_relative / name, True)
+        )
+        for name in sorted(filenames):
+            if rules.included(dir_relative / name, False):
+                yield dir_relative / name
+
+
+def _is_same_file(src, dst):
+    if not dst.exists():
+        return False
+    src_stat, dst_stat = src.stat(), dst.stat()
+    return (
+        src_stat.st_size == dst_stat.st_size
+        and int(src_stat.st_mtime) == int(dst_stat.st_mtime)
+    )
+
+
+def _reflink_or_copy(src, dst):
+    """Clone src to dst if the file system supports it, otherwise copy it."""
+    try:
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+        shutil.copystat(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class Transport:
+    """Move subject files between this computer and the lab server.
+
+    Subclasses implement :meth:`pull` and :meth:`push`, with the same semantics as
+    the rsync commands they replace:
+
+    - ``pull(source, destination)`` copies ``source`` into the ``destination``
+      directory. If ``source`` contains a ``/./`` marker, the path after the marker
+      is kept under ``destination`` (like ``rsync -R``). Otherwise only the last
+      component of ``source`` is kept. A ``filter_file`` selects the files to copy.
+    - ``push(source, destination)`` copies the file or directory ``source`` into
+      the ``destination`` directory. Files that are identical to the same file under
+      one of the ``link_dest`` directories are hard-linked instead, where possible.
+
+    Transfers are saved to the ``transfers`` ledger, and the rsync, local and fake
+    transports return the record. Server paths are always plain paths: a remote
+    transport adds the ``username@ip_address:`` prefix itself.
+    """
+
+    name = None
+
+    def __init__(self, *, server_is_mounted=True, ip_address=None, username=None):
+        self.server_is_mounted = server_is_mounted
+        self.ip_address = ip_address
+        self.username = username
+
+    def __repr__(self):
+        return f"{type(self).__name__}(server_is_mounted={self.server_is_mounted})"
+
+    def pull(self, source, destination, *, filter_file=None, dry_run=False, **options):
+        raise NotImplementedError
+
+    def push(self, source, destination, *, link_dest=None, exclude=None, **options):
+        raise NotImplementedError
+
+
+class RsyncTransport(Transport):
+    """Transfer files with rsync, locally or over SSH. This is the default."""
+
+    name = "rsync"
+
+    def _remote(self, path):
+        if self.server_is_mounted:
+            return path
+        return f"{self.username}@{self.ip_address}:{path}"
+
+    def pull(self, source, destination, *, filter_file=None, dry_run=False, **options):
+        # imported here because utils.utils imports this module
+        from .utils import do_rsync
+
+        return do_rsync(
+            self._remote(source),
+            Path(destination),
+            filter_file=filter_file,
+            dry_run=dry_run,
+            server_is_mounted=self.server_is_mounted,
+            priority="pull",
+            **options,
+        )
+
+    def push(self, source, destination, *, link_dest=None, exclude=None, **options):
+        from .utils import do_rsync
+
+        options.setdefault("flags", "-rltv")
+        return do_rsync(
+            source,
+            Path(self._remote(destination)),
+            server_is_mounted=self.server_is_mounted,
+            link_dest=link_dest,
+            exclude=exclude,
+            priority="push",
+            **options,
+        )
+
+
+class LocalCopyTransport(Transport):
+    """Copy files between local directories, without rsync.
+
+    Use this when the "server" is on the same file system, for example a local
+    stand-in server directory (see ``MRI_SERVER_ROOT``). Files are cloned where the
+    file system supports it (``mode="reflink"``, the default), or hard-linked
+    (``mode="hardlink"``), or copied (``mode="copy"``).
+    """
+
+    name = "local"
+
+    def __init__(self, *, mode="reflink", **kwargs):
+        super().__init__(**kwargs)
+        if not self.server_is_mounted:
+            raise ValueError("The local transport can only be used with a mounted server.")
+        if mode not in ["reflink", "hardlink", "copy"]:
+            raise ValueError(
+                f"mode must be 'reflink', 'hardlink' or 'copy', but got: {mode}"
+            )
+        self.mode = mode
+
+    def _copy_file(self, src, dst, link_dest=()):
+        if _is_same_file(src, dst):
+            return 0
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        if dst.exists():
+            dst.unlink()
+        for candidate in link_dest:
+            if _is_same_file(src, candidate):
+                os.link(candidate, dst)
+                return 0
+        if self.mode == "hardlink":
+            os.link(src, dst)
+            return 0
+        if self.mode == "reflink":
+            _reflink_or_copy(src, dst)
+        else:
+            shutil.copy2(src, dst)
+        return dst.stat().st_size
+
+    def _copy_tree(self, root, relative, destination, rules, link_dest, dry_run):
+        start = time.perf_counter()
+        n_files = 0
+        n_bytes = 0
+        for file_relative in _walk(root, relative, rules):
+            n_files += 1
+            if dry_run:
+                print(f"Would copy {root / file_relative}")
+                continue
+            n_bytes += self._copy_file(
+                root / file_relative,
+                destination / file_relative,
+                [Path(path) / file_relative for path in link_dest],
+            )
+        return record_transfer(
+            source=root / relative,
+            destination=destination,
+            elapsed_s=time.perf_counter() - start,
+            transport=self.name,
+            n_files_transferred=n_files,
+            bytes_sent=n_bytes,
+            save=not dry_run,
+        )
+
+    def pull(self, source, destination, *, filter_file=None, dry_run=False, **options):
+        root, relative = _split_relative(source)
+        rules = FilterRules() if filter_file is None else FilterRules.from_file(filter_file)
+        return self._copy_tree(root, relative, Path(destination), rules, [], dry_run)
+
+    def push(self, source, destination, *, link_dest=None, exclude=None, **options):
+        source = Path(source)
+        rules = FilterRules([("-", pattern) for pattern in exclude or []])
+        if isinstance(link_dest, (str, Path)):
+            link_dest = [link_dest]
+        return self._copy_tree(
+            source.parent,
+            Path(source.name),
+            Path(destination),
+            rules,
+            link_dest or [],
+            dry_run=False,
+        )
+
+
+class ArchiveTransport(RsyncTransport):
+    """Push and pull whole directories as single compressed tar streams.
+
+    Directories are sent with :func:`~utils.transfer.push_archive` and
+    :func:`~utils.transfer.pull_archive`. Single files, filtered pulls and pushes
+    that need ``link_dest`` or ``exclude`` can't be archived, so they go through
+    rsync. So do pushes to a mounted server, where the archive would be unpacked
+    file by file over the share.
+    """
+
+    name = "archive"
+
+    def pull(self, source, destination, *, filter_file=None, dry_run=False, **options):
+        if filter_file is not None or dry_run or "/./" in str(source):
+            return super().pull(
+                source, destination, filter_file=filter_file, dry_run=dry_run, **options
+            )
+        pull_archive(
+            source,
+            destination,
+            server_is_mounted=self.server_is_mounted,
+            ip_address=self.ip_address,
+            username=self.username,
+        )
+
+    def push(self, source, destination, *, link_dest=None, exclude=None, **options):
+        if self.server_is_mounted and Path(source).is_dir():
+            print(f"The server is mounted, pushing {source} with rsync instead of an archive")
+        if link_dest or exclude or self.server_is_mounted or not Path(source).is_dir():
+            return super().push(
+                source, destination, link_dest=link_dest, exclude=exclude, **options
+            )
+        push_archive(
+            source,
+            destination,
+            server_is_mounted=self.server_is_mounted,
+            ip_address=self.ip_address,
+            username=self.username,
+        )
+
+
+# The files of the fake server, shared by every FakeTransport that doesn't get its own
+_FAKE_SERVER = dict()
+
+
+class FakeTransport(Transport):
+    """An in-memory stand-in for the lab server, for tests and benchmarks.
+
+    The server is a dict that maps server paths (as strings) to file contents. Use
+    :meth:`add_file` to populate it. Every call is also appended to
+    ``operations``, so tests can check which transfers were requested.
+    """
+
+    name = "fake"
+
+    def __init__(self, *, files=None, **kwargs):
+        super().__init__(**kwargs)
+        self.files = _FAKE_SERVER if files is None else files
+        self.operations = []
+
+    def add_file(self, path, data=b""):
+        self.files[str(path)] = data
+
+    def pull(self, source, destination, *, filter_file=None, dry_run=False, **options):
+        self.operations.append(("pull", str(source), str(destination)))
+        root, relative = _split_relative(source)
+        rules = FilterRules() if filter_file is None else FilterRules.from_file(filter_file)
+        n_files = 0
+        n_bytes = 0
+        for path, data in sorted(self.files.items()):
+            path = Path(path)
+            if not path.is_relative_to(root / relative):
+                continue
+            file_relative = path.relative_to(root)
+            parents = [
+                parent
+                for parent in file_relative.parents
+                if parent != relative and parent.is_relative_to(relative)
+            ]
+            if not all(rules.included(parent, True) for parent in parents):
+                continue
+            if not rules.included(file_relative, False):
+                continue
+            n_files += 1
+            n_bytes += len(data)
+            if not dry_run:
+                local_path = Path(destination) / file_relative
+                local_path.parent.mkdir(parents=True, exist_ok=True)
+                local_path.write_bytes(data)
+        return record_transfer(
+            source=source,
+            destination=destination,
+            elapsed_s=0.0,
+            transport=self.name,
+            n_files_transferred=n_files,
+            bytes_received=n_bytes,
+            save=not dry_run,
+        )
+
+    def push(self, source, destination, *, link_dest=None, exclude=None, **options):
+        self.operations.append(("push", str(source), str(destination)))
+        source = Path(source)
+        rules = FilterRules([("-", pattern) for pattern in exclude or []])
+        n_files = 0
+        n_bytes = 0
+        for file_relative in _walk(source.parent, Path(source.name), rules):
+            data = (source.parent / file_relative).read_bytes()
+            self.files[str(Path(destination) / file_relative)] = data
+            n_files += 1
+            n_bytes += len(data)
+        return record_transfer(
+            source=source,
+            destination=destination,
+            elapsed_s=0.0,
+            transport=self.name,
+            n_files_transferred=n_files,
+            bytes_sent=n_bytes,
+        )
+
+
+TRANSPORTS = {
+    transport.name: transport
+    for transport in [RsyncTransport, LocalCopyTransport, ArchiveTransport, FakeTransport]
+}
+
+
+def get_transport(name=None, **kwargs):
+    """Return a transport.
+
+    Parameters
+    ----------
+    name : str | None
+        One of ``"rsync"``, ``"local"``, ``"archive"`` or ``"fake"``. Default is None,
+        which reads the ``MRI_TRANSPORT`` environment variable, and uses ``"rsync"``
+        if it is not set.
+    **kwargs
+        Passed to the transport, for example ``server_is_mounted``, ``ip_address``
+        and ``username``.
+    """
+    if name is None:
+        name = os.environ.get("MRI_TRANSPORT", "rsync")
+    if name not in TRANSPORTS:
+        raise ValueError(f"transport must be one of {list(TRANSPORTS)}, but got: {name}")
+    return TRANSPORTS[name](**kwargs)
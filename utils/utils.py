@@ -1,9 +1,19 @@
 import shutil
-import subprocess
+import time
 from pathlib import Path
 from warnings import warn
 
-from .config import Config
+from .bandwidth import get_scheduler
+from .config import Config, get_server_root
+from .metrics import rsync_version, run_rsync, transfer_context
+from .tracing import span
+from .transfer import (
+    RSYNC_VANISHED_EXIT_CODE,
+    TRANSFER_PROFILES,
+    RsyncError,
+    select_profile,
+)
+from .transport import get_transport
 
 BABIES_SERVER = Path("/Volumes") / "HumphreysLab" / "Daily_2" / "BABIES" / "MRI"
 
@@ -92,6 +102,9 @@ def pull_subject_files(
     username=None,
     dry_run=False,
     verbose="INFO",
+    archive=False,
+    profile="auto",
+    transport=None,
 ):
     """use rsync to pull the bids directory from 1 subject for a project like BABIES.
 
@@ -126,9 +139,21 @@ def pull_subject_files(
         computer, for example "Lab Username". Default is None, which does not do
         anything if ip_address is None as well, but will raise an error if ip_address
         is not None and username is None.
+    archive : bool
+        If True, the subject's recon-all directory, which holds thousands of small
+        files, is pulled as a single zstd compressed tar archive instead of with rsync.
+        Default is False.
+    profile : str | dict
+        The rsync transfer profile. Default is ``"auto"``, which measures the link to
+        the server once and picks suitable options. See
+        :func:`~utils.transfer.select_profile`.
+    transport : str | None
+        The name of the transport to use, see :func:`~utils.transport.get_transport`.
+        Default is None, which uses the ``MRI_TRANSPORT`` environment variable, or
+        rsync if it is not set.
     """
-    BABIES = Path("/Volumes") / "HumphreysLab" / "Daily_2" / "BABIES" / "MRI"
-    ABC = Path("/Volumes") / "HumphreysLab" / "Daily_2" / "ABC" / "MRI"
+    BABIES = get_server_root() / "BABIES" / "MRI"
+    ABC = get_server_root() / "ABC" / "MRI"
     if project == "BABIES":
         input_dir = BABIES
         session = "six_month" if session == "sixmonth" else session
@@ -213,20 +238,32 @@ def pull_subject_files(
         subject_id=subject_id,
         session_dir=session,
         anat_only=anat_only,
-        bids_only=bids_only,
+        bids_only=bids_only or archive,
         filter_dwi=filter_dwi
     )
     rsync_input = f"{str(input_dir.parent.parent)}/./{project}/MRI/{session}"
-    if ip_address is not None:
-        rsync_input = f"{username}@{ip_address}:" + rsync_input
-    do_rsync(
-        rsync_input,
-        output_dir,
-        filter_file=filter_fpath,
-        dry_run=dry_run,
-        server_is_mounted=server_is_mounted,
-        verbose=verbose,
+    transport_kwargs = dict(
+        server_is_mounted=server_is_mounted, ip_address=ip_address, username=username
     )
+    with transfer_context(
+        project=project, subject=subject_id, session=session, stage="pull"
+    ):
+        with span("transfer", category="transfer", source=rsync_input):
+            get_transport(transport, **transport_kwargs).pull(
+                rsync_input,
+                output_dir,
+                filter_file=filter_fpath,
+                dry_run=dry_run,
+                verbose=verbose,
+                profile=select_profile(profile, **transport_kwargs),
+            )
+        if archive and not bids_only:
+            reconall_output = output_dir / project / "MRI" / session / "derivatives" / "recon-all"
+            if dry_run:
+                print(f"Would pull {recon_dir} to {reconall_output} as an archive.")
+                return
+            with span("transfer", category="transfer", source=recon_dir):
+                get_transport("archive", **transport_kwargs).pull(recon_dir, reconall_output)
 
 
 def do_rsync(
@@ -237,12 +274,45 @@ def do_rsync(
     flags="-ahR",
     server_is_mounted=True,
     verbose="INFO",
+    link_dest=None,
+    exclude=None,
+    profile=None,
+    retries=3,
+    backoff_s=30,
+    priority="push",
 ):
-    """Use rsync to copy files from one directory to another."""
+    """Use rsync to copy files from one directory to another.
+
+    ``link_dest`` can be a directory (or a list of directories) on the receiving side.
+    Files that are identical to a file in one of these directories are hard-linked
+    instead of being copied, see the ``--link-dest`` option of rsync. ``exclude`` can
+    be a list of patterns that are passed to rsync with ``--exclude``. ``profile`` is
+    a dict of transfer options returned by :func:`~utils.transfer.select_profile`.
+    Default is None, which uses ``TRANSFER_PROFILES["default"]``.
+
+    The rsync statistics, elapsed time and throughput are saved to the
+    ``logs/transfers.jsonl`` ledger (unless ``dry_run``), and the record is returned.
+
+    Partially transferred files are kept in a ``.rsync-partial`` directory, so if the
+    connection drops, the transfer resumes where it left off. Transient failures
+    (see ``RSYNC_TRANSIENT_EXIT_CODES``) are retried up to ``retries`` times, waiting
+    ``backoff_s`` seconds before the first retry and twice as long before each of the
+    next ones. Any other failure raises a :class:`~utils.transfer.RsyncError` right
+    away.
+
+    ``priority`` is ``"pull"`` or ``"push"``. Each attempt waits for a slot from the
+    shared :class:`~utils.bandwidth.BandwidthScheduler`, and is run with the
+    ``--bwlimit`` that it hands out.
+    """
     if server_is_mounted:
        assert Path(input_dir).exists(), f"{input_dir} does not exist"
        assert output_dir.exists(), f"{output_dir} does not exist"
-    flags = flags
+    if profile is None:
+        profile = TRANSFER_PROFILES["default"]
+    if profile["whole_file"]:
+        flags += "W"
+    if profile["compress"]:
+        flags += "z"
     if verbose == "INFO":
         flags += "v"
     elif verbose == "DEBUG":
@@ -256,14 +326,51 @@ def do_rsync(
         f"{input_dir}",
         f"{output_dir}",
         "--prune-empty-dirs",
-        "--progress",
+        "--partial-dir=.rsync-partial",
     ]
+    if not server_is_mounted:
+        # Give up on a stalled connection, so that it can be retried
+        command += ["--timeout=300"]
+    if profile["progress"]:
+        command += ["--progress"]
+    elif rsync_version() >= (3, 1, 0):
+        command += ["--info=progress2"]
     if filter_file is not None:
         command += [f"--filter=merge {filter_file}"]
+    if link_dest is not None:
+        if isinstance(link_dest, (str, Path)):
+            link_dest = [link_dest]
+        command += [f"--link-dest={path}" for path in link_dest]
+    if exclude is not None:
+        command += [f"--exclude={pattern}" for pattern in exclude]
     print("\n")
     print(" ".join(command))
     print("\n")
-    subprocess.run(command)
+    for attempt in range(retries + 1):
+        with get_scheduler().transfer(priority) as bwlimit:
+            attempt_command = list(command)
+            if bwlimit is not None:
+                attempt_command += [f"--bwlimit={bwlimit}"]
+            with transfer_context(attempt=attempt + 1, bwlimit_kbps=bwlimit), span(
+                "rsync",
+                category="transfer",
+                source=input_dir,
+                attempt=attempt + 1,
+                bwlimit_kbps=bwlimit,
+            ):
+                returncode, record = run_rsync(attempt_command, save=not dry_run)
+        if returncode == RSYNC_VANISHED_EXIT_CODE:
+            warn(f"Some files vanished before rsync could copy them: {input_dir}")
+            return record
+        if returncode == 0:
+            return record
+        error = RsyncError(command, returncode)
+        if not error.transient or attempt == retries:
+            raise error
+        delay = backoff_s * 2**attempt
+        warn(f"{error}\nRetrying in {delay} seconds ({attempt + 1}/{retries}).")
+        with span("retry backoff", category="wait", delay_s=delay):
+            time.sleep(delay)
 
 
 def delete_directory(path):
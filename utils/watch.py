@@ -0,0 +1,184 @@
+"""Find the subjects on the server that are ready for Nibabies, without rescanning everything.
+
+A subject is ready when the server has its anatomical BIDS files and its
+recon-all ``aseg.nii.gz`` and ``brain_mask.nii.gz``, but no Nibabies output for
+the session yet. The paths are the ones of :class:`utils.config.SubjectConfig`.
+
+:class:`Watcher` is polled. It lists the ``bids``, ``recon-all`` and ``Nibabies``
+directories of the session again only when their mtime changed (a new
+``sub-XXXX`` directory changes it), and keeps checking the few subjects that have
+some but not all of their inputs, for example while they are being copied. The
+inputs of a subject that settled, or that misses some, are checked again only
+when its anatomical or recon-all directory changed. So a poll of an unchanged
+server is a handful of ``stat`` calls, and two per candidate subject. A subject
+is only ready once its inputs have not changed for ``settle_s`` seconds, so that
+a copy in progress is not picked up::
+
+    python -m utils.watch --project BABIES --session newborn
+
+prints the subjects that are ready now. ``python orchestrator.py watch`` queues
+them as they appear.
+"""
+
+import argparse
+import os
+import time
+
+from .config import SubjectConfig
+
+# The recon-all files that the precomputed derivatives are made from
+RECONALL_FILES = ("aseg.nii.gz", "brain_mask.nii.gz")
+
+
+def subject_paths(project, subject, session):
+    """Return the server paths of a subject, see :meth:`SubjectConfig.create_path_dict`."""
+    config = SubjectConfig(
+        project, subject, session, get_spatial_file=False, server_is_mounted=False
+    )
+    return config["server_paths"]
+
+
+class Watcher:
+    """Poll the server for the subjects of a session that are ready for Nibabies.
+
+    Parameters
+    ----------
+    project : str
+        The project, for example ``"BABIES"``.
+    session : str
+        The session, for example ``"newborn"``.
+    settle_s : float
+        How long the inputs of a subject must be unchanged before it is ready.
+        Default is 600 seconds.
+    """
+
+    def __init__(self, project, session, *, settle_s=600.0):
+        self.project = project
+        self.session = session
+        self.settle_s = settle_s
+        paths = subject_paths(project, "", session)
+        self.directories = dict(
+            bids=paths["bids"], reconall=paths["reconall"], nibabies=paths["nibabies"]
+        )
+        self.mtimes = dict()
+        self.listings = dict()
+        # Subjects with Nibabies output for this session, which do not change back
+        self.done = set()
+        # The directory mtimes, newest input mtime and settled state of each subject
+        self.inputs = dict()
+        self.n_stats = 0
+
+    def _list(self, name):
+        """Return the ``sub-XXXX`` labels in a directory, listing it again only if it changed."""
+        directory = self.directories[name]
+        try:
+            self.n_stats += 1
+            mtime = directory.stat().st_mtime_ns
+        except FileNotFoundError:
+            return set()
+        if self.mtimes.get(name) != mtime:
+            with os.scandir(directory) as entries:
+                self.listings[name] = {
+                    entry.name[len("sub-"):]
+                    for entry in entries
+                    if entry.name.startswith("sub-") and entry.is_dir()
+                }
+            self.mtimes[name] = mtime
+        return self.listings[name]
+
+    def _newest_input(self, subject):
+        """Return the newest mtime of the inputs of a subject, or None if some are missing."""
+        paths = subject_paths(self.project, subject, self.session)
+        try:
+            self.n_stats += 1
+            with os.scandir(paths["sub_anatpath"]) as entries:
+                anat = [
+                    entry.stat().st_mtime
+                    for entry in entries
+                    if "_T1w.nii" in entry.name or "_T2w.nii" in entry.name
+                ]
+            self.n_stats += len(RECONALL_FILES)
+            reconall = [(paths["sub_reconall"] / fname).stat().st_mtime for fname in RECONALL_FILES]
+        except FileNotFoundError:
+            return None
+        return max(anat + reconall) if anat else None
+
+    def _directory_mtimes(self, subject):
+        """Return the mtimes of the anatomical and recon-all directories of a subject."""
+        paths = subject_paths(self.project, subject, self.session)
+        mtimes = []
+        for name in ("sub_anatpath", "sub_reconall"):
+            self.n_stats += 1
+            try:
+                mtimes.append(paths[name].stat().st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _check(self, subject, now):
+        """Return the newest input mtime of a subject and whether it settled, cached.
+
+        A new or renamed input changes its directory. A subject that has all its
+        inputs but did not settle yet is checked again at each poll, since a file
+        that is written in place does not change its directory.
+        """
+        mtimes = self._directory_mtimes(subject)
+        cached = self.inputs.get(subject)
+        if cached is not None and cached[0] == mtimes:
+            _, newest, settled = cached
+            if settled or newest is None:
+                return newest, settled
+        newest = self._newest_input(subject)
+        settled = newest is not None and now - newest >= self.settle_s
+        self.inputs[subject] = (mtimes, newest, settled)
+        return newest, settled
+
+    def poll(self, now=None):
+        """Return the subjects that are ready now, sorted.
+
+        A subject is returned at every poll until its Nibabies output appears, so
+        the caller remembers the ones it already queued.
+        """
+        now = time.time() if now is None else now
+        candidates = self._list("bids") & self._list("reconall")
+        started = self._list("nibabies")
+        ready = []
+        for subject in sorted(candidates - self.done):
+            # The Nibabies directory of the subject may hold another session
+            if subject in started:
+                self.n_stats += 1
+                if subject_paths(self.project, subject, self.session)["sub_nibabies"].exists():
+                    self.done.add(subject)
+                    self.inputs.pop(subject, None)
+                    continue
+            _, settled = self._check(subject, now)
+            if settled:
+                ready.append(subject)
+        return ready
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="List the subjects on the server that are ready for Nibabies."
+    )
+    parser.add_argument("--project", choices=["BABIES", "ABC"], required=True)
+    parser.add_argument("--session", choices=["newborn", "sixmonth"], required=True)
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=600.0,
+        dest="settle_s",
+        help="seconds the inputs of a subject must be unchanged. Default is 600.",
+    )
+    return vars(parser.parse_args())
+
+
+def main():
+    args = parse_args()
+    watcher = Watcher(args["project"], args["session"], settle_s=args["settle_s"])
+    for subject in watcher.poll():
+        print(subject)
+
+
+if __name__ == "__main__":
+    main()